@@ -0,0 +1,187 @@
+"""
+Measures how long Snakemake takes to build the DAG of the pipeline (dry-run)
+for a growing number of samples. The inputs are empty files and the
+pre-clusters are written beforehand (as if the checkpoint had run), so the
+whole DAG after the checkpoint is evaluated.
+
+    python benchmarks/dag_build.py --samples 100 1000 10000 --output dag_build.tsv
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import yaml
+from generators import sample_names, write_sample_sheet
+from measure import run_measured
+
+PACKAGE_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+
+def make_config(work_dir: pathlib.Path, sample_sheet: pathlib.Path) -> dict:
+    """Same keys as the config made by juno_snp.py, in reference mode"""
+    with open(PACKAGE_DIR.joinpath("config", "pipeline_parameters.yaml")) as file:
+        config = yaml.safe_load(file)
+    config.update(
+        {
+            "sample_sheet": str(sample_sheet),
+            "input_dir": str(work_dir.joinpath("input")),
+            "output_dir": str(work_dir.joinpath("output")),
+            "exclusion_file": "None",
+            "db_dir": str(work_dir.joinpath("db")),
+            "reference": str(work_dir.joinpath("reference.fasta")),
+            "mask": "None",
+            "precluster_state": "None",
+            "max_coverage": "None",
+            "mapping_cache": "None",
+            "mapping_cache_size": 50,
+            "use_singularity": "False",
+            "dryrun": False,
+            "referenceseeker": {
+                "db": str(work_dir.joinpath("db", "bacteria-refseq")),
+                "ani_threshold": 0.95,
+                "conserved_dna_threshold": 0.69,
+                "sliding_window": 400,
+                "search": "all",
+                "representatives": 3,
+            },
+            "mash": {
+                "kmer_length": 21,
+                "sketch_size": 1000,
+                "threshold": 0.01,
+                "sketch_cache": str(work_dir.joinpath("sketch_cache")),
+            },
+            "reference_store": {
+                "dir": str(work_dir.joinpath("db", "reference_genomes")),
+                "max_size_gb": 20,
+            },
+            "tree": {"algorithm": "upgma"},
+            "ml_tree": {"mode": "full", "cache": str(work_dir.joinpath("ml_cache"))},
+            "snippy": {"report": ""},
+            "resource_model": {
+                "mode": "fixed",
+                "file": str(PACKAGE_DIR.joinpath("config", "resource_model.yaml")),
+                "retries": 0,
+                "retry_factor": 1.5,
+            },
+            "profile_run": False,
+            "group_jobs": False,
+            "scratch_dir": "None",
+        }
+    )
+    return config
+
+
+def make_inputs(work_dir: pathlib.Path, n_samples: int, cluster_size: int) -> None:
+    """
+    Writes empty reads and assemblies, the sample sheet, the config and the
+    (already finished) pre-clusters with n_samples / cluster_size clusters.
+    """
+    samples = sample_names(n_samples)
+    sample_sheet = work_dir.joinpath("sample_sheet.yaml")
+    write_sample_sheet(sample_sheet, work_dir.joinpath("input"), samples)
+    work_dir.joinpath("reference.fasta").write_text(">ref\nACGT\n")
+    config_file = work_dir.joinpath("config.yaml")
+    with open(config_file, "w") as file:
+        yaml.dump(make_config(work_dir, sample_sheet), file)
+
+    # Written after the inputs, so the checkpoint is up to date
+    time.sleep(0.01)
+    clusters = {
+        sample: i // cluster_size + 1 for i, sample in enumerate(sorted(samples))
+    }
+    output_dir = work_dir.joinpath("output")
+    clusters_file = output_dir.joinpath("preclustering", "mock_clusters.yaml")
+    clusters_file.parent.mkdir(parents=True)
+    with open(clusters_file, "w") as file:
+        yaml.dump(clusters, file, default_flow_style=False)
+    for cluster in set(clusters.values()):
+        ref_dir = output_dir.joinpath("ref_genomes_used", f"cluster_{cluster}")
+        ref_dir.mkdir(parents=True)
+        ref_dir.joinpath("ref_genome.seq").write_text(">ref\nACGT\n")
+
+
+def time_dry_run(work_dir: pathlib.Path) -> tuple[float, float, int]:
+    """Wall time and peak memory (MB) of the dry-run and number of jobs in the DAG"""
+    log_file = work_dir.joinpath("dry_run.log")
+    seconds, max_rss_mb, returncode = run_measured(
+        [
+            sys.executable,
+            "-m",
+            "snakemake",
+            "--dry-run",
+            "--quiet",
+            "--cores",
+            "1",
+            "--snakefile",
+            str(PACKAGE_DIR.joinpath("Snakefile")),
+            "--directory",
+            str(work_dir),
+            "--configfile",
+            str(work_dir.joinpath("config.yaml")),
+        ],
+        log_file,
+        cwd=work_dir,
+    )
+    output = log_file.read_text()
+    if returncode != 0:
+        raise RuntimeError(f"Dry-run failed:\n{output}")
+    n_jobs = 0
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == "total":
+            n_jobs = int(fields[1])
+    return seconds, max_rss_mb, n_jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the Snakemake DAG build time against the number of samples."
+    )
+    parser.add_argument(
+        "-s",
+        "--samples",
+        help="Numbers of samples to benchmark.",
+        metavar="INT",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 5000],
+    )
+    parser.add_argument(
+        "-c",
+        "--cluster-size",
+        help="Number of samples per cluster.",
+        metavar="INT",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output tsv with the results. Printed if not given.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    args = parser.parse_args()
+    rows = ["samples\tclusters\tjobs\tseconds\tmax_rss_mb"]
+    for n_samples in args.samples:
+        with tempfile.TemporaryDirectory(prefix="juno_snp_dag_") as tmp_dir:
+            work_dir = pathlib.Path(tmp_dir)
+            make_inputs(work_dir, n_samples, args.cluster_size)
+            seconds, max_rss_mb, n_jobs = time_dry_run(work_dir)
+        n_clusters = -(-n_samples // args.cluster_size)
+        rows.append(
+            f"{n_samples}\t{n_clusters}\t{n_jobs}\t{seconds:.2f}\t{max_rss_mb:.1f}"
+        )
+        print(rows[-1], file=sys.stderr)
+    if args.output is None:
+        print("\n".join(rows))
+    else:
+        args.output.write_text("\n".join(rows) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+Seeded generators of synthetic inputs for the benchmarks, in the formats of
+the tools the pipeline runs: sample sheets, mash dist tables, Newick trees,
+referenceseeker results, snippy outputs and snippy-core alignments. The same
+seed always gives the same files.
+"""
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import yaml
+
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+REFERENCESEEKER_COLUMNS = [
+    "#ID",
+    "Mash Distance",
+    "ANI",
+    "Con. DNA",
+    "Taxonomy ID",
+    "Assembly Status",
+    "Organism",
+]
+LINE_WIDTH = 60
+CONTIG = "contig_1"
+
+
+def sample_names(n_samples: int) -> list:
+    return [f"sample{i:06d}" for i in range(n_samples)]
+
+
+def write_sample_sheet(
+    path: pathlib.Path, input_dir: pathlib.Path, samples: list, touch: bool = True
+) -> dict:
+    """Sample sheet as made by juno_library (reads and assembly per sample)"""
+    sample_sheet = {}
+    for sample in samples:
+        sample_sheet[sample] = {
+            "R1": str(input_dir.joinpath(f"{sample}_R1.fastq.gz")),
+            "R2": str(input_dir.joinpath(f"{sample}_R2.fastq.gz")),
+            "assembly": str(input_dir.joinpath(f"{sample}.fasta")),
+        }
+    if touch:
+        input_dir.mkdir(parents=True, exist_ok=True)
+        for files in sample_sheet.values():
+            for file in files.values():
+                pathlib.Path(file).touch()
+    with open(path, "w") as file:
+        yaml.dump(sample_sheet, file, default_flow_style=False)
+    return sample_sheet
+
+
+def make_clusters(samples: list, mean_size: float, rng: np.random.Generator) -> dict:
+    """
+    Pre-clusters with geometrically distributed sizes (many small clusters,
+    a few large ones), numbered by decreasing size as in preclustering.py
+    """
+    sizes = []
+    remaining = len(samples)
+    while remaining > 0:
+        sizes.append(min(remaining, int(rng.geometric(1 / mean_size))))
+        remaining -= sizes[-1]
+    sizes.sort(reverse=True)
+    order = rng.permutation(len(samples))
+    clusters = {}
+    start = 0
+    for cluster, size in enumerate(sizes, start=1):
+        for i in order[start : start + size]:
+            clusters[samples[i]] = cluster
+        start += size
+    return clusters
+
+
+def write_mash_table(
+    path: pathlib.Path,
+    clusters: dict,
+    rng: np.random.Generator,
+    threshold: float = 0.01,
+    other_pairs: int = 10,
+    batch_rows: int = 1_000_000,
+) -> None:
+    """
+    Output of mash dist (query, ref, distance, p-value, shared hashes) with
+    every pair within a cluster (below the threshold) and other_pairs pairs
+    per sample with samples of other clusters (above it). Both orders of a
+    pair and the pairs of a sample with itself are written, as when mash dist
+    compares a set of sketches against itself. Other pairs between clusters
+    are left out, as the table would grow with the square of the samples.
+    """
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(cluster, []).append(sample)
+    names = np.array([f"assemblies/{sample}.fasta" for sample in clusters])
+    sample_index = {sample: i for i, sample in enumerate(clusters)}
+    cluster_of = np.array(list(clusters.values()))
+    batches = [[], [], []]
+
+    def flush(mode: str) -> None:
+        query = np.concatenate(batches[0]) if batches[0] else np.empty(0, dtype=int)
+        ref = np.concatenate(batches[1]) if batches[1] else np.empty(0, dtype=int)
+        dist = np.concatenate(batches[2]) if batches[2] else np.empty(0)
+        shared = np.round(1000 * np.exp(-21 * dist)).astype(int)
+        pd.DataFrame(
+            {
+                "query": names[query],
+                "ref": names[ref],
+                "dist": np.round(dist, 7),
+                "p-value": 0,
+                "matches": [f"{value}/1000" for value in shared],
+            }
+        ).to_csv(path, sep="\t", header=False, index=False, mode=mode)
+        for batch in batches:
+            batch.clear()
+
+    mode = "w"
+    n_rows = 0
+    for samples in members.values():
+        index = np.array([sample_index[sample] for sample in samples])
+        dist = rng.uniform(0, threshold, (len(index), len(index)))
+        dist = np.triu(dist, 1)
+        dist = dist + dist.T
+        batches[0].append(np.repeat(index, len(index)))
+        batches[1].append(np.tile(index, len(index)))
+        batches[2].append(dist.ravel())
+        n_rows += len(index) ** 2
+        if n_rows >= batch_rows:
+            flush(mode)
+            mode = "a"
+            n_rows = 0
+    query = np.repeat(np.arange(len(names)), other_pairs)
+    ref = rng.integers(0, len(names), len(query))
+    keep = cluster_of[query] != cluster_of[ref]
+    query, ref = query[keep], ref[keep]
+    dist = rng.uniform(threshold * 3, 0.25, len(query))
+    batches[0].extend([query, ref])
+    batches[1].extend([ref, query])
+    batches[2].extend([dist, dist])
+    flush(mode)
+
+
+def write_newick(path: pathlib.Path, samples: list, rng: np.random.Generator) -> None:
+    """Random binary tree of the samples, made by joining random pairs of subtrees"""
+    subtrees = [
+        f"{sample}:{length:.6f}"
+        for sample, length in zip(samples, rng.exponential(0.001, len(samples)))
+    ]
+    while len(subtrees) > 2:
+        i, j = sorted(rng.choice(len(subtrees), 2, replace=False))
+        joined = f"({subtrees[i]},{subtrees[j]}):{rng.exponential(0.001):.6f}"
+        # Swap with the last subtrees so removing is O(1)
+        subtrees[j] = subtrees[-1]
+        subtrees.pop()
+        subtrees[i] = joined
+    path.write_text(f"({','.join(subtrees)});\n")
+
+
+def write_referenceseeker_results(
+    out_dir: pathlib.Path,
+    clusters: dict,
+    rng: np.random.Generator,
+    hits: int = 20,
+    candidates: int = 30,
+) -> dict:
+    """
+    Writes referenceseeker_{sample}.tab for every sample, with hits drawn from
+    candidate genomes shared by the samples of a cluster. Returns the
+    candidates of every cluster.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    n_clusters = len(set(clusters.values()))
+    pool = [f"GCF_{i:09d}.1" for i in range(max(candidates, n_clusters * 5))]
+    cluster_candidates = {}
+    for sample, cluster in clusters.items():
+        if cluster not in cluster_candidates:
+            cluster_candidates[cluster] = [
+                pool[i] for i in rng.choice(len(pool), candidates, replace=False)
+            ]
+        chosen = rng.choice(candidates, min(hits, candidates), replace=False)
+        mash_distance = np.sort(rng.uniform(0, 0.05, len(chosen)))
+        res = pd.DataFrame(
+            {
+                "#ID": [cluster_candidates[cluster][i] for i in chosen],
+                "Mash Distance": np.round(mash_distance, 5),
+                "ANI": np.round(100 - mash_distance * 100, 2),
+                "Con. DNA": np.round(rng.uniform(69, 100, len(chosen)), 2),
+                "Taxonomy ID": 562,
+                "Assembly Status": "complete",
+                "Organism": "Escherichia coli",
+            },
+            columns=REFERENCESEEKER_COLUMNS,
+        )
+        res.to_csv(
+            out_dir.joinpath(f"referenceseeker_{sample}.tab"), sep="\t", index=False
+        )
+    return cluster_candidates
+
+
+def write_wrapped(file, seq: np.ndarray) -> None:
+    """Writes a sequence (uint8) wrapped at LINE_WIDTH characters per line"""
+    n_lines = len(seq) // LINE_WIDTH
+    lines = np.empty((n_lines, LINE_WIDTH + 1), dtype=np.uint8)
+    lines[:, :LINE_WIDTH] = seq[: n_lines * LINE_WIDTH].reshape(n_lines, LINE_WIDTH)
+    lines[:, LINE_WIDTH] = ord("\n")
+    file.write(lines.tobytes())
+    if len(seq) > n_lines * LINE_WIDTH:
+        file.write(seq[n_lines * LINE_WIDTH :].tobytes() + b"\n")
+
+
+class SimulatedAlignment:
+    """
+    Reference genome (one contig) and the aligned sequences of samples that
+    descend from a few lineages. Every lineage differs from the reference at
+    part of the variable sites and every sample at a few more, and samples
+    have unaligned (-) and low coverage (N) stretches. The sequence of sample
+    i only depends on the seed and i.
+    """
+
+    def __init__(
+        self,
+        length: int,
+        seed: int,
+        snp_rate: float = 0.005,
+        n_lineages: int = 10,
+        private_rate: float = 0.05,
+        gaps: int = 3,
+        max_gap: int = 200,
+    ) -> None:
+        rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.private_rate = private_rate
+        self.gaps = gaps
+        self.max_gap = min(max_gap, length)
+        reference_codes = rng.integers(0, 4, length)
+        self.reference = NUCLEOTIDES[reference_codes]
+        n_sites = max(1, int(length * snp_rate))
+        self.sites = np.sort(rng.choice(length, n_sites, replace=False))
+        self.site_codes = reference_codes[self.sites]
+        mutated = rng.random((n_lineages, n_sites)) < 0.5
+        self.lineage_codes = np.where(
+            mutated,
+            (self.site_codes + rng.integers(1, 4, (n_lineages, n_sites))) % 4,
+            self.site_codes,
+        )
+
+    def lineage(self, i: int) -> int:
+        return i % len(self.lineage_codes)
+
+    def _rng(self, i: int) -> np.random.Generator:
+        return np.random.default_rng([self.seed, i])
+
+    def _site_codes(self, i: int, rng: np.random.Generator) -> np.ndarray:
+        codes = self.lineage_codes[self.lineage(i)]
+        private = rng.random(len(codes)) < self.private_rate
+        return np.where(private, (codes + rng.integers(1, 4, len(codes))) % 4, codes)
+
+    def sequence(self, i: int) -> np.ndarray:
+        rng = self._rng(i)
+        seq = self.reference.copy()
+        seq[self.sites] = NUCLEOTIDES[self._site_codes(i, rng)]
+        for char in [b"-", b"N"]:
+            for _ in range(self.gaps):
+                start = rng.integers(0, len(seq) - self.max_gap + 1)
+                seq[start : start + rng.integers(1, self.max_gap + 1)] = ord(char)
+        return seq
+
+    def snp_matrix(self, n_samples: int) -> np.ndarray:
+        """
+        SNP distances between the first n_samples samples, counted on the
+        variable sites only (the unaligned and low coverage stretches are
+        ignored)
+        """
+        codes = np.array(
+            [self._site_codes(i, self._rng(i)) for i in range(n_samples)],
+            dtype=np.uint8,
+        )
+        # Matching alleles counted as the product of one-hot encodings
+        one_hot = np.zeros((n_samples, codes.shape[1] * 4), dtype=np.float32)
+        one_hot[
+            np.arange(n_samples)[:, None], np.arange(codes.shape[1]) * 4 + codes
+        ] = 1
+        dm = codes.shape[1] - np.rint(one_hot @ one_hot.T).astype(np.int64)
+        return dm
+
+
+def write_reference(path: pathlib.Path, alignment: SimulatedAlignment) -> None:
+    with open(path, "wb") as file:
+        file.write(f">{CONTIG}\n".encode())
+        write_wrapped(file, alignment.reference)
+
+
+def write_snippy_dirs(
+    out_dir: pathlib.Path, alignment: SimulatedAlignment, samples: list
+) -> list:
+    """
+    Output directory of snippy for every sample, with the aligned.fa and a
+    vcf with one record per SNP (the files read by snippy-core)
+    """
+    snippy_dirs = []
+    for i, sample in enumerate(samples):
+        snippy_dir = out_dir.joinpath(sample)
+        snippy_dir.mkdir(parents=True, exist_ok=True)
+        seq = alignment.sequence(i)
+        with open(snippy_dir.joinpath(f"{sample}.aligned.fa"), "wb") as file:
+            file.write(f">{CONTIG}\n".encode())
+            write_wrapped(file, seq)
+        ref_alleles = alignment.reference[alignment.sites]
+        alleles = seq[alignment.sites]
+        snps = np.flatnonzero((alleles != ref_alleles) & np.isin(alleles, NUCLEOTIDES))
+        with open(snippy_dir.joinpath(f"{sample}.vcf"), "w") as file:
+            file.write("##fileformat=VCFv4.2\n")
+            file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t")
+            file.write(f"{sample}\n")
+            for snp in snps:
+                file.write(
+                    f"{CONTIG}\t{alignment.sites[snp] + 1}\t.\t{chr(ref_alleles[snp])}"
+                    f"\t{chr(alleles[snp])}\t1000\t.\tTYPE=snp\tGT\t1/1\n"
+                )
+        snippy_dirs.append(snippy_dir)
+    return snippy_dirs
+
+
+def write_full_alignment(
+    path: pathlib.Path, alignment: SimulatedAlignment, samples: list
+) -> None:
+    """The .full.aln of snippy-core: the reference and every sample, full length"""
+    with open(path, "wb") as file:
+        file.write(b">Reference\n")
+        write_wrapped(file, alignment.reference)
+        for i, sample in enumerate(samples):
+            file.write(f">{sample}\n".encode())
+            write_wrapped(file, alignment.sequence(i))
+
+
+def write_core_tab(
+    path: pathlib.Path, alignment: SimulatedAlignment, samples: list
+) -> None:
+    """The .tab of snippy-core: the allele of every sample at the variable sites"""
+    alleles = np.empty((len(alignment.sites), 2 * len(samples)), dtype=np.uint8)
+    alleles[:, 1::2] = ord("\t")
+    alleles[:, -1] = ord("\n")
+    for i in range(len(samples)):
+        alleles[:, 2 * i] = alignment.sequence(i)[alignment.sites]
+    with open(path, "wb") as file:
+        file.write(("\t".join(["CHR", "POS", "REF"] + samples) + "\n").encode())
+        for site, ref, row in zip(
+            alignment.sites, alignment.reference[alignment.sites], alleles
+        ):
+            file.write(f"{CONTIG}\t{site + 1}\t{chr(ref)}\t".encode() + row.tobytes())
+
+
+def write_snp_matrix(
+    path: pathlib.Path, alignment: SimulatedAlignment, samples: list
+) -> None:
+    """SNP matrix in the csv format of snp-dists, as read by make_tree.py"""
+    dm = alignment.snp_matrix(len(samples))
+    with open(path, "w") as file:
+        file.write(",".join(["snp-dists 0.8.2"] + samples) + "\n")
+        for sample, row in zip(samples, dm):
+            file.write(sample + "," + ",".join(map(str, row.tolist())) + "\n")
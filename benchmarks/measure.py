@@ -0,0 +1,60 @@
+"""
+Runs a command and measures its wall time and peak memory:
+
+    python benchmarks/measure.py LOG_FILE COMMAND [ARGS ...]
+
+prints the seconds, peak resident memory (MB) and exit code. The peak
+memory of a process on Linux includes that of the process it was forked
+from, so the benchmarks run their commands through this small script
+instead of forking them from the (large) benchmark process itself.
+"""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+
+def measure(command: list, log_file: pathlib.Path, cwd: pathlib.Path = None) -> dict:
+    with open(log_file, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    # The process was reaped by os.wait4
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is the peak of the largest process (the command or any of its
+    # child processes), in kilobytes on Linux and in bytes on macOS
+    max_rss_mb = usage.ru_maxrss / 1024
+    if sys.platform == "darwin":
+        max_rss_mb /= 1024
+    return {
+        "seconds": seconds,
+        "max_rss_mb": max_rss_mb,
+        "returncode": process.returncode,
+    }
+
+
+def run_measured(
+    command: list, log_file: pathlib.Path, cwd: pathlib.Path = None
+) -> tuple[float, float, int]:
+    """
+    Runs a command with its output in log_file. Returns the wall time
+    (seconds), the peak resident memory (MB) and the exit code.
+    """
+    res = subprocess.run(
+        [sys.executable, __file__, str(pathlib.Path(log_file).resolve())]
+        + [str(arg) for arg in command],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    res = json.loads(res.stdout)
+    return res["seconds"], res["max_rss_mb"], res["returncode"]
+
+
+if __name__ == "__main__":
+    print(json.dumps(measure(sys.argv[2:], pathlib.Path(sys.argv[1]))))
@@ -0,0 +1,535 @@
+"""
+Benchmarks of the scripts in bin/ and of the DAG build on synthetic inputs
+of a growing number of samples. Every case runs the script as the pipeline
+does and records its wall time and peak memory. The results are stored as
+json, and can be compared with a baseline (e.g. of the previous release):
+
+    python benchmarks/suite.py --samples 100 1000 --output results.json \\
+        --baseline benchmarks/baselines/baseline.json
+
+The exit code is 1 if any case is slower or uses more memory than the
+baseline by more than the tolerance.
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+
+import generators
+import numpy as np
+import yaml
+from dag_build import make_inputs, time_dry_run
+from measure import run_measured
+
+PACKAGE_DIR = pathlib.Path(__file__).resolve().parent.parent
+BIN_DIR = PACKAGE_DIR.joinpath("bin")
+# Differences below these are noise, whatever the ratio to the baseline
+MIN_SECONDS_DIFFERENCE = 0.5
+MIN_RSS_MB_DIFFERENCE = 20
+
+
+class Dataset:
+    """Synthetic inputs for one number of samples, written when first used"""
+
+    def __init__(
+        self,
+        work_dir: pathlib.Path,
+        n_samples: int,
+        seed: int,
+        cluster_size: int,
+        genome_length: int,
+    ) -> None:
+        self.dir = work_dir.joinpath("inputs")
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.n_samples = n_samples
+        self.seed = seed
+        self.cluster_size = cluster_size
+        self.genome_length = genome_length
+        self.samples = generators.sample_names(n_samples)
+
+    def rng(self, name: str) -> np.random.Generator:
+        """Independent random generator per input, so inputs do not depend on each other"""
+        return np.random.default_rng(
+            [self.seed, self.n_samples, zlib.crc32(name.encode())]
+        )
+
+    @functools.cached_property
+    def clusters(self) -> dict:
+        return generators.make_clusters(
+            self.samples, self.cluster_size, self.rng("clusters")
+        )
+
+    @functools.cached_property
+    def clusters_file(self) -> pathlib.Path:
+        path = self.dir.joinpath("clusters.yaml")
+        with open(path, "w") as file:
+            yaml.dump(self.clusters, file, default_flow_style=False)
+        return path
+
+    @functools.cached_property
+    def mash_table(self) -> pathlib.Path:
+        path = self.dir.joinpath("mash_distances.tsv")
+        generators.write_mash_table(path, self.clusters, self.rng("mash"))
+        return path
+
+    @functools.cached_property
+    def newick(self) -> pathlib.Path:
+        path = self.dir.joinpath("tree.newick")
+        generators.write_newick(path, self.samples, self.rng("newick"))
+        return path
+
+    @functools.cached_property
+    def referenceseeker(self) -> tuple[pathlib.Path, dict]:
+        path = self.dir.joinpath("referenceseeker")
+        candidates = generators.write_referenceseeker_results(
+            path, self.clusters, self.rng("referenceseeker")
+        )
+        return path, candidates
+
+    @functools.cached_property
+    def referenceseeker_index(self) -> pathlib.Path:
+        path = self.dir.joinpath("referenceseeker_index.npz")
+        subprocess.run(
+            [
+                sys.executable,
+                BIN_DIR.joinpath("index_referenceseeker.py"),
+                "--input-dir",
+                self.referenceseeker[0],
+                "--output",
+                path,
+            ],
+            check=True,
+            capture_output=True,
+        )
+        return path
+
+    @functools.cached_property
+    def local_genomes(self) -> pathlib.Path:
+        """Genomes of the candidate references, as downloaded from NCBI"""
+        path = self.dir.joinpath("local_genomes")
+        path.mkdir()
+        for candidate in set().union(*self.referenceseeker[1].values()):
+            path.joinpath(f"{candidate}.fna").write_text(f">{candidate}\nACGT\n")
+        return path
+
+    @functools.cached_property
+    def alignment(self) -> generators.SimulatedAlignment:
+        return generators.SimulatedAlignment(self.genome_length, self.seed)
+
+    @functools.cached_property
+    def reference(self) -> pathlib.Path:
+        path = self.dir.joinpath("ref_genome.fasta")
+        generators.write_reference(path, self.alignment)
+        return path
+
+    @functools.cached_property
+    def snippy_dirs(self) -> list:
+        return generators.write_snippy_dirs(
+            self.dir.joinpath("snippy"), self.alignment, self.samples
+        )
+
+    @functools.cached_property
+    def full_alignment(self) -> pathlib.Path:
+        path = self.dir.joinpath("core.full.aln")
+        generators.write_full_alignment(path, self.alignment, self.samples)
+        return path
+
+    @functools.cached_property
+    def packed_alignment(self) -> pathlib.Path:
+        path = self.dir.joinpath("core.full.paln")
+        subprocess.run(
+            script("packed_alignment.py")
+            + ["pack", "--input", str(self.full_alignment), "--output", str(path)],
+            check=True,
+        )
+        return path
+
+    @functools.cached_property
+    def core_tab(self) -> pathlib.Path:
+        path = self.dir.joinpath("core.tab")
+        generators.write_core_tab(path, self.alignment, self.samples)
+        return path
+
+    @functools.cached_property
+    def snp_matrix(self) -> pathlib.Path:
+        path = self.dir.joinpath("snp_matrix.csv")
+        generators.write_snp_matrix(path, self.alignment, self.samples)
+        return path
+
+
+def script(name: str) -> list:
+    return [sys.executable, str(BIN_DIR.joinpath(name))]
+
+
+def case_preclustering(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    return script("preclustering.py") + [
+        "--input",
+        data.mash_table,
+        "--threshold",
+        "0.01",
+        "--output",
+        out_dir.joinpath("clusters.yaml"),
+        "--plot-output",
+        out_dir.joinpath("plots"),
+    ]
+
+
+def case_select_representatives(
+    data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return script("select_representatives.py") + [
+        "--input",
+        data.mash_table,
+        "--clustering-file",
+        data.clusters_file,
+        "--output",
+        out_dir.joinpath("representatives.yaml"),
+    ]
+
+
+def case_index_referenceseeker(
+    data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return script("index_referenceseeker.py") + [
+        "--input-dir",
+        data.referenceseeker[0],
+        "--output",
+        out_dir.joinpath("index.npz"),
+    ]
+
+
+def case_find_best_ref(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    # Cluster 1 is the largest
+    return script("find_best_ref.py") + [
+        "--index",
+        data.referenceseeker_index,
+        "--cluster",
+        "1",
+        "--clustering-file",
+        data.clusters_file,
+        "--output",
+        out_dir,
+        "--local-genomes",
+        data.local_genomes,
+    ]
+
+
+def case_newick2dm(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    return script("newick2dm.py") + [
+        "--input",
+        data.newick,
+        "--output",
+        out_dir.joinpath("distance_matrix.csv"),
+    ]
+
+
+def case_snp_core(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    return (
+        script("snp_core.py")
+        + ["--ref", data.reference, "--threads", str(threads)]
+        + ["--prefix", out_dir.joinpath("core")]
+        + data.snippy_dirs
+    )
+
+
+def analyse_command(
+    alignment: pathlib.Path, data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return script("analyse_core_alignment.py") + [
+        "--input",
+        alignment,
+        "--reference",
+        data.reference,
+        "--const-sites",
+        out_dir.joinpath("const_sites.txt"),
+        "--snp-matrix",
+        out_dir.joinpath("snp_matrix.csv"),
+        "--profile",
+        out_dir.joinpath("grapetree_profile.tab"),
+        "--threads",
+        str(threads),
+    ]
+
+
+def case_analyse_core_alignment(
+    data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return analyse_command(data.full_alignment, data, out_dir, threads)
+
+
+def case_analyse_packed_alignment(
+    data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return analyse_command(data.packed_alignment, data, out_dir, threads)
+
+
+def case_pack_alignment(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    return script("packed_alignment.py") + [
+        "pack",
+        "--input",
+        data.full_alignment,
+        "--output",
+        out_dir.joinpath("core.full.paln"),
+    ]
+
+
+def case_get_profile_for_tree(
+    data: Dataset, out_dir: pathlib.Path, threads: int
+) -> list:
+    return script("get_profile_for_tree.py") + [
+        "--input",
+        data.core_tab,
+        "--output",
+        out_dir.joinpath("profile.tab"),
+    ]
+
+
+def case_make_tree(data: Dataset, out_dir: pathlib.Path, threads: int) -> list:
+    return script("make_tree.py") + [
+        "--input",
+        data.snp_matrix,
+        "--algorithm",
+        "upgma",
+        "--output",
+        out_dir.joinpath("newick_tree.txt"),
+        "--distance-matrix",
+        out_dir.joinpath("distance_matrix.csv"),
+    ]
+
+
+# Cases and the largest number of samples they are run with. The cases on a
+# single alignment or distance matrix of all samples are limited, as their
+# inputs grow with the square of the samples (or with the genome length).
+CASES = {
+    "preclustering": (case_preclustering, 50_000),
+    "select_representatives": (case_select_representatives, 50_000),
+    "index_referenceseeker": (case_index_referenceseeker, 50_000),
+    "find_best_ref": (case_find_best_ref, 50_000),
+    "get_profile_for_tree": (case_get_profile_for_tree, 50_000),
+    "snp_core": (case_snp_core, 10_000),
+    "analyse_core_alignment": (case_analyse_core_alignment, 10_000),
+    "analyse_packed_alignment": (case_analyse_packed_alignment, 10_000),
+    "pack_alignment": (case_pack_alignment, 10_000),
+    "newick2dm": (case_newick2dm, 10_000),
+    "make_tree": (case_make_tree, 10_000),
+    "dag_build": (None, 50_000),
+}
+
+
+def run_case(case: str, data: Dataset, work_dir: pathlib.Path, threads: int) -> dict:
+    result = {"case": case, "samples": data.n_samples}
+    make_command, max_samples = CASES[case]
+    if data.n_samples > max_samples:
+        return {**result, "status": "skipped", "note": f"above {max_samples} samples"}
+    out_dir = work_dir.joinpath(case)
+    out_dir.mkdir(parents=True)
+    if case == "dag_build":
+        make_inputs(out_dir, data.n_samples, data.cluster_size)
+        try:
+            seconds, max_rss_mb, n_jobs = time_dry_run(out_dir)
+        except RuntimeError as error:
+            return {**result, "status": "failed", "note": str(error)[-500:]}
+        return {
+            **result,
+            "status": "ok",
+            "seconds": round(seconds, 3),
+            "max_rss_mb": round(max_rss_mb, 1),
+            "note": f"{n_jobs} jobs",
+        }
+    command = [str(arg) for arg in make_command(data, out_dir, threads)]
+    log_file = work_dir.joinpath(f"{case}.log")
+    seconds, max_rss_mb, returncode = run_measured(command, log_file)
+    if returncode != 0:
+        return {
+            **result,
+            "status": "failed",
+            "note": log_file.read_text()[-500:],
+        }
+    return {
+        **result,
+        "status": "ok",
+        "seconds": round(seconds, 3),
+        "max_rss_mb": round(max_rss_mb, 1),
+    }
+
+
+def machine_info() -> dict:
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=PACKAGE_DIR, capture_output=True, text=True
+    )
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit.stdout.strip() if commit.returncode == 0 else None,
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count()
+        ),
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float) -> bool:
+    """Prints the ratios to the baseline and returns whether any case regressed"""
+    baseline = {
+        (res["case"], res["samples"]): res for res in baseline if res["status"] == "ok"
+    }
+    regressed = False
+    print("case\tsamples\tseconds\ttime_ratio\tmax_rss_mb\trss_ratio\tregression")
+    for res in results:
+        base = baseline.get((res["case"], res["samples"]))
+        if res["status"] != "ok" or base is None:
+            continue
+        time_ratio = res["seconds"] / max(base["seconds"], 1e-3)
+        rss_ratio = res["max_rss_mb"] / max(base["max_rss_mb"], 1e-3)
+        regression = (
+            time_ratio > tolerance
+            and res["seconds"] - base["seconds"] > MIN_SECONDS_DIFFERENCE
+        ) or (
+            rss_ratio > tolerance
+            and res["max_rss_mb"] - base["max_rss_mb"] > MIN_RSS_MB_DIFFERENCE
+        )
+        regressed = regressed or regression
+        print(
+            f"{res['case']}\t{res['samples']}\t{res['seconds']}\t{time_ratio:.2f}"
+            f"\t{res['max_rss_mb']}\t{rss_ratio:.2f}\t{'yes' if regression else ''}"
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the scripts of the pipeline and the DAG build on synthetic data."
+    )
+    parser.add_argument(
+        "-s",
+        "--samples",
+        help="Numbers of samples to benchmark.",
+        metavar="INT",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10_000, 50_000],
+    )
+    parser.add_argument(
+        "--cases",
+        help="Cases to run. Default is all.",
+        choices=list(CASES),
+        nargs="+",
+        default=list(CASES),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output json with the results. Printed if not given.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        help="Results of an earlier run (json) to compare with.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Ratio of time or memory to the baseline above which a case has regressed.",
+        metavar="FLOAT",
+        type=float,
+        default=1.5,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the synthetic data.",
+        metavar="INT",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-c",
+        "--cluster-size",
+        help="Mean number of samples per cluster.",
+        metavar="INT",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "-g",
+        "--genome-length",
+        help="Length of the simulated reference genome and alignments.",
+        metavar="INT",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Threads of the scripts that use more than one.",
+        metavar="INT",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-w",
+        "--work-dir",
+        help="Directory where the inputs and outputs are kept. Default is a temporary directory that is removed.",
+        metavar="DIR",
+        type=pathlib.Path,
+        default=None,
+    )
+    args = parser.parse_args()
+    results = []
+    for n_samples in args.samples:
+        if args.work_dir is None:
+            work_dir = pathlib.Path(tempfile.mkdtemp(prefix="juno_snp_bench_"))
+        else:
+            work_dir = args.work_dir.joinpath(f"{n_samples}_samples")
+            if work_dir.exists():
+                shutil.rmtree(work_dir)
+            work_dir.mkdir(parents=True)
+        data = Dataset(
+            work_dir, n_samples, args.seed, args.cluster_size, args.genome_length
+        )
+        try:
+            for case in args.cases:
+                results.append(run_case(case, data, work_dir, args.threads))
+                print(json.dumps(results[-1]), file=sys.stderr)
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(work_dir)
+    report = {
+        "machine": machine_info(),
+        "settings": {
+            "seed": args.seed,
+            "cluster_size": args.cluster_size,
+            "genome_length": args.genome_length,
+            "threads": args.threads,
+        },
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import pathlib
+
+import numpy as np
+
+from packed_alignment import PackedAlignment, open_alignment
+from snp_dists import (
+    NUCLEOTIDES,
+    POPCOUNT,
+    nucleotide_codes,
+    pack_bit_planes,
+    snp_distances,
+    write_csv,
+)
+
+# Name of the reference sequence in the alignments of snippy-core
+REFERENCE_NAME = "Reference"
+# Maximum size (in bytes) of a block of columns kept in memory
+BLOCK_BYTES = 64 * 1024**2
+
+
+def read_contigs(reference: pathlib.Path) -> list:
+    """Returns the name and length of every contig in a fasta file"""
+    contigs = []
+    with open(reference) as file:
+        for line in file:
+            if line.startswith(">"):
+                contigs.append([line[1:].split()[0], 0])
+            elif len(contigs) > 0:
+                contigs[-1][1] += len(line.strip())
+    return contigs
+
+
+def get_site_labels(columns: np.ndarray, contigs: list = None) -> list:
+    """
+    Names the sites as CHR:POS, like the CHR and POS columns of the core.tab
+    of snippy-core (its alignments are the contigs of the reference pasted
+    one after another). Without contigs, the position in the alignment is used.
+    """
+    if contigs is None:
+        return [str(column + 1) for column in columns]
+    ends = np.cumsum([length for _, length in contigs])
+    starts = ends - np.array([length for _, length in contigs])
+    contig_idx = np.searchsorted(ends, columns, side="right")
+    return [
+        f"{contigs[i][0]}:{column - starts[i] + 1}"
+        for i, column in zip(contig_idx, columns)
+    ]
+
+
+def analyse_alignment(
+    alignment_file: pathlib.Path, block_size: int = None, threads: int = 1
+) -> dict:
+    """
+    Reads the alignment (fasta or packed) once, block of columns by block of
+    columns, and collects everything that is needed downstream:
+      - the counts of A, C, G and T in the constant sites (as snp-sites -C),
+      - the pairwise SNP distances (as snp-dists),
+      - the alleles of every sequence at the core SNP sites (sites where all
+        sequences have a nucleotide and at least two nucleotides are found).
+    """
+    with open_alignment(alignment_file) as alignment:
+        names = alignment.names
+        length = alignment.length
+        if len(names) == 0 or length == 0:
+            raise ValueError(f"No sequences found in {alignment_file}")
+        if block_size is None and isinstance(alignment, PackedAlignment):
+            block_size = alignment.window
+        elif block_size is None:
+            block_size = max(1, BLOCK_BYTES // len(names))
+
+        const_sites = np.zeros(len(NUCLEOTIDES), dtype=np.int64)
+        variable_codes = []
+        core_columns = []
+        core_alleles = []
+        for first in range(0, length, block_size):
+            last = min(first + block_size, length)
+            block = alignment.read_columns(first, last)
+            block = np.where(
+                (block >= ord("a")) & (block <= ord("z")), block - 32, block
+            )
+            codes = nucleotide_codes(block)
+            seen = np.bitwise_or.reduce(codes, axis=0)
+            n_nucleotides = POPCOUNT[seen]
+            for bit in range(len(NUCLEOTIDES)):
+                const_sites[bit] += np.count_nonzero(
+                    seen[n_nucleotides == 1] == 1 << bit
+                )
+            variable = np.flatnonzero(n_nucleotides > 1)
+            variable_codes.append(codes[:, variable])
+            core = variable[(codes[:, variable] > 0).all(axis=0)]
+            core_columns.append(core + first)
+            core_alleles.append(block[:, core])
+
+    variable_codes = np.hstack(variable_codes)
+    print(
+        f"Found {variable_codes.shape[1]} variable positions in {len(names)} sequences"
+    )
+    planes = pack_bit_planes(variable_codes)
+    del variable_codes
+    return {
+        "names": names,
+        "const_sites": const_sites,
+        "snp_matrix": snp_distances(planes, threads),
+        "core_columns": np.concatenate(core_columns),
+        "core_alleles": np.hstack(core_alleles),
+    }
+
+
+def write_const_sites(const_sites: np.ndarray, output_file: pathlib.Path) -> None:
+    """Same format as snp-sites -C, which can be given to iqtree -fconst"""
+    with open(output_file, "w") as file:
+        file.write(",".join(map(str, const_sites.tolist())) + "\n")
+
+
+def write_profile(
+    names: list,
+    core_alleles: np.ndarray,
+    site_labels: list,
+    output_file: pathlib.Path,
+) -> None:
+    """Writes the alleles per sample (one row per sample) for grapetree"""
+    with open(output_file, "w") as file:
+        file.write("\t".join([""] + site_labels) + "\n")
+        for name, alleles in zip(names, core_alleles):
+            if name == REFERENCE_NAME:
+                continue
+            file.write(name + "\t" + "\t".join(alleles.tobytes().decode()) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Get the constant sites, SNP matrix and allele profile of a core alignment in one pass."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="Alignment (fasta or packed), e.g. the .full.paln of snp_core.py.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-c",
+        "--const-sites",
+        help="Output file with the counts of constant sites (snp-sites -C format).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--snp-matrix",
+        help="Output file for the SNP matrix (csv extension).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="Output tab file where the allele profile (for grapetree) will be stored.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-r",
+        "--reference",
+        help="Reference genome (fasta) used for the alignment, to name the sites of the profile.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-b",
+        "--block-size",
+        help="Number of columns read at once. Default is based on the number of sequences.",
+        metavar="INT",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes used to compute the distances.",
+        metavar="INT",
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args()
+    res = analyse_alignment(args.input, args.block_size, args.threads)
+    contigs = None if args.reference is None else read_contigs(args.reference)
+    write_const_sites(res["const_sites"], args.const_sites)
+    write_csv(res["names"], res["snp_matrix"], args.snp_matrix)
+    write_profile(
+        res["names"],
+        res["core_alleles"],
+        get_site_labels(res["core_columns"], contigs),
+        args.profile,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import pathlib
+
+import yaml
+
+# The C implementation of the yaml loader is much faster on large files
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class ClusterIndex:
+    """
+    Samples per cluster as read from a clusters yaml (sample: cluster), e.g.
+    the output of the preclustering checkpoint, and the plan of the clusters
+    (run_manifest.py). Every file is parsed once per modification, so the
+    input functions of the rules (called for every job when the DAG is
+    re-evaluated) do not parse it and scan all samples again.
+    The returned dicts and lists are shared and must not be modified.
+    """
+
+    def __init__(self) -> None:
+        self._cache: dict = {}
+        self._plans: dict = {}
+
+    @staticmethod
+    def _version(path: str) -> tuple:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, clusters_file: pathlib.Path) -> tuple[dict, dict]:
+        clusters_file = str(clusters_file)
+        version = self._version(clusters_file)
+        cached = self._cache.get(clusters_file)
+        if cached is None or cached[0] != version:
+            with open(clusters_file) as file:
+                sample_clusters = yaml.load(file, Loader=YAML_LOADER) or {}
+            cluster_samples = {}
+            for sample, cluster in sample_clusters.items():
+                cluster_samples.setdefault(str(cluster), []).append(sample)
+            cached = (version, sample_clusters, cluster_samples)
+            self._cache[clusters_file] = cached
+        return cached[1], cached[2]
+
+    def sample_clusters(self, clusters_file: pathlib.Path) -> dict:
+        """Cluster of every sample, as in the file"""
+        return self._load(clusters_file)[0]
+
+    def clusters(self, clusters_file: pathlib.Path) -> list:
+        """Names of the clusters (as str), in order of first appearance"""
+        return list(self._load(clusters_file)[1])
+
+    def samples(self, clusters_file: pathlib.Path, cluster) -> list:
+        """Samples of one cluster, in the order of the file"""
+        return self._load(clusters_file)[1].get(str(cluster), [])
+
+    def plan(self, plan_file: pathlib.Path, cluster) -> dict:
+        """Plan of one cluster (status and digest of its members), see run_manifest.py"""
+        plan_file = str(plan_file)
+        version = self._version(plan_file)
+        cached = self._plans.get(plan_file)
+        if cached is None or cached[0] != version:
+            with open(plan_file) as file:
+                plan = yaml.load(file, Loader=YAML_LOADER) or {}
+            clusters = {
+                str(name): entry for name, entry in plan.get("clusters", {}).items()
+            }
+            cached = (version, clusters)
+            self._plans[plan_file] = cached
+        return cached[1][str(cluster)]
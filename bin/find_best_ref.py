@@ -1,14 +1,20 @@
 import argparse
 import pathlib
-import subprocess
+import shutil
 import sys
 import zipfile
 
 import pandas as pd
 import yaml
+from index_referenceseeker import (
+    find_referenceseeker_res,
+    parse_referenceseeker_res,
+    read_index,
+)
 from ncbi.datasets import GenomeApi as DatasetsGenomeApi
 from ncbi.datasets.openapi import ApiClient as DatasetsApiClient
 from ncbi.datasets.openapi import ApiException as DatasetsApiException
+from reference_store import ReferenceStore, fetch_from_directory
 
 
 def read_clusters(yaml_path: pathlib.Path) -> tuple([dict, set]):
@@ -17,47 +23,23 @@ def read_clusters(yaml_path: pathlib.Path) -> tuple([dict, set]):
     return cluster_dict
 
 
-def find_referenceseeker_res(input_dir):
-    input_dir = pathlib.Path(input_dir)
-    return list(input_dir.glob("**/referenceseeker_*.tab"))
+def select_samples_cluster(cluster: int, cluster_dict: dict) -> list:
+    return [
+        sample
+        for sample, _cluster in cluster_dict.items()
+        if str(_cluster) == str(cluster)
+    ]
 
 
-def append_all_referenceseeker_res(file_list):
-    res_referenceseeker = []
-    for file_ in file_list:
-        sample_name = file_.stem.replace("referenceseeker_", "")
-        rows_to_skip = subprocess.check_output(
-            f'grep -n "#ID" {file_} | cut -d : -f 1', shell=True
-        )
-        rows_to_skip = int(rows_to_skip) - 1
-        sample_res = pd.read_csv(
-            file_, skiprows=rows_to_skip, sep="\t", index_col=None, header=0
-        )
-        sample_res = sample_res[["#ID", "ANI", "Mash Distance", "Con. DNA"]]
-        sample_res["Sample"] = sample_name
-        res_referenceseeker.append(sample_res)
-        res = pd.concat(res_referenceseeker)
-    return res
-
-
-def select_files_cluster(file_list: list, cluster: int, cluster_dict: dict) -> list:
-    selected_files = []
-    for sample, _cluster in cluster_dict.items():
-        if str(_cluster) == str(cluster):
-            list_sample_match = [
-                sample_path
-                for sample_path in file_list
-                if f"referenceseeker_{sample}.tab" in str(sample_path)
-            ]
-            assert (
-                len(list_sample_match) == 1
-            ), f"Did not find exactly one Referenceseeker file matching sample {sample}. Exiting"
-            selected_files.append(list_sample_match[0])
-    return selected_files
-
-
-def score_candidates(file_list):
-    df_all = append_all_referenceseeker_res(file_list)
+def check_samples_found(selected_samples: list, found_samples: list) -> None:
+    found_samples = set(found_samples)
+    for sample in selected_samples:
+        assert (
+            sample in found_samples
+        ), f"Did not find exactly one Referenceseeker file matching sample {sample}. Exiting"
+
+
+def score_candidates(df_all):
     candidates = df_all.groupby("#ID")[["ANI", "Mash Distance", "Con. DNA"]].agg(
         ["mean", "size"]
     )
@@ -82,6 +64,11 @@ def get_best_hit(candidates_df):
 
 
 def download_from_ncbi(accession_nr, output_dir):
+    """
+    Downloads the genome data package of an assembly from NCBI and extracts
+    the genomic sequence as ref_genome.seq. The package is streamed to disk
+    instead of being held in memory.
+    """
     output_dir = pathlib.Path(output_dir)
     accessions = [accession_nr]
     zipfile_name = output_dir.joinpath("ncbi_dataset.zip")
@@ -92,19 +79,24 @@ def download_from_ncbi(accession_nr, output_dir):
             print("Begin download of genome data package ...")
             genome_ds_download = genome_api.download_assembly_package(
                 accessions,
-                include_annotation_type=["RNA_FASTA", "PROT_FASTA"],
                 _preload_content=False,
             )
             with open(zipfile_name, "wb") as f:
-                f.write(genome_ds_download.data)
+                shutil.copyfileobj(genome_ds_download, f, length=1024**2)
+            genome_ds_download.release_conn()
             print(f"Download completed -- see {zipfile_name}")
         except DatasetsApiException as e:
             sys.exit(f"Exception when calling download_assembly_package: {e}\n")
     with zipfile.ZipFile(zipfile_name, "r") as zip_ref:
-        zip_ref.extractall(output_dir)
-    for item in output_dir.joinpath("ncbi_dataset", "data").glob("**/*.fna"):
-        item.rename(ref_genome)
-    output_dir.joinpath("README.md").unlink()
+        genomic_fna = [
+            name
+            for name in zip_ref.namelist()
+            if name.startswith("ncbi_dataset/data/") and name.endswith("_genomic.fna")
+        ]
+        if len(genomic_fna) == 0:
+            sys.exit(f"No genomic sequence found in the data package of {accession_nr}")
+        with zip_ref.open(genomic_fna[0]) as src, open(ref_genome, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=1024**2)
     zipfile_name.unlink()
     return ref_genome
 
@@ -122,7 +114,6 @@ def get_user_args():
         "-id",
         "--input-dir",
         metavar="DIR",
-        required=not ("-if" in sys.argv or "--input-files" in sys.argv),
         type=pathlib.Path,
         default=None,
     )
@@ -131,12 +122,46 @@ def get_user_args():
         "--input-files",
         metavar="FILES",
         nargs="+",
-        required=not ("-id" in sys.argv or "--input-dir" in sys.argv),
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-ix",
+        "--index",
+        metavar="DIR",
+        help="Index with the results of referenceseeker for all samples, as made by index_referenceseeker.py",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-rs",
+        "--reference-store",
+        metavar="DIR",
+        help="Directory where downloaded reference genomes are stored and reused",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--reference-store-size",
+        metavar="FLOAT",
+        help="Maximum size (in GB) of the reference store. The least recently used genomes are removed when it is exceeded",
+        type=float,
+        default=20,
+    )
+    parser.add_argument(
+        "--local-genomes",
+        metavar="DIR",
+        help="Take reference genomes from this directory (files named after the accession number) instead of downloading them from NCBI",
         type=pathlib.Path,
         default=None,
     )
     args = parser.parse_args()
-    if args.input_files is None:
+    if (
+        sum(arg is not None for arg in [args.input_dir, args.input_files, args.index])
+        != 1
+    ):
+        parser.error("Exactly one of --input-dir, --input-files or --index is required")
+    if args.input_dir is not None:
         args.input_files = find_referenceseeker_res(args.input_dir)
     return args
 
@@ -144,14 +169,33 @@ def get_user_args():
 def main():
     args = get_user_args()
     cluster_dict = read_clusters(args.clustering_file)
-    list_selected_files = select_files_cluster(
-        args.input_files, args.cluster, cluster_dict
-    )
-    res = score_candidates(list_selected_files)
+    selected_samples = select_samples_cluster(args.cluster, cluster_dict)
+    if args.index is not None:
+        df_cluster, found_samples = read_index(args.index, selected_samples)
+    else:
+        sample_set = set(selected_samples)
+        selected_files = [
+            file_
+            for file_ in args.input_files
+            if file_.stem.replace("referenceseeker_", "") in sample_set
+        ]
+        df_cluster, found_samples = parse_referenceseeker_res(selected_files)
+    check_samples_found(selected_samples, found_samples)
+    res = score_candidates(df_cluster)
     args.output.mkdir(parents=True, exist_ok=True)
     res.to_csv(args.output.joinpath("scores_refseq_candidates.csv"))
     best_hit = get_best_hit(res)
-    download_from_ncbi(best_hit, output_dir=args.output)
+    if args.local_genomes is not None:
+        fetch = fetch_from_directory(args.local_genomes)
+    else:
+        fetch = download_from_ncbi
+    if args.reference_store is not None:
+        store = ReferenceStore(
+            args.reference_store, fetch, max_size_gb=args.reference_store_size
+        )
+        store.get(best_hit, args.output.joinpath("ref_genome.seq"))
+    else:
+        fetch(best_hit, args.output)
 
 
 if __name__ == "__main__":
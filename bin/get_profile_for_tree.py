@@ -1,20 +1,117 @@
 import argparse
 import pathlib
 
+import numpy as np
 import pandas as pd
-from this import d
 
+# Alleles are stored as small integer codes (index in this list). Alleles
+# that are not in the list are added while reading.
+DEFAULT_ALLELES = ["N", "A", "C", "G", "T", "-"]
 
-def make_profile_tab(core_snps_tab: str, output: pathlib.Path = None):
-    if output is not None and not output.suffix == ".tab":
-        raise ValueError(f"The output file must have tab extension")
-    core_snps = pd.read_csv(core_snps_tab, sep="\t", index_col=0)
-    samples = [col for col in core_snps.columns if col not in ["REF", "POS"]]
-    profile = core_snps.loc[:, samples].transpose()
-    profile.columns.name = None
-    if output is not None:
-        profile.to_csv(output, sep="\t")
-    return profile
+
+def count_sites(core_snps_tab: pathlib.Path) -> int:
+    """Number of rows (sites) in core.tab, without the header"""
+    n_lines = 0
+    with open(core_snps_tab, "rb") as file:
+        for block in iter(lambda: file.read(1024**2), b""):
+            n_lines += block.count(b"\n")
+            last = block
+    if n_lines > 0 and not last.endswith(b"\n"):
+        n_lines += 1
+    return max(0, n_lines - 1)
+
+
+def encode_alleles(alleles: np.ndarray, allele_codes: dict) -> np.ndarray:
+    uniques, inverse = np.unique(alleles, return_inverse=True)
+    for allele in uniques:
+        if allele not in allele_codes:
+            allele_codes[allele] = len(allele_codes)
+    if len(allele_codes) > 256:
+        raise ValueError("Too many different alleles to store them as uint8")
+    lookup = np.array([allele_codes[allele] for allele in uniques], dtype=np.uint8)
+    return lookup[inverse].reshape(alleles.shape)
+
+
+def read_profile(
+    core_snps_tab: pathlib.Path, chunksize: int = 10_000
+) -> tuple[list, list, list, np.ndarray]:
+    """
+    Reads core.tab of snippy-core in chunks of sites. Returns the samples, the
+    site names (CHR:POS), the alleles and a (sites x samples) matrix with the
+    code of the allele of every sample at every site.
+    """
+    n_sites = count_sites(core_snps_tab)
+    header = pd.read_csv(core_snps_tab, sep="\t", nrows=0).columns
+    samples = [col for col in header if col not in ["CHR", "POS", "REF"]]
+    allele_codes = {allele: i for i, allele in enumerate(DEFAULT_ALLELES)}
+    codes = np.zeros((n_sites, len(samples)), dtype=np.uint8)
+    sites = []
+    row = 0
+    for chunk in pd.read_csv(
+        core_snps_tab,
+        sep="\t",
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunksize,
+    ):
+        sites.extend((chunk["CHR"] + ":" + chunk["POS"]).tolist())
+        codes[row : row + len(chunk)] = encode_alleles(
+            chunk[samples].to_numpy(), allele_codes
+        )
+        row += len(chunk)
+    return samples, sites, list(allele_codes), codes[:row]
+
+
+def write_profile_tab(
+    samples: list,
+    sites: list,
+    alleles: list,
+    codes: np.ndarray,
+    output: pathlib.Path,
+    block_size: int = 256,
+) -> None:
+    """
+    Writes one row per sample. The matrix is transposed a block of samples at
+    a time so only that block is decoded in memory.
+    """
+    alleles = np.array(alleles, dtype=object)
+    with open(output, "w") as file:
+        file.write("\t".join([""] + sites) + "\n")
+        for first in range(0, len(samples), block_size):
+            block = alleles[codes[:, first : first + block_size].T]
+            for sample, sample_alleles in zip(samples[first:], block):
+                file.write(sample + "\t" + "\t".join(sample_alleles) + "\n")
+
+
+def write_profile_npz(
+    samples: list, sites: list, alleles: list, codes: np.ndarray, output: pathlib.Path
+) -> None:
+    """
+    Stores the profile as (samples x sites) allele codes plus the names of the
+    samples, sites and alleles. The transposed matrix is written in Fortran
+    order, so it is not copied.
+    """
+    np.savez(
+        output,
+        samples=np.array(samples, dtype=str),
+        sites=np.array(sites, dtype=str),
+        alleles=np.array(alleles, dtype=str),
+        profile=codes.T,
+    )
+
+
+def make_profile_tab(
+    core_snps_tab: pathlib.Path, output: pathlib.Path = None, chunksize: int = 10_000
+):
+    output = None if output is None else pathlib.Path(output)
+    if output is not None and output.suffix not in [".tab", ".npz"]:
+        raise ValueError("The output file must have tab or npz extension")
+    samples, sites, alleles, codes = read_profile(core_snps_tab, chunksize)
+    if output is not None and output.suffix == ".npz":
+        write_profile_npz(samples, sites, alleles, codes, output)
+    elif output is not None:
+        write_profile_tab(samples, sites, alleles, codes, output)
+    return samples, sites, alleles, codes
 
 
 def main():
@@ -32,13 +129,20 @@ def main():
     parser.add_argument(
         "-o",
         "--output",
-        help="Output tab file where the profile will be stored.  ",
+        help="Output file where the profile will be stored. Use the tab extension for a table and npz for the binary (compact) format.",
         type=pathlib.Path,
         default=None,
         required=True,
     )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        help="Number of sites read at once.",
+        type=int,
+        default=10_000,
+    )
     args = parser.parse_args()
-    make_profile_tab(args.input, output=args.output)
+    make_profile_tab(args.input, output=args.output, chunksize=args.chunk_size)
 
 
 if __name__ == "__main__":
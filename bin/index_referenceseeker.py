@@ -0,0 +1,156 @@
+import argparse
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+REFERENCESEEKER_COLUMNS = ["#ID", "ANI", "Mash Distance", "Con. DNA"]
+# File of every column in the index
+INDEX_FILES = {
+    "#ID": "id",
+    "ANI": "ani",
+    "Mash Distance": "mash_distance",
+    "Con. DNA": "con_dna",
+    "Sample": "sample",
+}
+
+
+def find_referenceseeker_res(input_dir):
+    input_dir = pathlib.Path(input_dir)
+    return list(input_dir.glob("**/referenceseeker_*.tab"))
+
+
+def parse_referenceseeker_res(file_list) -> tuple[pd.DataFrame, list]:
+    """
+    Parses all referenceseeker outputs in a single pass. Returns one table
+    with the columns of interest plus the sample name, and the list of samples
+    that were parsed (also those without any hit).
+    """
+    columns = {column: [] for column in REFERENCESEEKER_COLUMNS + ["Sample"]}
+    samples = []
+    for file_ in file_list:
+        file_ = pathlib.Path(file_)
+        sample_name = file_.stem.replace("referenceseeker_", "")
+        samples.append(sample_name)
+        with open(file_) as file:
+            col_idx = None
+            for line in file:
+                fields = line.rstrip("\n").split("\t")
+                if col_idx is None:
+                    if fields[0] == "#ID":
+                        col_idx = [fields.index(col) for col in REFERENCESEEKER_COLUMNS]
+                    continue
+                if line.strip() == "":
+                    continue
+                for column, i in zip(REFERENCESEEKER_COLUMNS, col_idx):
+                    columns[column].append(fields[i])
+                columns["Sample"].append(sample_name)
+            if col_idx is None:
+                sys.exit(f"Could not find the header (#ID) in {file_}. Exiting")
+    res = pd.DataFrame(columns)
+    for column in ["ANI", "Mash Distance", "Con. DNA"]:
+        res[column] = res[column].astype(np.float64)
+    return res, samples
+
+
+def write_index(res: pd.DataFrame, samples: list, output: pathlib.Path) -> None:
+    """
+    Stores the parsed results in a directory with one .npy file per column,
+    sorted by sample so that the rows of a sample are contiguous. The sorted
+    samples with hits and the offsets of their rows are stored too, so that
+    read_index() reads only the rows of the requested samples.
+    """
+    output = pathlib.Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    res = res.sort_values("Sample", kind="stable")
+    hit_samples, first_rows = np.unique(
+        res["Sample"].to_numpy(dtype=str), return_index=True
+    )
+    np.save(output.joinpath("samples.npy"), np.array(samples, dtype=str))
+    np.save(output.joinpath("hit_samples.npy"), hit_samples)
+    np.save(
+        output.joinpath("offsets.npy"),
+        np.append(first_rows, len(res)).astype(np.int64),
+    )
+    for column, name in INDEX_FILES.items():
+        np.save(
+            output.joinpath(f"{name}.npy"),
+            res[column].to_numpy(dtype=str if column in ["#ID", "Sample"] else None),
+        )
+
+
+def read_index(
+    index_dir: pathlib.Path, samples: list = None
+) -> tuple[pd.DataFrame, list]:
+    """
+    Reads the results stored by write_index(). If samples is given, only the
+    rows of those samples are read (looked up in the sorted samples with
+    hits) from the memory mapped columns.
+    """
+    index_dir = pathlib.Path(index_dir)
+    indexed_samples = np.load(index_dir.joinpath("samples.npy")).tolist()
+    if samples is None:
+        columns = {
+            column: np.load(index_dir.joinpath(f"{name}.npy"))
+            for column, name in INDEX_FILES.items()
+        }
+        return pd.DataFrame(columns), indexed_samples
+    hit_samples = np.load(index_dir.joinpath("hit_samples.npy"))
+    offsets = np.load(index_dir.joinpath("offsets.npy"))
+    requested = np.unique(np.asarray(samples, dtype=str))
+    positions = np.searchsorted(hit_samples, requested)
+    found = positions < len(hit_samples)
+    found[found] = hit_samples[positions[found]] == requested[found]
+    positions = positions[found]
+    rows = np.concatenate(
+        [np.arange(offsets[i], offsets[i + 1]) for i in positions]
+        + [np.empty(0, dtype=np.int64)]
+    )
+    columns = {
+        column: np.asarray(
+            np.load(index_dir.joinpath(f"{name}.npy"), mmap_mode="r")[rows]
+        )
+        for column, name in INDEX_FILES.items()
+    }
+    return pd.DataFrame(columns), indexed_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect the results of referenceseeker for all samples in one index."
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+        help="Output directory of the index.",
+    )
+    parser.add_argument(
+        "-id",
+        "--input-dir",
+        metavar="DIR",
+        required=not ("-if" in sys.argv or "--input-files" in sys.argv),
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-if",
+        "--input-files",
+        metavar="FILES",
+        nargs="+",
+        required=not ("-id" in sys.argv or "--input-dir" in sys.argv),
+        type=pathlib.Path,
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.input_files is None:
+        args.input_files = find_referenceseeker_res(args.input_dir)
+    res, samples = parse_referenceseeker_res(args.input_files)
+    write_index(res, samples, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from analyse_core_alignment import REFERENCE_NAME
+from newick2dm import dm2file, newick2dm
+
+
+class ActiveMatrix:
+    """
+    Distance matrix of the clusters that are still to be joined. The active
+    clusters are kept in the first rows/columns so all operations work on
+    views, and the nearest neighbour of every row is kept up to date so the
+    closest pair can be found without scanning the whole matrix.
+    """
+
+    def __init__(self, dm: np.ndarray) -> None:
+        self.dm = np.array(dm, dtype=np.float64)
+        self.size = len(self.dm)
+        # Index of the node (leaf or join) stored in every row
+        self.nodes = np.arange(self.size)
+        self.row_min = np.zeros(self.size)
+        self.row_arg = np.zeros(self.size, dtype=np.intp)
+        self.update_row_min(np.arange(self.size))
+
+    def update_row_min(self, rows: np.ndarray) -> None:
+        if len(rows) == 0 or self.size < 2:
+            return
+        block = self.dm[rows, : self.size].copy()
+        block[np.arange(len(rows)), rows] = np.inf
+        self.row_arg[rows] = block.argmin(axis=1)
+        self.row_min[rows] = block[np.arange(len(rows)), self.row_arg[rows]]
+
+    def join(self, i: int, j: int, distances: np.ndarray, node: int) -> None:
+        """
+        Replaces row i by the join of rows i and j (with the given distances to
+        all active rows) and removes row j.
+        """
+        n = self.size
+        stale = np.flatnonzero(
+            (self.row_arg[:n] == i) | (self.row_arg[:n] == j)
+        ).tolist()
+        self.dm[i, :n] = distances
+        self.dm[:n, i] = distances
+        self.dm[i, i] = 0
+        closer = np.flatnonzero(distances < self.row_min[:n])
+        self.row_min[closer] = distances[closer]
+        self.row_arg[closer] = i
+        self.nodes[i] = node
+
+        last = n - 1
+        if j != last:
+            self.dm[j, :n] = self.dm[last, :n]
+            self.dm[:n, j] = self.dm[:n, last]
+            self.dm[j, j] = 0
+            self.nodes[j] = self.nodes[last]
+            self.row_min[j] = self.row_min[last]
+            self.row_arg[j] = self.row_arg[last]
+            self.row_arg[:n][self.row_arg[:n] == last] = j
+            stale = [j if row == last else row for row in stale]
+        self.size -= 1
+        stale = {row for row in stale + [i] if row < self.size}
+        self.update_row_min(np.array(sorted(stale), dtype=np.intp))
+
+
+class Tree:
+    """Nodes of a tree: leaves first, then every join in the order of joining"""
+
+    def __init__(self, names: list) -> None:
+        self.names = list(names)
+        self.children = [[] for _ in names]
+
+    def add_node(self, children: list) -> int:
+        self.children.append(children)
+        return len(self.children) - 1
+
+    def to_newick(self, root: int) -> str:
+        # Iterative, trees of many samples can be very deep
+        parts = []
+        stack = [(root, None)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            node, length = item
+            suffix = "" if length is None else f":{max(0.0, float(length))!r}"
+            if not self.children[node]:
+                parts.append(self.names[node] + suffix)
+                continue
+            parts.append("(")
+            stack.append(")" + suffix)
+            for k, child in enumerate(reversed(self.children[node])):
+                if k > 0:
+                    stack.append(",")
+                stack.append(child)
+        return "".join(parts) + ";"
+
+
+def upgma(names: list, dm: np.ndarray) -> str:
+    tree = Tree(names)
+    if len(names) == 1:
+        return tree.to_newick(0)
+    matrix = ActiveMatrix(dm)
+    sizes = np.ones(len(names))
+    heights = np.zeros(2 * len(names) - 1)
+    while matrix.size > 1:
+        n = matrix.size
+        i = int(matrix.row_min[:n].argmin())
+        i, j = sorted([i, int(matrix.row_arg[i])])
+        node_i, node_j = matrix.nodes[i], matrix.nodes[j]
+        height = matrix.dm[i, j] / 2
+        node = tree.add_node(
+            [
+                (node_i, height - heights[node_i]),
+                (node_j, height - heights[node_j]),
+            ]
+        )
+        heights[node] = height
+        distances = (sizes[i] * matrix.dm[i, :n] + sizes[j] * matrix.dm[j, :n]) / (
+            sizes[i] + sizes[j]
+        )
+        sizes[i] += sizes[j]
+        sizes[j] = sizes[n - 1]
+        matrix.join(i, j, distances, node)
+    return tree.to_newick(matrix.nodes[0])
+
+
+def neighbour_joining(names: list, dm: np.ndarray) -> str:
+    """
+    Neighbour joining. As in RapidNJ, the search for the pair to join is
+    pruned with a lower bound of the Q criterion of every row:
+        Q(i, j) >= (n - 2) * min_j d(i, j) - R(i) - max(R)
+    so only the rows whose bound is below the best Q found so far are scanned.
+    """
+    tree = Tree(names)
+    if len(names) == 1:
+        return tree.to_newick(0)
+    matrix = ActiveMatrix(dm)
+    row_sums = matrix.dm.sum(axis=1)
+    while matrix.size > 2:
+        n = matrix.size
+        dm_active = matrix.dm[:n, :n]
+        sums = row_sums[:n]
+        lower_bounds = (n - 2) * matrix.row_min[:n] - sums - sums.max()
+        first = int(lower_bounds.argmin())
+        q = (n - 2) * dm_active[first] - sums[first] - sums
+        q[first] = np.inf
+        rows = np.flatnonzero(lower_bounds <= q.min() + 1e-9 * (1 + abs(q.min())))
+        q = (n - 2) * dm_active[rows] - sums[rows, np.newaxis] - sums
+        q[np.arange(len(rows)), rows] = np.inf
+        row, j = np.unravel_index(q.argmin(), q.shape)
+        i, j = sorted([int(rows[row]), int(j)])
+
+        dij = dm_active[i, j]
+        length_i = dij / 2 + (sums[i] - sums[j]) / (2 * (n - 2))
+        node = tree.add_node(
+            [(matrix.nodes[i], length_i), (matrix.nodes[j], dij - length_i)]
+        )
+        distances = (dm_active[i] + dm_active[j] - dij) / 2
+        distances[i] = 0
+        distances[j] = 0
+        row_sums[:n] += distances - dm_active[i] - dm_active[j]
+        row_sums[i] = distances.sum()
+        row_sums[j] = row_sums[n - 1]
+        matrix.join(i, j, distances, node)
+
+    # Join the last two nodes
+    node_0, node_1 = matrix.nodes[0], matrix.nodes[1]
+    distance = matrix.dm[0, 1]
+    if tree.children[node_0]:
+        tree.children[node_0].append((node_1, distance))
+        return tree.to_newick(node_0)
+    if tree.children[node_1]:
+        tree.children[node_1].append((node_0, distance))
+        return tree.to_newick(node_1)
+    root = tree.add_node([(node_0, distance / 2), (node_1, distance / 2)])
+    return tree.to_newick(root)
+
+
+ALGORITHMS = {"upgma": upgma, "nj": neighbour_joining}
+
+
+def read_snp_matrix(snp_matrix: pathlib.Path) -> tuple[list, np.ndarray]:
+    """Reads the SNP matrix (snp-dists format) without the reference"""
+    dm = pd.read_csv(snp_matrix, index_col=0)
+    dm = dm.drop(index=REFERENCE_NAME, columns=REFERENCE_NAME, errors="ignore")
+    return dm.index.astype(str).tolist(), dm.to_numpy(dtype=np.float64)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make a tree (newick) and its distance matrix from a SNP matrix."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="SNP matrix (csv) as made by snp-dists.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-a",
+        "--algorithm",
+        help="Algorithm to use for making the tree.",
+        choices=list(ALGORITHMS),
+        default="upgma",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file for the tree (newick).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--distance-matrix",
+        help="Output file for the (patristic) distance matrix of the tree.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    args = parser.parse_args()
+    names, dm = read_snp_matrix(args.input)
+    print(f"Making {args.algorithm} tree of {len(names)} samples...\n")
+    with open(args.output, "w") as file:
+        file.write(ALGORITHMS[args.algorithm](names, dm) + "\n")
+    tree_names, tree_dm = newick2dm(args.output)
+    dm2file(tree_names, tree_dm, args.distance_matrix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+
+import pandas as pd
+from Bio import Phylo
+
+# Minimum number of taxa shared with a cached tree to use it as starting tree
+MIN_SHARED_TAXA = 3
+# Branch length of the taxa grafted in the starting tree (iqtree optimises it)
+GRAFT_BRANCH_LENGTH = 1e-6
+# Fraction of the taxa that may be new since the cached model was selected.
+# With more new taxa ModelFinder is run again (on the grafted starting tree).
+MODEL_REFRESH_FRACTION = 0.2
+
+
+def reference_key(reference: pathlib.Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(reference, "rb") as file:
+        for block in iter(lambda: file.read(1024**2), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_taxa(alignment: pathlib.Path) -> list:
+    with open(alignment) as file:
+        return [line[1:].split()[0] for line in file if line.startswith(">")]
+
+
+def read_cached_taxa(entry: pathlib.Path) -> list:
+    with open(entry.joinpath("taxa.txt")) as file:
+        return file.read().split()
+
+
+def read_model(iqtree_report: pathlib.Path) -> str:
+    """Gets the substitution model from the .iqtree report"""
+    with open(iqtree_report) as file:
+        for line in file:
+            if line.startswith("Best-fit model according to") or line.startswith(
+                "Model of substitution:"
+            ):
+                return line.split(":", 1)[1].strip()
+    raise ValueError(f"Could not find the substitution model in {iqtree_report}")
+
+
+def find_cached_tree(cache_dir: pathlib.Path, taxa: list) -> pathlib.Path:
+    """
+    Returns the cached entry (for the same reference) that shares most taxa
+    with the current alignment, or None if none shares enough taxa.
+    """
+    best_entry, best_shared = None, MIN_SHARED_TAXA - 1
+    if not cache_dir.exists():
+        return None
+    for entry in sorted(cache_dir.iterdir()):
+        if not entry.joinpath("complete").exists():
+            continue
+        shared = len(set(taxa) & set(read_cached_taxa(entry)))
+        if shared > best_shared:
+            best_entry, best_shared = entry, shared
+    return best_entry
+
+
+def graft_taxa(tree, taxa: list, snp_matrix: pd.DataFrame) -> None:
+    """
+    Removes the taxa that are not in the alignment anymore and adds every new
+    taxon as sibling of its closest taxon (by SNP distance) in the tree.
+    """
+    in_tree = [leaf.name for leaf in tree.get_terminals()]
+    for name in set(in_tree) - set(taxa):
+        tree.prune(name)
+    in_tree = [name for name in in_tree if name in taxa]
+    for name in [taxon for taxon in taxa if taxon not in in_tree]:
+        closest = snp_matrix.loc[name, in_tree].idxmin()
+        leaf = next(tree.find_clades(name=closest))
+        leaf.split(n=2, branch_length=GRAFT_BRANCH_LENGTH)
+        leaf.clades[0].name, leaf.clades[1].name = closest, name
+        leaf.name = None
+        in_tree.append(name)
+
+
+def prepare(
+    cache_root: pathlib.Path,
+    reference: pathlib.Path,
+    alignment: pathlib.Path,
+    snp_matrix: pathlib.Path,
+    output_dir: pathlib.Path,
+) -> None:
+    """
+    Writes model.txt and start_tree.nwk in output_dir if a tree of a previous
+    run with the same reference can be reused. Otherwise output_dir is empty.
+    The model is left out if more than MODEL_REFRESH_FRACTION of the taxa
+    are new, so that ModelFinder selects it again for the larger taxa set.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = cache_root.joinpath(reference_key(reference))
+    taxa = read_taxa(alignment)
+    entry = find_cached_tree(cache_dir, taxa)
+    if entry is None:
+        print(f"No cached tree found in {cache_dir}, the tree is made from scratch")
+        return
+    print(f"Using the model and tree of {entry} as starting point")
+    tree = Phylo.read(entry.joinpath("tree.nwk"), "newick")
+    graft_taxa(tree, taxa, pd.read_csv(snp_matrix, index_col=0))
+    Phylo.write(tree, output_dir.joinpath("start_tree.nwk"), "newick")
+    new_taxa = len(set(taxa) - set(read_cached_taxa(entry)))
+    if new_taxa > MODEL_REFRESH_FRACTION * len(taxa):
+        print(f"{new_taxa} of {len(taxa)} taxa are new, the model is selected again")
+    else:
+        shutil.copyfile(entry.joinpath("model.txt"), output_dir.joinpath("model.txt"))
+    entry.joinpath("last_used").touch()
+
+
+def store(
+    cache_root: pathlib.Path,
+    reference: pathlib.Path,
+    alignment: pathlib.Path,
+    iqtree_prefix: str,
+) -> None:
+    """
+    Stores the model and tree of this run. Cached trees of which all taxa are
+    in the new tree are removed, as the new tree replaces them.
+    """
+    treefile = pathlib.Path(f"{iqtree_prefix}.treefile")
+    if not treefile.exists():
+        print(f"No tree found ({treefile}), nothing to store")
+        return
+    cache_dir = cache_root.joinpath(reference_key(reference))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    taxa = read_taxa(alignment)
+    entry_name = hashlib.sha256("\n".join(sorted(taxa)).encode()).hexdigest()[:16]
+    for entry in cache_dir.iterdir():
+        if not entry.joinpath("complete").exists() or entry.name == entry_name:
+            continue
+        if set(read_cached_taxa(entry)).issubset(taxa):
+            shutil.rmtree(entry, ignore_errors=True)
+
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_"))
+    shutil.copyfile(treefile, tmp_dir.joinpath("tree.nwk"))
+    with open(tmp_dir.joinpath("model.txt"), "w") as file:
+        file.write(read_model(pathlib.Path(f"{iqtree_prefix}.iqtree")) + "\n")
+    with open(tmp_dir.joinpath("taxa.txt"), "w") as file:
+        file.writelines(f"{taxon}\n" for taxon in taxa)
+    tmp_dir.joinpath("complete").touch()
+    tmp_dir.joinpath("last_used").touch()
+    entry = cache_dir.joinpath(entry_name)
+    if entry.exists():
+        shutil.rmtree(entry)
+    os.replace(tmp_dir, entry)
+    print(f"Stored model and tree in {entry}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reuse the substitution model and tree of iqtree between runs."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in ["prepare", "store"]:
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument(
+            "-c",
+            "--cache",
+            help="Directory where the models and trees are stored.",
+            metavar="DIR",
+            type=pathlib.Path,
+            required=True,
+        )
+        subparser.add_argument(
+            "-r",
+            "--reference",
+            help="Reference genome of the cluster. Trees are only reused for the same reference.",
+            metavar="FILE",
+            type=pathlib.Path,
+            required=True,
+        )
+        subparser.add_argument(
+            "-a",
+            "--alignment",
+            help="Alignment given to iqtree.",
+            metavar="FILE",
+            type=pathlib.Path,
+            required=True,
+        )
+    subparsers.choices["prepare"].add_argument(
+        "-m",
+        "--snp-matrix",
+        help="SNP matrix of the alignment, used to place new taxa in the starting tree.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    subparsers.choices["prepare"].add_argument(
+        "-o",
+        "--output-dir",
+        help="Directory where the model and starting tree are written.",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+    )
+    subparsers.choices["store"].add_argument(
+        "-p",
+        "--prefix",
+        help="Prefix of the output files of iqtree.",
+        metavar="PREFIX",
+        required=True,
+    )
+    args = parser.parse_args()
+    if args.command == "prepare":
+        prepare(
+            args.cache, args.reference, args.alignment, args.snp_matrix, args.output_dir
+        )
+    else:
+        store(args.cache, args.reference, args.alignment, args.prefix)
+
+
+if __name__ == "__main__":
+    main()
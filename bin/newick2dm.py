@@ -1,34 +1,84 @@
 import argparse
-import itertools
+import pathlib
 
-import pandas as pd
+import numpy as np
 from Bio import Phylo
 
 # Modified from https://gist.github.com/mgalardini/1dbd33a6250241658d35ec279b9b6a79
 
 
 def newick2dm(newick_file):
-    """Converts a newick file to a matrix. Returns a distance matrix (dictionary)"""
+    """Converts a newick file to a matrix. Returns the leaf names and the
+    patristic distance matrix (numpy array) in the same order.
+
+    The tree is traversed only once: the distance between two leaves is
+    depth(a) + depth(b) - 2 * depth(lca(a, b)), and every pair of leaves is
+    filled in exactly once, at the node where their lineages meet."""
     print(f"Reading Newick file {newick_file}...\n")
     tree = Phylo.read(newick_file, "newick")
-    dm = {}
     print("Converting newick format to distance matrix...\n")
-    for x, y in itertools.combinations(tree.get_terminals(), 2):
-        pair_dist = tree.distance(x, y)
-        dm[x.name] = dm.get(x.name, {})
-        dm[x.name][y.name] = pair_dist
-        dm[y.name] = dm.get(y.name, {})
-        dm[y.name][x.name] = pair_dist
-    for x in tree.get_terminals():
-        dm[x.name][x.name] = 0
-    return dm
-
-
-def dm2file(dm, output_file):
-    """Converts a distance matrix (as a dictionary) into a csv file"""
+    # Pre-order pass (iterative to support deep, caterpillar-like trees, for
+    # which the recursive traversals of Bio.Phylo fail)
+    clade_depths = {}
+    preorder = []
+    stack = [(tree.root, 0.0)]
+    while stack:
+        clade, depth = stack.pop()
+        clade_depths[id(clade)] = depth
+        preorder.append(clade)
+        for child in reversed(clade.clades):
+            stack.append((child, depth + (child.branch_length or 0.0)))
+
+    # Leaves in the same order as tree.get_terminals()
+    terminals = [clade for clade in preorder if clade.is_terminal()]
+    names = [terminal.name for terminal in terminals]
+    leaf_index = {id(terminal): i for i, terminal in enumerate(terminals)}
+    leaf_depths = np.zeros(len(terminals), dtype=np.float64)
+    dm = np.zeros((len(terminals), len(terminals)), dtype=np.float64)
+
+    # Post-order pass: fill the block of pairs whose lowest common ancestor
+    # is the current clade
+    leaves_below = {}
+    for clade in reversed(preorder):
+        if clade.is_terminal():
+            i = leaf_index[id(clade)]
+            leaf_depths[i] = clade_depths[id(clade)]
+            leaves_below[id(clade)] = np.array([i], dtype=np.intp)
+            continue
+        lca_depth = clade_depths[id(clade)]
+        seen = np.empty(0, dtype=np.intp)
+        for child in clade.clades:
+            child_leaves = leaves_below.pop(id(child))
+            if seen.size > 0:
+                block = (
+                    leaf_depths[seen][:, None]
+                    + leaf_depths[child_leaves][None, :]
+                    - 2 * lca_depth
+                )
+                dm[np.ix_(seen, child_leaves)] = block
+                dm[np.ix_(child_leaves, seen)] = block.T
+            seen = np.concatenate([seen, child_leaves])
+        leaves_below[id(clade)] = seen
+    return names, dm
+
+
+def dm2file(names, dm, output_file):
+    """Writes a distance matrix to a tab separated file, one row at a time"""
     print("Writing distance matrix to a csv file...\n")
-    df = pd.DataFrame(dm)
-    df.to_csv(output_file, sep="\t")
+    with open(output_file, "w") as file:
+        file.write("\t" + "\t".join(names) + "\n")
+        for name, row in zip(names, dm):
+            file.write(name + "\t" + "\t".join(map(repr, row.tolist())) + "\n")
+
+
+def dm2npy(names, dm, output_file):
+    """Writes a distance matrix to a binary numpy file. The leaf names are
+    stored next to it (one per line) in a file with the .labels.txt suffix"""
+    output_file = pathlib.Path(output_file)
+    print(f"Writing distance matrix to binary file {output_file}...\n")
+    np.save(output_file, dm)
+    with open(output_file.with_suffix(".labels.txt"), "w") as file:
+        file.writelines(f"{name}\n" for name in names)
 
 
 def main():
@@ -49,9 +99,19 @@ def main():
         metavar="FILE",
         required=True,
     )
+    parser.add_argument(
+        "-b",
+        "--binary-output",
+        help="Optional output file (npy extension) to also store the matrix in binary format.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
     args = parser.parse_args()
-    dm = newick2dm(args.input)
-    dm2file(dm, args.output)
+    names, dm = newick2dm(args.input)
+    dm2file(names, dm, args.output)
+    if args.binary_output is not None:
+        dm2npy(names, dm, args.binary_output)
 
 
 if __name__ == "__main__":
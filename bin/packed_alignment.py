@@ -0,0 +1,385 @@
+"""
+Packed alignment (.paln): an alignment of sequences of the same length in a
+fraction of the size of the fasta, of which any window of columns can be
+read without reading the rest of the file. The file consists of
+
+    MAGIC, size of the header (uint64), header (json)
+    window 0, window 1, ...
+    offset and size of every window (uint64), offset of this index (uint64), MAGIC
+
+The header has the names of the sequences, their length and the number of
+columns per window. A window is compressed on its own and holds every base
+(A, C, G or T) in 2 bits and all other characters (gaps, N, X, ...) as runs
+of the same character, per sequence. The 2-bit bases of the sequences are
+stored XOR those of the first sequence (the reference of snippy-core), so
+the compression mostly sees zeros for sequences that are alike.
+
+    python bin/packed_alignment.py pack -i core.full.aln -o core.full.paln
+    python bin/packed_alignment.py unpack -i core.full.paln -o core.full.aln
+"""
+
+import argparse
+import json
+import mmap
+import os
+import pathlib
+import struct
+import zlib
+
+import numpy as np
+
+from snp_dists import SequenceLayout, index_fasta, is_nucleotide, read_columns
+
+MAGIC = b"JSNPALN\x01"
+FORMAT_VERSION = 1
+# Fast compression: the 2-bit bases XOR the reference are mostly zeros anyway
+COMPRESSION_LEVEL = 1
+# Maximum size (in bytes) of a window of columns of all sequences
+WINDOW_BYTES = 16 * 1024**2
+# Line width of the fasta written (as snippy-core)
+LINE_WIDTH = 60
+# Bits 1 and 2 of the ASCII codes of A, C, T and G are 0, 1, 2 and 3, which
+# are used as their 2-bit codes
+BASES = np.frombuffer(b"ACTG", dtype=np.uint8)
+# Bases of the four 2-bit codes in a byte (first base in the highest bits)
+UNPACKED = BASES[(np.arange(256)[:, np.newaxis] >> np.array([6, 4, 2, 0])) & 3]
+
+
+class FastaLayout:
+    """Byte layout of the fasta written for the alignment, wrapped at LINE_WIDTH"""
+
+    def __init__(self, names: list, length: int) -> None:
+        self.length = length
+        seq_bytes = length + -(-length // LINE_WIDTH)
+        self.starts = []
+        offset = 0
+        for name in names:
+            offset += len(name) + 2
+            self.starts.append(offset)
+            offset += seq_bytes
+        self.size = offset
+
+    def write_headers(self, fd: int, names: list) -> None:
+        for name, start in zip(names, self.starts):
+            header = f">{name}\n".encode()
+            os.pwrite(fd, header, start - len(header))
+
+
+def wrap(seq: np.ndarray, is_end: bool) -> bytes:
+    """Adds the newlines to a part of a sequence that starts at a line start"""
+    n_lines = len(seq) // LINE_WIDTH
+    lines = np.empty((n_lines, LINE_WIDTH + 1), dtype=np.uint8)
+    lines[:, :LINE_WIDTH] = seq[: n_lines * LINE_WIDTH].reshape(n_lines, LINE_WIDTH)
+    lines[:, LINE_WIDTH] = ord("\n")
+    wrapped = lines.tobytes()
+    if len(seq) > n_lines * LINE_WIDTH:
+        wrapped += seq[n_lines * LINE_WIDTH :].tobytes()
+        if is_end:
+            wrapped += b"\n"
+    return wrapped
+
+
+def window_size(n_sequences: int) -> int:
+    """Columns per window, a multiple of LINE_WIDTH of about WINDOW_BYTES"""
+    return max(
+        LINE_WIDTH, WINDOW_BYTES // max(1, n_sequences) // LINE_WIDTH * LINE_WIDTH
+    )
+
+
+def encode_window(block: np.ndarray) -> bytes:
+    """Compressed window of a (n_sequences, n_columns) block of characters"""
+    n_sequences, width = block.shape
+    other = ~is_nucleotide(block)
+    codes = np.zeros((n_sequences, -(-width // 4) * 4), dtype=np.uint8)
+    codes[:, :width] = block
+    codes >>= 1
+    codes &= 3
+    # Other characters get the code of the first sequence, so they are 0 after
+    # the XOR (they are written as runs)
+    np.copyto(codes[1:, :width], codes[0, :width], where=other[1:])
+    # Four codes (bytes) at once, the first in the highest bits
+    codes = codes.view("<u4")
+    packed = (codes << 6 | codes >> 4 | codes >> 14 | codes >> 24).astype(np.uint8)
+    packed[1:] ^= packed[0]
+
+    # Runs of the same character (other than a base) within a sequence
+    chars = block.reshape(-1)
+    other = other.reshape(-1)
+    is_start = other.copy()
+    is_start[1:] &= chars[1:] != chars[:-1]
+    is_start[::width] = other[::width]
+    is_end = other.copy()
+    is_end[:-1] &= chars[:-1] != chars[1:]
+    is_end[width - 1 :: width] = other[width - 1 :: width]
+    starts = np.flatnonzero(is_start)
+    lengths = np.flatnonzero(is_end) + 1 - starts
+    n_runs = np.bincount(starts // width, minlength=n_sequences)
+    return zlib.compress(
+        packed.tobytes()
+        + n_runs.astype("<u4").tobytes()
+        + (starts % width).astype("<u4").tobytes()
+        + lengths.astype("<u4").tobytes()
+        + chars[starts].tobytes(),
+        COMPRESSION_LEVEL,
+    )
+
+
+def decode_window(data: bytes, n_sequences: int, width: int) -> np.ndarray:
+    """Block of characters of a window written by encode_window()"""
+    raw = zlib.decompress(data)
+    n_bytes = -(-width // 4)
+    packed = np.frombuffer(raw, dtype=np.uint8, count=n_sequences * n_bytes)
+    packed = packed.reshape(n_sequences, n_bytes).copy()
+    packed[1:] ^= packed[0]
+    block = UNPACKED[packed].reshape(n_sequences, n_bytes * 4)[:, :width].copy()
+
+    offset = n_sequences * n_bytes
+    n_runs = np.frombuffer(raw, dtype="<u4", count=n_sequences, offset=offset)
+    offset += 4 * n_sequences
+    total = int(n_runs.sum())
+    starts = np.frombuffer(raw, dtype="<u4", count=total, offset=offset)
+    lengths = np.frombuffer(raw, dtype="<u4", count=total, offset=offset + 4 * total)
+    chars = np.frombuffer(raw, dtype=np.uint8, count=total, offset=offset + 8 * total)
+    starts = starts + np.repeat(np.arange(n_sequences, dtype=np.int64) * width, n_runs)
+    lengths = lengths.astype(np.int64)
+    # Position of every character of the runs in the block
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    block.reshape(-1)[np.arange(len(shift)) + shift] = np.repeat(chars, lengths)
+    return block
+
+
+class PackedAlignmentWriter:
+    """Writes the windows of a packed alignment, in order"""
+
+    def __init__(self, path: pathlib.Path, names: list, length: int, window: int):
+        self.n_windows = -(-length // window)
+        self.index = []
+        self.file = open(path, "wb")
+        header = json.dumps(
+            {
+                "format_version": FORMAT_VERSION,
+                "compression": "zlib",
+                "names": names,
+                "length": length,
+                "window": window,
+            }
+        ).encode()
+        self.file.write(MAGIC + struct.pack("<Q", len(header)) + header)
+
+    def add_window(self, data: bytes) -> None:
+        """Adds a window compressed by encode_window()"""
+        self.index.append((self.file.tell(), len(data)))
+        self.file.write(data)
+
+    def close(self) -> None:
+        if len(self.index) != self.n_windows:
+            self.file.close()
+            raise ValueError(
+                f"Packed alignment has {len(self.index)} of {self.n_windows} windows"
+            )
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype="<u8").tobytes())
+        self.file.write(struct.pack("<Q", index_offset) + MAGIC)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class PackedAlignment:
+    """
+    Memory-mapped reader of a packed alignment. The names and length of the
+    sequences come from the header; windows are decompressed when read.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(MAGIC)] != MAGIC or self._mmap[-len(MAGIC) :] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a (complete) packed alignment")
+        (header_size,) = struct.unpack_from("<Q", self._mmap, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self._mmap[start : start + header_size])
+        if header["format_version"] > FORMAT_VERSION:
+            self._mmap.close()
+            raise ValueError(
+                f"{path} has format version {header['format_version']}, "
+                f"only version {FORMAT_VERSION} and older can be read"
+            )
+        self.names = header["names"]
+        self.length = header["length"]
+        self.window = header["window"]
+        self.n_windows = -(-self.length // self.window)
+        (index_offset,) = struct.unpack_from(
+            "<Q", self._mmap, len(self._mmap) - len(MAGIC) - 8
+        )
+        self._index = np.frombuffer(
+            self._mmap[index_offset : index_offset + 16 * self.n_windows],
+            dtype="<u8",
+        ).reshape(self.n_windows, 2)
+
+    def read_window(self, i: int) -> np.ndarray:
+        """Block of characters (n_sequences, n_columns) of window i"""
+        offset, size = (int(value) for value in self._index[i])
+        width = min(self.window, self.length - i * self.window)
+        return decode_window(self._mmap[offset : offset + size], len(self.names), width)
+
+    def read_columns(self, first: int, last: int) -> np.ndarray:
+        """Block of characters of columns first to last (exclusive)"""
+        windows = range(first // self.window, -(-last // self.window))
+        block = np.hstack(
+            [self.read_window(i) for i in windows]
+            or [np.empty((len(self.names), 0), dtype=np.uint8)]
+        )
+        start = windows.start * self.window
+        return block[:, first - start : last - start]
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class FastaAlignment:
+    """Reader of an alignment (fasta) with the same methods as PackedAlignment"""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = index_fasta(self._mmap)
+        self.names = [name for name, _, _ in records]
+        self._layouts = [
+            SequenceLayout(self._mmap, start, end) for _, start, end in records
+        ]
+        self.length = max([layout.length for layout in self._layouts], default=0)
+        if any(layout.length != self.length for layout in self._layouts):
+            self._mmap.close()
+            raise ValueError("Sequences in the alignment do not have the same length")
+
+    def read_columns(self, first: int, last: int) -> np.ndarray:
+        """Block of characters of columns first to last (exclusive)"""
+        if last <= first:
+            return np.empty((len(self.names), 0), dtype=np.uint8)
+        return np.vstack(
+            [
+                read_columns(self._mmap, layout, first, last, upper=False)
+                for layout in self._layouts
+            ]
+        )
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def is_packed(path: pathlib.Path) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def open_alignment(path: pathlib.Path):
+    """Reader of a packed alignment or of a fasta alignment"""
+    if is_packed(path):
+        return PackedAlignment(path)
+    return FastaAlignment(path)
+
+
+def pack(fasta: pathlib.Path, output: pathlib.Path, window: int = None) -> None:
+    with FastaAlignment(fasta) as alignment:
+        if window is None:
+            window = window_size(len(alignment.names))
+        with PackedAlignmentWriter(
+            output, alignment.names, alignment.length, window
+        ) as writer:
+            for first in range(0, alignment.length, window):
+                last = min(first + window, alignment.length)
+                writer.add_window(encode_window(alignment.read_columns(first, last)))
+
+
+def unpack(packed: pathlib.Path, output: pathlib.Path) -> None:
+    with PackedAlignment(packed) as alignment:
+        fasta_layout = FastaLayout(alignment.names, alignment.length)
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, fasta_layout.size)
+            fasta_layout.write_headers(fd, alignment.names)
+            # Parts of the sequences that start at a line start
+            step = max(LINE_WIDTH, alignment.window // LINE_WIDTH * LINE_WIDTH)
+            for first in range(0, alignment.length, step):
+                last = min(first + step, alignment.length)
+                block = alignment.read_columns(first, last)
+                for row, start in zip(block, fasta_layout.starts):
+                    offset = start + first + first // LINE_WIDTH
+                    os.pwrite(fd, wrap(row, last == alignment.length), offset)
+        finally:
+            os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert alignments between fasta and the packed format (.paln)."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, description in [
+        ("pack", "Pack a fasta alignment."),
+        ("unpack", "Write a packed alignment as fasta."),
+        ("info", "Print the number of sequences, length and windows."),
+    ]:
+        subparser = subparsers.add_parser(command, help=description)
+        subparser.add_argument(
+            "-i",
+            "--input",
+            help="Input alignment.",
+            metavar="FILE",
+            type=pathlib.Path,
+            required=True,
+        )
+        if command != "info":
+            subparser.add_argument(
+                "-o",
+                "--output",
+                help="Output alignment.",
+                metavar="FILE",
+                type=pathlib.Path,
+                required=True,
+            )
+    subparsers.choices["pack"].add_argument(
+        "-w",
+        "--window",
+        help="Number of columns per window. Default is based on the number of sequences.",
+        metavar="INT",
+        type=int,
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.command == "pack":
+        pack(args.input, args.output, args.window)
+    elif args.command == "unpack":
+        unpack(args.input, args.output)
+    else:
+        with PackedAlignment(args.input) as alignment:
+            print(f"sequences\t{len(alignment.names)}")
+            print(f"length\t{alignment.length}")
+            print(f"windows\t{alignment.n_windows} of {alignment.window} columns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Persisted state of incremental preclustering. A state is a directory with
+the pre-clusters (sample -> component, with the k-mer length and sketch size
+of the sketches), one mash sketch per sample, the list of those samples and
+their sketches pasted into one file for mash dist. Every run writes a new
+state directory next to the current one and then points the "current" link
+to it, so an interrupted update leaves the previous state intact.
+"""
+
+import pathlib
+import shutil
+import tempfile
+
+import yaml
+
+STATE_FILE = "precluster_state.yaml"
+SKETCH_DIR = "sketches"
+SKETCHED_SAMPLES = "sketched_samples.txt"
+SKETCH_LIST = "sketch_list.txt"
+MERGED_SKETCHES = "mash_sketches.msh"
+
+
+def read_state(
+    state_path: pathlib.Path, kmer_length: int = None, sketch_size: int = None
+) -> dict:
+    """
+    Pre-clusters (sample -> component) of a preclustering state. If the
+    k-mer length and sketch size are given, a state made with other settings
+    (or by a version that did not store them) is ignored, as its sketches
+    can not be compared with the new ones: the run is then a full run.
+    """
+    if state_path is None or not pathlib.Path(state_path).exists():
+        return {}
+    with open(state_path) as file:
+        state = yaml.safe_load(file) or {}
+    if kmer_length is not None and (
+        state.get("kmer_length"),
+        state.get("sketch_size"),
+    ) != (int(kmer_length), int(sketch_size)):
+        return {}
+    return state.get("components") or {}
+
+
+def save_state(
+    components: dict, outpath: pathlib.Path, kmer_length: int, sketch_size: int
+) -> None:
+    state = {
+        "kmer_length": int(kmer_length),
+        "sketch_size": int(sketch_size),
+        "components": components,
+    }
+    with open(outpath, "w") as file:
+        yaml.dump(state, file, default_flow_style=False, sort_keys=False)
+
+
+def broken_components(components: dict, samples: set) -> set:
+    """
+    Components of a preclustering state with samples that are not in the
+    current run. Such a component may only have been connected through the
+    samples that left, so its other members have to be clustered again.
+    """
+    return {
+        component for sample, component in components.items() if sample not in samples
+    }
+
+
+def known_samples(state: pathlib.Path, kmer_length: int, sketch_size: int) -> dict:
+    """
+    Samples of a state directory (sample -> component) whose sketch is
+    stored in it with the given k-mer length and sketch size.
+    """
+    state = pathlib.Path(state)
+    sketched_path = state.joinpath(SKETCHED_SAMPLES)
+    if not sketched_path.exists():
+        return {}
+    components = read_state(state.joinpath(STATE_FILE), kmer_length, sketch_size)
+    with open(sketched_path) as file:
+        sketched = {line.strip() for line in file}
+    return {
+        sample: component
+        for sample, component in components.items()
+        if sample in sketched
+    }
+
+
+def samples_to_sketch(samples, known: dict) -> list:
+    """
+    Samples of the run that are sketched and compared again: those that are
+    not known and the members of pre-clusters that lost samples.
+    """
+    broken = broken_components(known, set(samples))
+    return [
+        sample for sample in samples if sample not in known or known[sample] in broken
+    ]
+
+
+def prepare_state(
+    state_dir: pathlib.Path,
+    previous: pathlib.Path,
+    state_file: pathlib.Path,
+    new_sketches: dict,
+    samples,
+) -> pathlib.Path:
+    """
+    Writes a new state directory in state_dir with the pre-clusters of this
+    run and one sketch per sample of this run: the sketch made in this run
+    (new_sketches, sample -> sketch) or else the one in the previous state.
+    Samples that are no longer in the run are left out, so the state never
+    holds a sample twice and does not grow with samples that left. Returns
+    the directory; the sketches listed in it still have to be pasted into
+    MERGED_SKETCHES before the directory is made current.
+    """
+    state_dir = pathlib.Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    new_state = pathlib.Path(tempfile.mkdtemp(prefix="state_", dir=state_dir))
+    sketch_dir = new_state.joinpath(SKETCH_DIR)
+    sketch_dir.mkdir()
+    sketched = []
+    for sample in dict.fromkeys(samples):
+        sketch = new_sketches.get(sample)
+        if sketch is None:
+            sketch = pathlib.Path(previous).joinpath(SKETCH_DIR, f"{sample}.msh")
+        shutil.copyfile(sketch, sketch_dir.joinpath(f"{sample}.msh"))
+        sketched.append(sample)
+    with open(new_state.joinpath(SKETCH_LIST), "w") as file:
+        file.writelines(
+            f"{sketch_dir.joinpath(sample + '.msh').resolve()}\n" for sample in sketched
+        )
+    with open(new_state.joinpath(SKETCHED_SAMPLES), "w") as file:
+        file.writelines(f"{sample}\n" for sample in sketched)
+    shutil.copyfile(state_file, new_state.joinpath(STATE_FILE))
+    return new_state
@@ -4,68 +4,395 @@ import os
 from pathlib import Path
 
 import networkx as nx
+import numpy as np
 import pandas as pd
 import yaml
 
+from precluster_state import broken_components, read_state, save_state
+from run_manifest import read_yaml, stable_cluster_ids
 
-def read_mash(filepath: str) -> pd.DataFrame:
-    df = pd.read_csv(
+MASH_COLUMNS = ["query", "ref", "dist", "p-value", "matches"]
+
+
+# Maximum number of samples in the heatmap (the first in the mash output)
+MAX_HEATMAP_SIZE = 1000
+# Maximum number of (largest) clusters drawn in the cluster summary
+MAX_SUMMARY_CLUSTERS = 100
+# Number of closest clusters every cluster is linked to in the cluster summary
+SUMMARY_NEIGHBOURS = 3
+
+
+def plot_heatmap(
+    heatmap: np.ndarray, heatmap_clusters: list, n_samples: int, out_dir: Path
+) -> None:
+    """
+    Draws the distances between the samples of the heatmap, ordered by
+    cluster (heatmap_clusters is the cluster of every row).
+    """
+    cluster_sizes = pd.Series(heatmap_clusters).value_counts(sort=False)
+    boundaries = np.cumsum(cluster_sizes.values)[:-1]
+    fig, ax = plt.subplots(figsize=(10, 9))
+    image = ax.imshow(
+        np.ma.masked_invalid(heatmap),
+        cmap="viridis_r",
+        interpolation="nearest",
+        rasterized=True,
+    )
+    if len(boundaries) <= MAX_SUMMARY_CLUSTERS:
+        for boundary in boundaries - 0.5:
+            ax.axhline(boundary, color="white", linewidth=0.5)
+            ax.axvline(boundary, color="white", linewidth=0.5)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    shown = f"{len(heatmap)} of {n_samples}" if len(heatmap) < n_samples else n_samples
+    ax.set_title(f"Mash distances of {shown} samples in {len(cluster_sizes)} clusters")
+    fig.colorbar(image, ax=ax, label="Mash distance")
+    fig.savefig(out_dir.joinpath("distance_heatmap.png"), dpi=150)
+    plt.close(fig)
+
+
+def plot_cluster_summary(
+    clusters: dict, cluster_links: pd.Series, threshold: float, out_dir: Path
+) -> None:
+    """
+    Draws one node per cluster (the largest MAX_SUMMARY_CLUSTERS) linked to
+    its SUMMARY_NEIGHBOURS closest clusters, labelled by the smallest mash
+    distance between their samples.
+    """
+    cluster_sizes = pd.Series(clusters).value_counts().sort_index()
+    shown = cluster_sizes.sort_values(ascending=False, kind="stable").index
+    shown = shown[:MAX_SUMMARY_CLUSTERS].sort_values()
+    graph = nx.Graph()
+    graph.add_nodes_from(shown)
+    if len(cluster_links) > 0:
+        links = cluster_links.reset_index()
+        links = links[links["cluster_1"].isin(shown) & links["cluster_2"].isin(shown)]
+        both_ways = pd.concat(
+            [
+                links,
+                links.rename(
+                    columns={"cluster_1": "cluster_2", "cluster_2": "cluster_1"}
+                ),
+            ]
+        )
+        closest = (
+            both_ways.sort_values("dist").groupby("cluster_1").head(SUMMARY_NEIGHBOURS)
+        )
+        graph.add_weighted_edges_from(
+            closest[["cluster_1", "cluster_2", "dist"]].itertuples(index=False),
+            weight="dist",
+        )
+    pos = nx.spring_layout(graph, seed=1)
+    fig, ax = plt.subplots(figsize=(12, 10))
+    nx.draw_networkx_nodes(
+        graph,
+        pos,
+        node_size=[30 + 20 * np.sqrt(cluster_sizes[node]) for node in graph.nodes],
+        ax=ax,
+    )
+    nx.draw_networkx_labels(
+        graph,
+        pos,
+        labels={node: f"{node} (n={cluster_sizes[node]})" for node in graph.nodes},
+        font_size=7,
+        ax=ax,
+    )
+    nx.draw_networkx_edges(graph, pos, alpha=0.4, ax=ax)
+    nx.draw_networkx_edge_labels(
+        graph,
+        pos,
+        edge_labels={
+            (node_1, node_2): f"{dist:.3g}"
+            for node_1, node_2, dist in graph.edges(data="dist")
+        },
+        font_size=6,
+        ax=ax,
+    )
+    title = f"Closest clusters (mash threshold {threshold})"
+    if len(cluster_sizes) > len(shown):
+        title += f", largest {len(shown)} of {len(cluster_sizes)} clusters shown"
+    ax.set_title(title)
+    ax.set_axis_off()
+    fig.savefig(out_dir.joinpath("cluster_summary.png"), dpi=150)
+    plt.close(fig)
+
+
+def plot_clusters(
+    plot_data: "PlotData",
+    union_find: "UnionFind",
+    clusters: dict,
+    threshold: float,
+    out_dir: Path,
+) -> None:
+    """
+    Draws the plot data collected by stream_mash_clusters. In an incremental
+    run the mash output only has the distances of the new samples (new vs.
+    existing and new vs. new), so the distances between samples that were
+    already in the state are missing from the heatmap and the cluster links.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if len(clusters) == 0:
+        return
+    heatmap, heatmap_clusters, cluster_links = plot_data.for_clusters(
+        union_find, clusters
+    )
+    plot_heatmap(heatmap, heatmap_clusters, len(clusters), out_dir)
+    plot_cluster_summary(clusters, cluster_links, threshold, out_dir)
+
+
+def read_mash_chunks(filepath: str, chunksize: int = 1_000_000):
+    """
+    Reads the mash dist output in chunks of chunksize lines and yields the
+    query and ref of every line, named after the stem of their file like
+    the samples, and the distances (an array).
+    """
+    if os.path.getsize(filepath) == 0:
+        return
+    stems = {}
+    reader = pd.read_csv(
         filepath,
         sep="\t",
         header=None,
-        names=["query", "ref", "dist", "p-value", "matches"],
+        names=MASH_COLUMNS,
+        usecols=["query", "ref", "dist"],
+        chunksize=chunksize,
     )
-    df["query_clean"] = df["query"].apply(lambda x: Path(x).stem)
-    df["ref_clean"] = df["ref"].apply(lambda x: Path(x).stem)
-    df = df[df["query_clean"] != df["ref_clean"]]
-    return df
+    for chunk in reader:
+        for name in pd.unique(chunk[["query", "ref"]].values.ravel()):
+            if name not in stems:
+                stems[name] = Path(name).stem
+        yield chunk["query"].map(stems), chunk["ref"].map(stems), chunk["dist"].values
 
 
-def create_graph(df: pd.DataFrame) -> tuple[nx.Graph, dict]:
-    G = nx.from_pandas_edgelist(
-        df, source="query_clean", target="ref_clean", edge_attr="dist"
-    )
-    pos = nx.circular_layout(
-        G
-    )  # To do: add different layout options e.g. spring_layout
-    return G, pos
+class UnionFind:
+    """Array-backed disjoint set of samples, indexed by order of appearance"""
+
+    def __init__(self) -> None:
+        self.index: dict = {}
+        self.parent: list = []
+        self.size: list = []
+
+    def add(self, sample: str) -> int:
+        if sample not in self.index:
+            self.index[sample] = len(self.parent)
+            self.parent.append(len(self.parent))
+            self.size.append(1)
+        return self.index[sample]
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+
+    def roots(self) -> np.ndarray:
+        """Root of every sample, by following all parents at once"""
+        roots = np.array(self.parent, dtype=np.int64)
+        while True:
+            parents = roots[roots]
+            if np.array_equal(parents, roots):
+                return roots
+            roots = parents
+
+
+class PlotData:
+    """
+    Data for the plots, collected while stream_mash_clusters reads the mash
+    output so it is read once: the distances between the first
+    MAX_HEATMAP_SIZE samples (in order of appearance) and the smallest
+    distance between every two components. As components merge while
+    reading, the links are kept by the current root of their components.
+    """
+
+    def __init__(self) -> None:
+        self.heatmap = np.full(
+            (MAX_HEATMAP_SIZE, MAX_HEATMAP_SIZE), np.nan, dtype=np.float32
+        )
+        self.links = pd.Series(
+            dtype=float,
+            index=pd.MultiIndex.from_arrays([[], []], names=["root_1", "root_2"]),
+            name="dist",
+        )
+
+    def add(
+        self, union_find: UnionFind, i: np.ndarray, j: np.ndarray, dist: np.ndarray
+    ) -> None:
+        """Adds the distances between samples i and j (indices in union_find)"""
+        shown = (i < MAX_HEATMAP_SIZE) & (j < MAX_HEATMAP_SIZE)
+        np.fmin.at(self.heatmap, (i[shown], j[shown]), dist[shown])
+        np.fmin.at(self.heatmap, (j[shown], i[shown]), dist[shown])
+        roots = union_find.roots()
+        old_1 = roots[self.links.index.get_level_values(0).values.astype(int)]
+        old_2 = roots[self.links.index.get_level_values(1).values.astype(int)]
+        root_1 = np.concatenate((old_1, roots[i]))
+        root_2 = np.concatenate((old_2, roots[j]))
+        dist = np.concatenate((self.links.values, dist))
+        between = root_1 != root_2
+        links = pd.DataFrame(
+            {
+                "root_1": np.minimum(root_1, root_2)[between],
+                "root_2": np.maximum(root_1, root_2)[between],
+                "dist": dist[between],
+            }
+        )
+        self.links = links.groupby(["root_1", "root_2"])["dist"].min()
+
+    def for_clusters(
+        self, union_find: UnionFind, clusters: dict
+    ) -> tuple[np.ndarray, list, pd.Series]:
+        """
+        The heatmap of the samples in clusters, ordered by cluster, the
+        cluster of every row and the smallest distance per pair of clusters.
+        """
+        samples = list(union_find.index)
+        shown = [
+            i
+            for i, sample in enumerate(samples[:MAX_HEATMAP_SIZE])
+            if sample in clusters
+        ]
+        shown.sort(key=lambda i: clusters[samples[i]])
+        heatmap = self.heatmap[np.ix_(shown, shown)].astype(float)
+        heatmap_clusters = [clusters[samples[i]] for i in shown]
+
+        root_clusters = {}
+        for sample, i in union_find.index.items():
+            if sample in clusters:
+                root_clusters[union_find.find(i)] = clusters[sample]
+        links = self.links.reset_index()
+        cluster_1 = links["root_1"].map(root_clusters)
+        cluster_2 = links["root_2"].map(root_clusters)
+        known = (cluster_1.notna() & cluster_2.notna()).values
+        cluster_1 = cluster_1[known].astype(int).values
+        cluster_2 = cluster_2[known].astype(int).values
+        cluster_links = (
+            pd.DataFrame(
+                {
+                    "cluster_1": np.minimum(cluster_1, cluster_2),
+                    "cluster_2": np.maximum(cluster_1, cluster_2),
+                    "dist": links["dist"].values[known],
+                }
+            )
+            .groupby(["cluster_1", "cluster_2"])["dist"]
+            .min()
+        )
+        return heatmap, heatmap_clusters, cluster_links
+
+
+def stream_mash_clusters(
+    filepath: str,
+    threshold: float,
+    chunksize: int = 1_000_000,
+    union_find: UnionFind = None,
+    samples: set = None,
+    plot_data: PlotData = None,
+) -> UnionFind:
+    """
+    Reads the mash dist output in chunks and merges every pair of samples
+    with a distance below or equal to the threshold. Pairs above the
+    threshold are dropped while reading, so memory grows with the number of
+    samples instead of the number of pairs. If a union_find is given (e.g.
+    loaded from a previous run), the new pairs are merged into it. If
+    samples is given, pairs with any other sample are ignored. If plot_data
+    is given, the distances are collected in it as well.
+    """
+    if union_find is None:
+        union_find = UnionFind()
+    self_only = {}
+    for query, ref, dist in read_mash_chunks(filepath, chunksize):
+        if samples is not None:
+            known = (query.isin(samples) & ref.isin(samples)).values
+            query, ref, dist = query[known], ref[known], dist[known]
+        query, ref = query.values, ref.values
+        not_self = query != ref
+        # Samples are numbered in order of first appearance, query before ref
+        interleaved = np.column_stack((query[not_self], ref[not_self])).ravel()
+        for sample in pd.unique(interleaved):
+            union_find.add(sample)
+        for sample in query[~not_self]:
+            self_only[sample] = None
+        keep = not_self & (dist <= threshold)
+        for sample_1, sample_2 in zip(query[keep], ref[keep]):
+            union_find.union(union_find.index[sample_1], union_find.index[sample_2])
+        if plot_data is not None:
+            index = pd.Series(union_find.index)
+            plot_data.add(
+                union_find,
+                index[query[not_self]].values,
+                index[ref[not_self]].values,
+                dist[not_self],
+            )
+    for sample in self_only:
+        union_find.add(sample)
+    return union_find
 
 
-def split_graph(
-    graph: nx.Graph, threshold: float, pos: dict, out_dir: Path
-) -> nx.Graph:
-    graph_copy = graph.copy()
-    edges_above_threshold = [
-        [n1, n2] for n1, n2, dist in graph_copy.edges(data="dist") if dist > threshold
-    ]
-    graph_copy.remove_edges_from(edges_above_threshold)
-    return graph_copy
+def load_state(
+    state_path: Path,
+    samples: set = None,
+    kmer_length: int = None,
+    sketch_size: int = None,
+) -> UnionFind:
+    """
+    Rebuilds the union-find from a preclustering state written by a previous
+    run (sample -> component, in order of first appearance). If samples is
+    given, the components with samples that are not in it are dropped
+    entirely; the pipeline compares their remaining members again as if they
+    were new, so the clusters are those of a full run on the same samples.
+    A state made with another k-mer length or sketch size is ignored.
+    """
+    union_find = UnionFind()
+    components = read_state(state_path, kmer_length, sketch_size)
+    if samples is not None:
+        broken = broken_components(components, samples)
+        components = {
+            sample: component
+            for sample, component in components.items()
+            if component not in broken
+        }
+    first_member = {}
+    for sample, component in components.items():
+        i = union_find.add(sample)
+        if component in first_member:
+            union_find.union(first_member[component], i)
+        else:
+            first_member[component] = i
+    return union_find
 
 
-def plot_graphs(
-    whole_graph: nx.Graph, splitted_graph: nx.Graph, pos: dict, out_dir: Path
+def write_state(
+    union_find: UnionFind, outpath: Path, kmer_length: int, sketch_size: int
 ) -> None:
-    # print(whole_graph.edges)
-    # print(splitted_graph.edges)
-    os.makedirs(out_dir, exist_ok=True)
-    dist_labels = nx.get_edge_attributes(whole_graph, "dist")
-    nx.draw(whole_graph, pos)
-    nx.draw_networkx_edge_labels(whole_graph, pos, edge_labels=dist_labels)
-    plt.savefig(out_dir.joinpath("pre_filter.png"))
-    plt.clf()
-
-    dist_labels = nx.get_edge_attributes(splitted_graph, "dist")
-    nx.draw(splitted_graph, pos)
-    nx.draw_networkx_edge_labels(splitted_graph, pos, edge_labels=dist_labels)
-    plt.savefig(out_dir.joinpath("post_filter.png"))
-    plt.clf()
-
-
-def define_clusters(graph: nx.Graph) -> dict:
-    components = nx.connected_components(graph)
-    list_subgraphs = [
-        subgraph for subgraph in sorted(components, key=len, reverse=True)
-    ]
+    components = {sample: union_find.find(i) for sample, i in union_find.index.items()}
+    save_state(components, outpath, kmer_length, sketch_size)
+
+
+def read_samples(sample_sheet: Path) -> set:
+    with open(sample_sheet) as file:
+        return set(yaml.safe_load(file))
+
+
+def define_clusters(union_find: UnionFind, samples: set = None) -> dict:
+    """
+    Numbers the connected components by decreasing size. Ties keep the order
+    in which their first sample appeared in the mash output. If samples is
+    given, only those samples are reported (and counted for the size).
+    """
+    components = {}
+    for sample, i in union_find.index.items():
+        if samples is not None and sample not in samples:
+            continue
+        components.setdefault(union_find.find(i), []).append(sample)
+    list_subgraphs = sorted(components.values(), key=len, reverse=True)
     sample_clusters = {}
     for cluster, sample_set in enumerate(list_subgraphs, start=1):
         for sample in sample_set:
@@ -79,13 +406,24 @@ def write_results(clusters: dict, outpath: Path) -> None:
 
 
 def main(args) -> None:
-    df = read_mash(args.input)
-    whole_graph, positions = create_graph(df)
-    splitted_graph = split_graph(whole_graph, args.threshold, positions, args.output)
-    if args.plot_output is not None:
-        plot_graphs(whole_graph, splitted_graph, positions, args.plot_output)
-    clusters = define_clusters(splitted_graph)
+    samples = None
+    if args.sample_sheet is not None:
+        samples = read_samples(args.sample_sheet)
+    union_find = load_state(
+        args.state_input, samples, args.kmer_length, args.sketch_size
+    )
+    plot_data = PlotData() if args.plot_output is not None else None
+    union_find = stream_mash_clusters(
+        args.input, args.threshold, args.chunk_size, union_find, samples, plot_data
+    )
+    if args.state_output is not None:
+        write_state(union_find, args.state_output, args.kmer_length, args.sketch_size)
+    clusters = define_clusters(union_find, samples)
+    if args.manifest is not None:
+        clusters = stable_cluster_ids(clusters, read_yaml(args.manifest))
     write_results(clusters, args.output)
+    if args.plot_output is not None:
+        plot_clusters(plot_data, union_find, clusters, args.threshold, args.plot_output)
 
 
 if __name__ == "__main__":
@@ -119,9 +457,67 @@ if __name__ == "__main__":
         help="Threshold of mash distance to group samples by",
         default=0.01,
     )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        type=int,
+        metavar="INT",
+        help="Number of mash dist lines to read at once",
+        default=1_000_000,
+    )
+    parser.add_argument(
+        "--state-input",
+        type=Path,
+        metavar="FILE",
+        help="Preclustering state of a previous run. The input distances are then"
+        " only those of the new samples (new vs. existing and new vs. new).",
+        default=None,
+    )
+    parser.add_argument(
+        "--state-output",
+        type=Path,
+        metavar="FILE",
+        help="Output path for the updated preclustering state",
+        default=None,
+    )
+    parser.add_argument(
+        "--kmer-length",
+        type=int,
+        metavar="INT",
+        help="K-mer length of the mash sketches. A state made with another k-mer"
+        " length or sketch size is ignored (the input is then a full run)",
+        default=None,
+    )
+    parser.add_argument(
+        "--sketch-size",
+        type=int,
+        metavar="INT",
+        help="Sketch size of the mash sketches",
+        default=None,
+    )
+    parser.add_argument(
+        "--sample-sheet",
+        type=Path,
+        metavar="FILE",
+        help="Sample sheet of the current run. If given, only these samples are"
+        " clustered and written to clusters.yaml and the state",
+        default=None,
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        metavar="FILE",
+        help="Run manifest of a previous run. If given, clusters keep the number of"
+        " the previous cluster they share most samples with, instead of being"
+        " numbered by size",
+        default=None,
+    )
     args = parser.parse_args()
 
     if args.plot_output is not None:
+        import matplotlib
+
+        matplotlib.use("Agg")
         import matplotlib.pyplot as plt
 
     main(args)
@@ -0,0 +1,343 @@
+import argparse
+import html
+import json
+import os
+import pathlib
+import re
+
+import numpy as np
+import pandas as pd
+
+from cluster_index import ClusterIndex
+from resource_model import FEATURES, job_features
+
+# Columns of the benchmark files of Snakemake that are reported
+BENCHMARK_COLUMNS = ["s", "cpu_time", "max_rss", "io_in", "io_out", "mean_load"]
+WILDCARD = re.compile(r"\{([^{}]+)\}")
+# First line of a job in the log of a Snakemake run
+JOB_HEADER = re.compile(r"^(local)?(checkpoint|rule) \S+:$")
+
+
+def pattern_regex(pattern: str) -> re.Pattern:
+    """Regular expression matching the paths of a Snakemake file pattern"""
+    regex, seen, end = "", set(), 0
+    for match in WILDCARD.finditer(pattern):
+        regex += re.escape(pattern[end : match.start()])
+        name, _, constraint = match.group(1).partition(",")
+        name = name.strip()
+        if name in seen:
+            regex += f"(?P={name})"
+        else:
+            regex += f"(?P<{name}>{constraint.strip() or '.+'})"
+            seen.add(name)
+        end = match.end()
+    return re.compile(regex + re.escape(pattern[end:]) + "$")
+
+
+def find_benchmarks(pattern: str, run_start: float) -> list:
+    """
+    Benchmark files of a rule written since run_start, with the wildcards of
+    their job taken from the benchmark pattern of the rule.
+    """
+    regex = pattern_regex(pattern)
+    root = os.path.dirname(pattern.partition("{")[0]) or "."
+    benchmarks = []
+    for dirpath, _, files in os.walk(root):
+        for file in files:
+            path = os.path.join(dirpath, file)
+            match = regex.match(path)
+            if match is not None and os.path.getmtime(path) >= run_start:
+                benchmarks.append((path, match.groupdict()))
+    return benchmarks
+
+
+def read_job_log(log_file: pathlib.Path) -> dict:
+    """
+    Inputs and outputs of the jobs in the log of a Snakemake run, by the
+    benchmark file of the job.
+    """
+    jobs = {}
+    if log_file is None or not log_file.exists():
+        return jobs
+    job = None
+    with open(log_file) as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if JOB_HEADER.match(line):
+                job = {"input": [], "output": []}
+            elif job is not None and line.startswith("    "):
+                key, _, value = line.strip().partition(": ")
+                if key in ["input", "output"]:
+                    job[key] = value.split(", ")
+                elif key == "benchmark":
+                    jobs[value] = job
+            else:
+                job = None
+    return jobs
+
+
+def read_benchmark(path: pathlib.Path) -> dict:
+    """Last line (attempt) of a benchmark file, or NaN if it is missing"""
+    if not path.exists():
+        return {column: np.nan for column in BENCHMARK_COLUMNS}
+    benchmark = pd.read_csv(path, sep="\t", na_values=["NA", "-"])
+    return {
+        column: (
+            float(benchmark[column].iloc[-1])
+            if column in benchmark and len(benchmark) > 0
+            else np.nan
+        )
+        for column in BENCHMARK_COLUMNS
+    }
+
+
+def collect_jobs(
+    patterns: dict,
+    job_log: dict,
+    run_start: float,
+    clusters_file: pathlib.Path,
+    output_dir: pathlib.Path,
+) -> pd.DataFrame:
+    """
+    One row per benchmark file written in this run, with the wildcards
+    (cluster and sample) of its job, the features of the resource model and
+    its measurements. A job ends when its benchmark file is written, so it
+    started s seconds before. The inputs and outputs of a job come from the
+    log of the run; the input size is unknown for jobs missing from it.
+    """
+    cluster_index = ClusterIndex()
+    rows = []
+    for rule, pattern in patterns.items():
+        for path, wildcards in find_benchmarks(pattern, run_start):
+            benchmark = read_benchmark(pathlib.Path(path))
+            cluster = wildcards.get("cluster")
+            n_samples = None
+            if cluster is not None and clusters_file.exists():
+                n_samples = len(cluster_index.samples(clusters_file, cluster))
+            job = job_log.get(path, {"input": [], "output": []})
+            features = job_features(
+                job["input"],
+                (
+                    None
+                    if cluster is None
+                    else output_dir.joinpath("ref_genomes_used", f"cluster_{cluster}")
+                ),
+                n_samples,
+            )
+            if path not in job_log:
+                features["input_gb"] = np.nan
+            end = os.path.getmtime(path)
+            rows.append(
+                {
+                    "rule": rule,
+                    "cluster": cluster,
+                    "sample": wildcards.get("sample"),
+                    "start": end - (0 if np.isnan(benchmark["s"]) else benchmark["s"]),
+                    "end": end,
+                    "input": job["input"],
+                    "output": job["output"],
+                    **features,
+                    **benchmark,
+                }
+            )
+    columns = ["rule", "cluster", "sample", "start", "end", "input", "output"]
+    return pd.DataFrame(rows, columns=columns + FEATURES + BENCHMARK_COLUMNS)
+
+
+def critical_path(jobs: pd.DataFrame, inputs: list, outputs: list) -> pd.DataFrame:
+    """
+    Chain of jobs that determined the duration of the run: starting from the
+    job that finished last, the input of every job that became available last.
+    wait is the time between that input being ready (or the start of the run
+    for the first job) and the job starting.
+    """
+    if len(jobs) == 0:
+        return jobs.assign(wait=[])
+    producer = {
+        output: i for i, job_outputs in enumerate(outputs) for output in job_outputs
+    }
+    path = [int(np.argmax(jobs["end"].to_numpy()))]
+    while True:
+        job = path[-1]
+        previous = {producer[file] for file in inputs[job] if file in producer} - {job}
+        if len(previous) == 0:
+            break
+        path.append(max(previous, key=lambda i: jobs["end"].iloc[i]))
+    path = jobs.iloc[path[::-1]].reset_index(drop=True)
+    path["wait"] = path["start"] - path["end"].shift(1).fillna(0)
+    return path
+
+
+def summarise(jobs: pd.DataFrame, by: list) -> pd.DataFrame:
+    """Number of jobs, wall and CPU time, peak memory and I/O per group"""
+    if len(jobs) == 0:
+        return pd.DataFrame(columns=by + ["jobs"])
+    summary = jobs.groupby(by, dropna=True).agg(
+        jobs=("rule", "size"),
+        total_s=("s", "sum"),
+        mean_s=("s", "mean"),
+        max_s=("s", "max"),
+        cpu_time=("cpu_time", "sum"),
+        max_rss=("max_rss", "max"),
+        io_in=("io_in", "sum"),
+        io_out=("io_out", "sum"),
+    )
+    summary["share_s"] = summary["total_s"] / jobs["s"].sum()
+    return summary.sort_values("total_s", ascending=False).reset_index()
+
+
+def write_html(
+    output: pathlib.Path, summary: dict, tables: dict, max_rows: int = 50
+) -> None:
+    body = [
+        "<h1>Juno-SNP run performance</h1>",
+        "<table>",
+        *(
+            f"<tr><th>{html.escape(key)}</th><td>{html.escape(str(value))}</td></tr>"
+            for key, value in summary.items()
+        ),
+        "</table>",
+    ]
+    for title, table in tables.items():
+        body.append(f"<h2>{html.escape(title)}</h2>")
+        if len(table) > max_rows:
+            body.append(f"<p>First {max_rows} of {len(table)} rows.</p>")
+        body.append(
+            table.head(max_rows).to_html(index=False, float_format="{:.2f}".format)
+        )
+    with open(output, "w") as file:
+        file.write(
+            "<!DOCTYPE html>\n<html><head><meta charset='utf-8'>"
+            "<title>Juno-SNP run performance</title>"
+            "<style>body{font-family:sans-serif} table{border-collapse:collapse}"
+            " td,th{border:1px solid #ccc;padding:2px 6px;text-align:right}</style>"
+            "</head><body>\n" + "\n".join(body) + "\n</body></html>\n"
+        )
+
+
+def profile_report(
+    patterns_file: pathlib.Path,
+    log_file: pathlib.Path,
+    run_start: float,
+    clusters_file: pathlib.Path,
+    output_dir: pathlib.Path,
+    report_dir: pathlib.Path,
+) -> None:
+    with open(patterns_file) as file:
+        patterns = json.load(file)
+    jobs = collect_jobs(
+        patterns, read_job_log(log_file), run_start, clusters_file, output_dir
+    )
+    # Times in seconds since the start of the first job
+    run_start = jobs["start"].min()
+    jobs["start"] = jobs["start"] - run_start
+    jobs["end"] = jobs["end"] - run_start
+    path = critical_path(jobs, list(jobs.pop("input")), list(jobs.pop("output")))
+
+    report_dir.mkdir(parents=True, exist_ok=True)
+    tables = {
+        "Critical path": path,
+        "Rules": summarise(jobs, ["rule"]),
+        "Clusters": summarise(jobs, ["cluster"]),
+        "Samples": summarise(jobs, ["sample"]),
+        "Slowest jobs": jobs.sort_values("s", ascending=False),
+    }
+    files = ["critical_path", "rules", "clusters", "samples", "jobs"]
+    for file, table in zip(files, tables.values()):
+        table.to_csv(
+            report_dir.joinpath(f"{file}.tsv"),
+            sep="\t",
+            index=False,
+            float_format="%.6g",
+        )
+    summary = {
+        "jobs": len(jobs),
+        "wall_time_s": (
+            round(float(jobs["end"].fillna(0).max()), 1) if len(jobs) > 0 else 0.0
+        ),
+        "critical_path_s": round(float((path["end"] - path["start"]).sum()), 1),
+        "critical_path_wait_s": round(float(path["wait"].sum()), 1),
+        "job_time_s": round(float(jobs["s"].sum()), 1),
+        "cpu_time_s": round(float(jobs["cpu_time"].sum()), 1),
+        "max_rss_mb": (
+            round(float(jobs["max_rss"].fillna(0).max()), 1) if len(jobs) > 0 else 0.0
+        ),
+    }
+    with open(report_dir.joinpath("report.json"), "w") as file:
+        json.dump(
+            {
+                "summary": summary,
+                "critical_path": json.loads(path.to_json(orient="records")),
+                "rules": json.loads(tables["Rules"].to_json(orient="records")),
+            },
+            file,
+            indent=2,
+        )
+    write_html(report_dir.joinpath("report.html"), summary, tables)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the wall time, CPU time, peak memory and I/O of the jobs of a run."
+    )
+    parser.add_argument(
+        "-p",
+        "--patterns",
+        help="Json with the benchmark file pattern of every rule that has one.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-l",
+        "--log",
+        help="Log of the Snakemake run, with the inputs and outputs of its jobs.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-s",
+        "--run-start",
+        help="Time (seconds since the epoch) at which the run started. Jobs of earlier runs are ignored.",
+        metavar="FLOAT",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "-cf",
+        "--clustering-file",
+        help="Clusters of the samples (clusters.yaml).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        help="Output directory of the pipeline.",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output directory for the report.",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+    )
+    args = parser.parse_args()
+    profile_report(
+        args.patterns,
+        args.log,
+        args.run_start,
+        args.clustering_file,
+        args.output_dir,
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import fcntl
+import os
+import pathlib
+import shutil
+import tempfile
+from typing import Callable
+
+# A fetch backend receives an accession number and an (empty) directory and
+# returns the path of the reference genome it wrote in that directory.
+FetchBackend = Callable[[str, pathlib.Path], pathlib.Path]
+
+
+def fetch_from_directory(source_dir: pathlib.Path) -> FetchBackend:
+    """
+    Creates a fetch backend that copies reference genomes from a local
+    directory instead of downloading them (e.g. for testing or offline use).
+    The genome of an accession is the first file starting with the accession
+    number.
+    """
+    source_dir = pathlib.Path(source_dir)
+
+    def fetch(accession_nr: str, output_dir: pathlib.Path) -> pathlib.Path:
+        matches = sorted(source_dir.glob(f"{accession_nr}*"))
+        if len(matches) == 0:
+            raise FileNotFoundError(
+                f"Could not find reference genome {accession_nr} in {source_dir}"
+            )
+        ref_genome = pathlib.Path(output_dir).joinpath("ref_genome.seq")
+        shutil.copyfile(matches[0], ref_genome)
+        return ref_genome
+
+    return fetch
+
+
+class ReferenceStore:
+    """
+    Local store of reference genomes keyed by accession number.
+
+    Every accession is prepared once (fetched into a temporary directory and
+    moved into place atomically). Later requests are resolved by hard linking
+    the stored genome to the requested location, or copying it if the store
+    is on another file system, so an output never depends on the store. When
+    the store grows beyond max_size_gb, the least recently used genomes are
+    evicted.
+    """
+
+    def __init__(
+        self, root: pathlib.Path, fetch: FetchBackend, max_size_gb: float = 20
+    ) -> None:
+        self.root = pathlib.Path(root)
+        self.fetch = fetch
+        self.max_size = int(max_size_gb * 1024**3)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def entry(self, accession_nr: str) -> pathlib.Path:
+        return self.root.joinpath(accession_nr, "ref_genome.seq")
+
+    def get(self, accession_nr: str, ref_genome: pathlib.Path) -> pathlib.Path:
+        entry = self.entry(accession_nr)
+        with open(self.root.joinpath(f".{accession_nr}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if entry.exists():
+                print(f"Reference genome {accession_nr} found in {self.root}")
+            else:
+                self._prepare(accession_nr, entry)
+            entry.parent.joinpath("last_used").touch()
+            self._link(entry, pathlib.Path(ref_genome))
+        self.evict(keep=accession_nr)
+        return pathlib.Path(ref_genome)
+
+    def _prepare(self, accession_nr: str, entry: pathlib.Path) -> None:
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.root, prefix=".tmp_") as tmp_dir:
+            fetched = self.fetch(accession_nr, pathlib.Path(tmp_dir))
+            os.replace(fetched, entry)
+
+    @staticmethod
+    def _link(entry: pathlib.Path, ref_genome: pathlib.Path) -> None:
+        ref_genome.parent.mkdir(parents=True, exist_ok=True)
+        if ref_genome.exists() or ref_genome.is_symlink():
+            ref_genome.unlink()
+        try:
+            os.link(entry, ref_genome)
+        except OSError:
+            # Hard links are not possible across file systems
+            shutil.copyfile(entry, ref_genome)
+
+    def evict(self, keep: str = None) -> None:
+        evict_lru(self.root, self.max_size, keep=keep)
+
+
+def evict_lru(root: pathlib.Path, max_size: int, keep: str = None) -> None:
+    """
+    Removes the least recently used entries (subdirectories with a last_used
+    file) of a store until its total size is at most max_size bytes. Entries
+    with files that are still hard linked from elsewhere (e.g. the reference
+    genome of an output directory) count toward the size but are never
+    removed, as that would free no space. Entries that are locked by another
+    job are skipped.
+    """
+    root = pathlib.Path(root)
+    entries = []
+    linked_size = 0
+    for entry_dir in root.iterdir():
+        if entry_dir.name.startswith(".") or not entry_dir.is_dir():
+            continue
+        stats = [f.stat() for f in entry_dir.rglob("*") if f.is_file()]
+        size = sum(stat.st_size for stat in stats)
+        if any(stat.st_nlink > 1 for stat in stats):
+            linked_size += size
+            continue
+        last_used = entry_dir.joinpath("last_used")
+        last_used_time = last_used.stat().st_mtime if last_used.exists() else 0
+        entries.append((last_used_time, size, entry_dir))
+    total_size = linked_size + sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        if entry_dir.name == keep:
+            continue
+        with open(root.joinpath(f".{entry_dir.name}.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Entry is being prepared or used by another job
+                continue
+            print(f"Evicting {entry_dir.name} from {root}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+    if total_size > max_size and total_size - linked_size <= max_size:
+        print(
+            f"{root} holds {total_size} bytes, more than its limit of {max_size}"
+            f" bytes, because {linked_size} bytes are still linked from elsewhere"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove the least recently used entries of a cache directory."
+    )
+    parser.add_argument(
+        "-r",
+        "--root",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+        help="Cache directory (e.g. reference store or mapping cache).",
+    )
+    parser.add_argument(
+        "-s",
+        "--max-size-gb",
+        metavar="FLOAT",
+        type=float,
+        required=True,
+        help="Maximum size of the cache in GB.",
+    )
+    args = parser.parse_args()
+    if args.root.exists():
+        evict_lru(args.root, int(args.max_size_gb * 1024**3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import math
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+import yaml
+
+# Measured per job, the inputs of the linear model of every resource
+FEATURES = ["input_gb", "ref_mb", "n_samples"]
+
+
+def path_size(path: pathlib.Path) -> int:
+    """Size in bytes of a file or of all files in a directory (0 if missing)"""
+    path = pathlib.Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    size = 0
+    if path.is_dir():
+        for root, _, files in os.walk(path):
+            size += sum(
+                os.path.getsize(os.path.join(root, file))
+                for file in files
+                if os.path.isfile(os.path.join(root, file))
+            )
+    return size
+
+
+def reference_mb(reference_dir: pathlib.Path) -> float:
+    """
+    Length (Mb) of the reference of a cluster, from the fasta index if it
+    exists or else from the size of the reference. The alignments of the
+    cluster have the same length.
+    """
+    fai = reference_dir.joinpath("ref_genome.fasta.fai")
+    if fai.exists():
+        with open(fai) as file:
+            return sum(int(line.split("\t")[1]) for line in file) / 1e6
+    for name in ["ref_genome.fasta", "ref_genome.seq"]:
+        if reference_dir.joinpath(name).exists():
+            return reference_dir.joinpath(name).stat().st_size / 1e6
+    return 0.0
+
+
+def job_features(
+    input: list, reference_dir: pathlib.Path = None, n_samples: int = None
+) -> dict:
+    """
+    Features of a job: the size of its inputs and, for jobs of a cluster, the
+    length of the reference and the number of samples in the cluster.
+    """
+    return {
+        "input_gb": sum(path_size(path) for path in input) / 1e9,
+        "ref_mb": 0.0 if reference_dir is None else reference_mb(reference_dir),
+        "n_samples": 1 if n_samples is None else n_samples,
+    }
+
+
+def predict(coefficients: dict, features: dict) -> float:
+    value = coefficients.get("intercept", 0) + sum(
+        coefficients.get(feature, 0) * features[feature] for feature in FEATURES
+    )
+    return min(
+        max(value, coefficients.get("min", 0)), coefficients.get("max", math.inf)
+    )
+
+
+class ResourceModel:
+    """
+    Threads, memory (GB) and runtime (minutes) of every job. In "fixed" mode
+    these are the values per tool of pipeline_parameters.yaml. In "model"
+    mode, rules in the model file get them from a linear model of the input
+    size, reference length and number of samples in the cluster of the job.
+    In both modes the memory (and runtime) grow with every retry of a job,
+    so a job killed for running out of memory gets more the next time.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        cluster_index,
+        clusters_file: pathlib.Path,
+        output_dir: pathlib.Path,
+    ) -> None:
+        self.threads_per_tool = {
+            tool: int(threads) for tool, threads in config["threads"].items()
+        }
+        self.mem_gb_per_tool = {
+            tool: int(mem_gb) for tool, mem_gb in config["mem_gb"].items()
+        }
+        settings = config["resource_model"]
+        self.mode = settings["mode"]
+        self.retries = int(settings["retries"])
+        model = {}
+        if self.mode == "model":
+            with open(settings["file"]) as file:
+                model = yaml.safe_load(file)
+        self.retry_factor = float(settings["retry_factor"])
+        self.rules = model.get("rules", {})
+        self.cluster_index = cluster_index
+        self.clusters_file = pathlib.Path(clusters_file)
+        self.output_dir = pathlib.Path(output_dir)
+
+    def features(self, wildcards, input) -> dict:
+        if "cluster" not in wildcards.keys():
+            return job_features(input)
+        n_samples = None
+        if self.clusters_file.exists():
+            n_samples = len(
+                self.cluster_index.samples(self.clusters_file, wildcards.cluster)
+            )
+        return job_features(
+            input,
+            self.output_dir.joinpath(
+                "ref_genomes_used", f"cluster_{wildcards.cluster}"
+            ),
+            n_samples,
+        )
+
+    def threads(self, tool: str):
+        def get_threads(wildcards, input, rulename):
+            if rulename not in self.rules or "threads" not in self.rules[rulename]:
+                return self.threads_per_tool[tool]
+            value = predict(
+                self.rules[rulename]["threads"], self.features(wildcards, input)
+            )
+            return max(1, int(round(value)))
+
+        return get_threads
+
+    def mem_gb(self, tool: str):
+        def get_mem_gb(wildcards, input, attempt, rulename):
+            if rulename not in self.rules or "mem_gb" not in self.rules[rulename]:
+                value = self.mem_gb_per_tool[tool]
+            else:
+                value = predict(
+                    self.rules[rulename]["mem_gb"], self.features(wildcards, input)
+                )
+            return max(1, math.ceil(value * self.retry_factor ** (attempt - 1)))
+
+        return get_mem_gb
+
+    def runtime(self, tool: str):
+        def get_runtime(wildcards, input, attempt, rulename):
+            if rulename not in self.rules or "runtime" not in self.rules[rulename]:
+                return None
+            value = predict(
+                self.rules[rulename]["runtime"], self.features(wildcards, input)
+            )
+            return max(1, math.ceil(value * self.retry_factor ** (attempt - 1)))
+
+        return get_runtime
+
+
+def fit_resource(jobs: pd.DataFrame, column: str, margin_quantile: float) -> dict:
+    """
+    Least squares fit of a resource on the features. Negative coefficients
+    are dropped (refitting without them) and the intercept is raised by a
+    quantile of the residuals, so most jobs get at least what they used.
+    """
+    features = [feature for feature in FEATURES if jobs[feature].nunique() > 1]
+    while True:
+        x = np.column_stack([np.ones(len(jobs))] + [jobs[f] for f in features])
+        coefs, *_ = np.linalg.lstsq(x, jobs[column].to_numpy(), rcond=None)
+        negative = [f for f, coef in zip(features, coefs[1:]) if coef < 0]
+        if len(negative) == 0:
+            break
+        features = [f for f in features if f not in negative]
+    residuals = jobs[column].to_numpy() - x @ coefs
+    intercept = coefs[0] + max(0.0, float(np.quantile(residuals, margin_quantile)))
+    fitted = {"intercept": round(max(0.0, float(intercept)), 4)}
+    for feature, coef in zip(features, coefs[1:]):
+        fitted[feature] = round(float(coef), 4)
+    return fitted
+
+
+def fit(
+    observations: list,
+    model_file: pathlib.Path,
+    output: pathlib.Path,
+    min_jobs: int = 5,
+    margin_quantile: float = 0.95,
+) -> None:
+    """
+    Updates the coefficients of the memory and runtime of the rules with at
+    least min_jobs observations (columns rule, the features, max_rss in MB
+    and s in seconds, as in the benchmark files of Snakemake). The limits
+    (min/max) and the threads of the model are kept.
+    """
+    jobs = pd.concat(
+        [pd.read_csv(path, sep="\t") for path in observations], ignore_index=True
+    )
+    jobs = jobs.replace("-", np.nan).dropna(subset=FEATURES + ["max_rss", "s"])
+    jobs[FEATURES + ["max_rss", "s"]] = jobs[FEATURES + ["max_rss", "s"]].astype(float)
+    jobs["mem_gb"] = jobs["max_rss"] / 1024
+    jobs["runtime"] = jobs["s"] / 60
+    with open(model_file) as file:
+        model = yaml.safe_load(file)
+    model.setdefault("rules", {})
+    for rule, rule_jobs in jobs.groupby("rule"):
+        if len(rule_jobs) < min_jobs:
+            print(f"Skipping {rule}: only {len(rule_jobs)} jobs")
+            continue
+        rule_model = model["rules"].setdefault(rule, {})
+        for resource in ["mem_gb", "runtime"]:
+            limits = {
+                key: value
+                for key, value in rule_model.get(resource, {}).items()
+                if key in ["min", "max"]
+            }
+            rule_model[resource] = {
+                **fit_resource(rule_jobs, resource, margin_quantile),
+                **limits,
+            }
+        print(f"Fitted {rule} on {len(rule_jobs)} jobs: {rule_model}")
+    with open(output, "w") as file:
+        yaml.dump(model, file, default_flow_style=False, sort_keys=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fit the resource model of the pipeline on the benchmarks of past runs."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="Tables with one row per job: rule, input_gb, ref_mb, n_samples, max_rss (MB) and s (seconds),"
+        " such as the jobs.tsv of the report of --profile-run.",
+        metavar="FILE",
+        type=pathlib.Path,
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        help="Resource model to update.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=pathlib.Path(__file__).parent.parent.joinpath(
+            "config", "resource_model.yaml"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file for the updated model. Default is to overwrite the model.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--min-jobs",
+        help="Minimum number of jobs of a rule to fit its coefficients.",
+        metavar="INT",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--margin-quantile",
+        help="Quantile of the residuals added to the intercept as safety margin.",
+        metavar="FLOAT",
+        type=float,
+        default=0.95,
+    )
+    args = parser.parse_args()
+    fit(
+        args.input,
+        args.model,
+        args.model if args.output is None else args.output,
+        args.min_jobs,
+        args.margin_quantile,
+    )
+
+
+if __name__ == "__main__":
+    main()
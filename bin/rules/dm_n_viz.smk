@@ -1,54 +1,175 @@
-rule count_const_sites:
+rule analyse_core_alignment:
     input:
-        output_dir.joinpath("snp_analysis", "snippy-core", "cluster_{cluster}"),
+        snippy_dir=output_dir.joinpath(
+            "snp_analysis", "snippy-core", "cluster_{cluster}"
+        ),
+        ref_fasta=output_dir.joinpath(
+            "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+        ),
     output:
-        temp(output_dir.joinpath("ml_tree", "counts_cluster_{cluster}.txt")),
+        const_sites=temp(
+            output_dir.joinpath("ml_tree", "counts_cluster_{cluster}.txt")
+        ),
+        snp_matrix=output_dir.joinpath("tree", "cluster_{cluster}", "snp_matrix.csv"),
+        profile=output_dir.joinpath(
+            "tree", "cluster_{cluster}", "grapetree_profile.tab"
+        ),
     message:
-        "Counting constant site identities."
-    params:
-        cluster="{cluster}",
+        "Counting constant sites, making SNP matrix and allele profile."
     log:
-        log_dir.joinpath("snp_analysis", "count_const_sites", "cluster_{cluster}.log"),
-    conda:
-        "../../envs/snippy.yaml"
-    container:
-        "docker://staphb/snippy:4.6.0-SC2"
-    threads: config["threads"]["other"]
+        log_dir.joinpath(
+            "snp_analysis", "analyse_core_alignment", "cluster_{cluster}.log"
+        ),
+    benchmark:
+        log_dir.joinpath(
+            "benchmark", "analyse_core_alignment", "cluster_{cluster}.tsv"
+        ),
+    group: CLUSTER_CORE_GROUP
+    threads: RESOURCES.threads("snp_dists")
     resources:
-        mem_gb=config["mem_gb"]["other"],
+        mem_gb=RESOURCES.mem_gb("snp_dists"),
+        runtime=RESOURCES.runtime("snp_dists"),
+    retries: RESOURCES.retries
+    params:
+        cluster="{cluster}",
     shell:
         """
-snp-sites -C {input}/cluster_{params.cluster}.full.aln > {output}
+python bin/analyse_core_alignment.py \
+    -i {input.snippy_dir}/cluster_{params.cluster}.full.paln \
+    -r {input.ref_fasta} \
+    -c {output.const_sites} \
+    -m {output.snp_matrix} \
+    -p {output.profile} \
+    -t {threads} &>{log}
         """
 
 
 rule make_tree:
     input:
-        output_dir.joinpath("snp_analysis", "snippy-core", "cluster_{cluster}"),
+        output_dir.joinpath("tree", "cluster_{cluster}", "snp_matrix.csv"),
     output:
         tree=output_dir.joinpath("tree", "cluster_{cluster}", "newick_tree.txt"),
-    container:
-        "docker://andersenlab/vcf-kit:20200822175018b7b60d"
-    conda:
-        "../../envs/vcfkit.yaml"
+        dm=output_dir.joinpath("tree", "cluster_{cluster}", "distance_matrix.csv"),
     message:
         "Making tree..."
     log:
         log_dir.joinpath("making_tree_cluster_{cluster}.log"),
-    threads: config["threads"]["vcfkit"]
+    benchmark:
+        log_dir.joinpath("benchmark", "make_tree", "cluster_{cluster}.tsv"),
+    group: CLUSTER_POST_GROUP
+    threads: RESOURCES.threads("make_tree")
     resources:
-        mem_gb=config["mem_gb"]["vcfkit"],
+        mem_gb=RESOURCES.mem_gb("make_tree"),
+        runtime=RESOURCES.runtime("make_tree"),
+    retries: RESOURCES.retries
     params:
-        cluster="{cluster}",
         algorithm=config["tree"]["algorithm"],
     shell:
         """
-vk phylo tree {params.algorithm} {input}/cluster_{params.cluster}.vcf > {output.tree} 2> {log}
+python bin/make_tree.py -i {input} -a {params.algorithm} -o {output.tree} -d {output.dm} &> {log}
         """
 
 
+def get_ml_tree_start(wildcards):
+    if config["ml_tree"]["mode"] != "incremental":
+        return {}
+    return {
+        "start": output_dir.joinpath("ml_tree", f"start_cluster_{wildcards.cluster}")
+    }
+
+
+if config["ml_tree"]["mode"] == "incremental":
+
+    rule prepare_ml_tree:
+        input:
+            snippy_dir=output_dir.joinpath(
+                "snp_analysis", "snippy-core", "cluster_{cluster}"
+            ),
+            snp_matrix=output_dir.joinpath(
+                "tree", "cluster_{cluster}", "snp_matrix.csv"
+            ),
+            ref_fasta=output_dir.joinpath(
+                "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+            ),
+        output:
+            temp(directory(output_dir.joinpath("ml_tree", "start_cluster_{cluster}"))),
+        message:
+            "Looking for a model and tree of a previous run to start from."
+        log:
+            log_dir.joinpath("prepare_ML_tree_cluster_{cluster}.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "prepare_ml_tree", "cluster_{cluster}.tsv"),
+        group: CLUSTER_CORE_GROUP
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            cluster="{cluster}",
+            cache=config["ml_tree"]["cache"],
+        shell:
+            """
+    python bin/ml_tree_cache.py prepare \
+        --cache {params.cache} \
+        --reference {input.ref_fasta} \
+        --alignment {input.snippy_dir}/cluster_{params.cluster}.aln \
+        --snp-matrix {input.snp_matrix} \
+        --output-dir {output} &> {log}
+            """
+
+# The model and tree are stored for later incremental runs; a refresh run
+# replaces them with those of a search from scratch
+if config["ml_tree"]["mode"] in ["incremental", "refresh"]:
+
+    rule store_ml_tree:
+        input:
+            ml_tree=output_dir.joinpath("ml_tree", "cluster_{cluster}"),
+            snippy_dir=output_dir.joinpath(
+                "snp_analysis", "snippy-core", "cluster_{cluster}"
+            ),
+            ref_fasta=output_dir.joinpath(
+                "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+            ),
+        output:
+            output_dir.joinpath("ml_tree", "stored", "cluster_{cluster}.txt"),
+        message:
+            "Storing the model and tree for later runs."
+        log:
+            log_dir.joinpath("store_ML_tree_cluster_{cluster}.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "store_ml_tree", "cluster_{cluster}.tsv"),
+        group: CLUSTER_POST_GROUP
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            cluster="{cluster}",
+            cache=config["ml_tree"]["cache"],
+        shell:
+            """
+    python bin/ml_tree_cache.py store \
+        --cache {params.cache} \
+        --reference {input.ref_fasta} \
+        --alignment {input.snippy_dir}/cluster_{params.cluster}.aln \
+        --prefix {input.ml_tree}/cluster_{params.cluster} &> {log}
+    touch {output}
+            """
+
+
+def get_nr_sequences(wildcards):
+    """Sequences in the alignment of a cluster (its samples and the reference)"""
+    SELECTED_SAMPLES = CLUSTER_INDEX.samples(
+        checkpoints.preclustering.get(**wildcards).output[0], wildcards.cluster
+    )
+    return len(SELECTED_SAMPLES) + 1
+
+
 rule make_ml_tree:
     input:
+        unpack(get_ml_tree_start),
         snippy_dir=output_dir.joinpath(
             "snp_analysis", "snippy-core", "cluster_{cluster}"
         ),
@@ -63,23 +184,44 @@ rule make_ml_tree:
         "Making ML tree..."
     log:
         log_dir.joinpath("making_ML_tree_cluster_{cluster}.log"),
-    threads: config["threads"]["iqtree"]
+    benchmark:
+        log_dir.joinpath("benchmark", "make_ml_tree", "cluster_{cluster}.tsv"),
+    threads: RESOURCES.threads("iqtree")
     resources:
-        mem_gb=config["mem_gb"]["iqtree"],
+        mem_gb=RESOURCES.mem_gb("iqtree"),
+        runtime=RESOURCES.runtime("iqtree"),
+    retries: RESOURCES.retries
     params:
         cluster="{cluster}",
+        start_dir=lambda wildcards: output_dir.joinpath(
+            "ml_tree", f"start_cluster_{wildcards.cluster}"
+        ),
+        nr_sequences=get_nr_sequences,
     shell:
         """
 mkdir -p {output}
 
-NR_SAMPLES=$(grep -c '>' {input.snippy_dir}/cluster_{params.cluster}.aln)
-if [ $NR_SAMPLES -le 2 ]
+# In incremental mode, the (grafted) tree of a previous run is the starting
+# tree and its model is reused instead of running ModelFinder, unless many
+# taxa are new (see ml_tree_cache.py)
+START_OPTIONS=""
+if [ -f {params.start_dir}/start_tree.nwk ]
+then
+    START_OPTIONS="-t {params.start_dir}/start_tree.nwk"
+fi
+if [ -f {params.start_dir}/model.txt ]
+then
+    START_OPTIONS="$START_OPTIONS -m $(<{params.start_dir}/model.txt)"
+fi
+
+if [ {params.nr_sequences} -le 2 ]
 then
     echo "Not running IQ-tree, does not reach minimal of three samples" > {output}/iqtree_not_started_for_cluster.txt
 else
     iqtree2 \
     -s {input.snippy_dir}/cluster_{params.cluster}.aln \
     -fconst $(<{input.const_sites}) \
+    $START_OPTIONS \
     -nt {threads} \
     --prefix {output}/cluster_{params.cluster} \
     --seed 1 \
@@ -92,49 +234,3 @@ else
     fi
 fi
         """
-
-
-rule get_dm:
-    input:
-        output_dir.joinpath("tree", "cluster_{cluster}", "newick_tree.txt"),
-    output:
-        output_dir.joinpath("tree", "cluster_{cluster}", "distance_matrix.csv"),
-    message:
-        "Getting distance matrix..."
-    log:
-        log_dir.joinpath("get_distance_matrix_cluster_{cluster}.log"),
-    threads: config["threads"]["other"]
-    resources:
-        mem_gb=config["mem_gb"]["other"],
-    params:
-        dm=lambda wildcards: output_dir.joinpath(
-            "tree", f"cluster_{wildcards.cluster}", "distance_matrix.tab"
-        ),
-    shell:
-        """
-python bin/newick2dm.py -i {input} -o {output}
-        """
-
-
-rule get_snp_matrix:
-    input:
-        output_dir.joinpath("snp_analysis", "snippy-core", "cluster_{cluster}"),
-    output:
-        snp_matrix=output_dir.joinpath("tree", "cluster_{cluster}", "snp_matrix.csv"),
-    container:
-        "docker://staphb/snp-dists:0.8.2"
-    conda:
-        "../../envs/snp_dists.yaml"
-    message:
-        "Making SNP matrix"
-    log:
-        log_dir.joinpath("snp_matrix_cluster_{cluster}.log"),
-    threads: config["threads"]["other"]
-    resources:
-        mem_gb=config["mem_gb"]["other"],
-    params:
-        cluster="{cluster}",
-    shell:
-        """
-snp-dists -c {input}/cluster_{params.cluster}.full.aln 1>{output.snp_matrix} 2>{log}
-        """
@@ -7,9 +7,13 @@ rule download_referenceseeker_db:
         "Downloading the bacterial referenceseeker database."
     log:
         log_dir.joinpath("download_referenceseeker_db.log"),
-    threads: config["threads"]["other"]
+    benchmark:
+        log_dir.joinpath("benchmark", "download_referenceseeker_db.tsv"),
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["threads"]["other"],
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
     params:
         url="https://zenodo.org/record/4415843/files/bacteria-refseq.tar.gz",
     shell:
@@ -34,13 +38,17 @@ rule find_reference:
         "Running referenceseeker for sample {wildcards.sample}."
     log:
         log_dir.joinpath("referenceseeker", "{sample}.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "find_reference", "{sample}.tsv"),
     conda:
         "../../envs/reference_seeker_env.yaml"
     container:
         "docker://ghcr.io/boasvdp/referenceseeker:1.8.0"
-    threads: config["threads"]["referenceseeker"]
+    threads: RESOURCES.threads("referenceseeker")
     resources:
-        mem_gb=config["mem_gb"]["referenceseeker"],
+        mem_gb=RESOURCES.mem_gb("referenceseeker"),
+        runtime=RESOURCES.runtime("referenceseeker"),
+    retries: RESOURCES.retries
     params:
         db_referenceseeker=config["referenceseeker"]["db"],
         ani_threshold=config["referenceseeker"]["ani_threshold"],
@@ -57,13 +65,103 @@ referenceseeker --ani {params.ani_threshold} \
         """
 
 
+# In "representatives" mode referenceseeker only runs on a few samples per
+# cluster (the medoid and the samples farthest from it by mash distance), as
+# only one reference per cluster is chosen from the results.
+if config["referenceseeker"]["search"] == "representatives":
+    reference_clustering = output_dir.joinpath(
+        "find_reference", "representatives.yaml"
+    )
+
+    checkpoint select_representatives:
+        input:
+            mash=output_dir.joinpath("preclustering", "mash_distances.tsv"),
+            clustering=output_dir.joinpath("preclustering", "clusters.yaml"),
+        output:
+            reference_clustering,
+        container:
+            "docker://ghcr.io/boasvdp/network_analysis:0.1"
+        message:
+            "Selecting representative samples per cluster for referenceseeker."
+        log:
+            log_dir.joinpath("find_reference", "select_representatives.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "select_representatives.tsv"),
+        conda:
+            "../../envs/preclustering.yaml"
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            representatives=config["referenceseeker"]["representatives"],
+        shell:
+            """
+    python bin/select_representatives.py --input {input.mash} \
+        --clustering-file {input.clustering} --output {output} \
+        --representatives {params.representatives} &> {log}
+            """
+
+else:
+    reference_clustering = output_dir.joinpath("preclustering", "clusters.yaml")
+
+
+def get_referenceseeker_results(wildcards):
+    samples = SAMPLES
+    if config["referenceseeker"]["search"] == "representatives":
+        samples = CLUSTER_INDEX.sample_clusters(
+            checkpoints.select_representatives.get().output[0]
+        )
+    return expand(
+        output_dir.joinpath("find_reference", "referenceseeker_{sample}.tab"),
+        sample=samples,
+    )
+
+
+rule index_referenceseeker:
+    input:
+        get_referenceseeker_results,
+    output:
+        directory(output_dir.joinpath("find_reference", "referenceseeker_index")),
+    container:
+        "docker://ghcr.io/boasvdp/referenceseeker:1.8.0"
+    message:
+        "Collecting referenceseeker results of all samples."
+    log:
+        log_dir.joinpath("find_reference", "index_referenceseeker.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "index_referenceseeker.tsv"),
+    conda:
+        "../../envs/reference_seeker_env.yaml"
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
+    shell:
+        """
+python3 bin/index_referenceseeker.py --input-files {input} --output {output} &> {log}
+        """
+
+
+def get_members_digest(wildcards):
+    return CLUSTER_INDEX.plan(
+        checkpoints.plan_clusters.get().output[0], wildcards.cluster
+    )["digest"]
+
+
+# The index and the clustering are rewritten whenever samples are added, so
+# their modification time is ignored: the reference of a cluster is chosen
+# again only if its samples changed (the digest of its members in the plan,
+# a parameter)
 rule get_best_ref:
     input:
-        referenceseeker=expand(
-            output_dir.joinpath("find_reference", "referenceseeker_{sample}.tab"),
-            sample=SAMPLES,
+        referenceseeker=ancient(
+            output_dir.joinpath("find_reference", "referenceseeker_index")
         ),
-        clustering=output_dir.joinpath("preclustering", "clusters.yaml"),
+        clustering=ancient(reference_clustering),
+        plan=ancient(cluster_plan),
     output:
         ref=output_dir.joinpath(
             "ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"
@@ -74,17 +172,25 @@ rule get_best_ref:
         "Finding best reference genome for dataset."
     log:
         log_dir.joinpath("find_reference", "{cluster}.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "get_best_ref", "cluster_{cluster}.tsv"),
     conda:
         "../../envs/reference_seeker_env.yaml"
-    threads: config["threads"]["other"]
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["mem_gb"]["other"],
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
     params:
         output_dir=lambda wildcards: output_dir.joinpath(
             "ref_genomes_used", f"cluster_{wildcards.cluster}"
         ),
         cluster=lambda wildcards: wildcards.cluster,
+        reference_store=config["reference_store"]["dir"],
+        reference_store_size=config["reference_store"]["max_size_gb"],
+        members=get_members_digest,
     shell:
         """
-python3 bin/find_best_ref.py --input-files {input.referenceseeker} --cluster {params.cluster} --clustering-file {input.clustering} --output {params.output_dir} &> {log}
+python3 bin/find_best_ref.py --index {input.referenceseeker} --cluster {params.cluster} --clustering-file {input.clustering} --output {params.output_dir} \
+    --reference-store {params.reference_store} --reference-store-size {params.reference_store_size} &> {log}
         """
@@ -7,11 +7,15 @@ checkpoint preclustering:
         "Creating mock cluster to force mapping on single reference genome."
     log:
         log_dir.joinpath("mock_clustering.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "preclustering.tsv"),
     conda:
         "../../envs/preclustering.yaml"
-    threads: config["threads"]["other"]
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["mem_gb"]["other"],
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
     params:
         script=srcdir("../../bin/mock_cluster.py"),
     shell:
@@ -1,75 +1,340 @@
-rule sketch_genomes:
+# Mash sketches are made per sample and stored in a content-addressed cache
+# (assembly checksum, k-mer length and sketch size), so unchanged assemblies
+# are never sketched again. The sketches needed for this run are then merged.
+sketch_cache = Path(config["mash"]["sketch_cache"]).joinpath(
+    f"k{config['mash']['kmer_length']}_s{config['mash']['sketch_size']}"
+)
+
+if config["precluster_state"] == "None":
+    SKETCH_SAMPLES = list(SAMPLES)
+    merged_sketches = output_dir.joinpath("preclustering", "mash_sketches.msh")
+else:
+    # Incremental preclustering: only the samples that are not yet in the
+    # persisted state are sketched and compared (new vs. existing and new vs.
+    # new). The state is updated once the pre-clusters have been defined.
+    # Samples of a pre-cluster that lost samples since the state was written
+    # are compared again as well (preclustering.py drops that pre-cluster
+    # from the state), as it may have been connected only through them.
+    # A state made with another k-mer length or sketch size is not used, so
+    # the run is then a full run. See precluster_state.py for the layout.
+    precluster_state_dir = Path(config["precluster_state"])
+    precluster_state_current = precluster_state_dir.joinpath("current").resolve()
+    precluster_state_yaml = precluster_state_current.joinpath("precluster_state.yaml")
+    precluster_state_sketches = precluster_state_current.joinpath("mash_sketches.msh")
+    KNOWN_SAMPLES = known_samples(
+        precluster_state_current,
+        config["mash"]["kmer_length"],
+        config["mash"]["sketch_size"],
+    )
+    SKETCH_SAMPLES = samples_to_sketch(SAMPLES, KNOWN_SAMPLES)
+    merged_sketches = output_dir.joinpath("preclustering", "new_mash_sketches.msh")
+
+
+rule sketch_genome:
     input:
-        [SAMPLES[sample]["assembly"] for sample in SAMPLES],
+        lambda wildcards: SAMPLES[wildcards.sample]["assembly"],
     output:
-        output_dir.joinpath("preclustering", "mash_sketches.msh"),
+        output_dir.joinpath("preclustering", "sketches", "{sample}.msh"),
     message:
-        "Sketching genome of using mash."
+        "Sketching genome of {wildcards.sample} using mash."
     container:
         "docker://staphb/mash:2.3"
     log:
-        log_dir.joinpath("sketch_genomes.log"),
+        log_dir.joinpath("sketch_genomes", "{sample}.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "sketch_genome", "{sample}.tsv"),
     conda:
         "../../envs/mash.yaml"
-    threads: config["threads"]["mash"]
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["mem_gb"]["mash"],
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
     params:
         kmer_length=config["mash"]["kmer_length"],
         sketch_size=config["mash"]["sketch_size"],
+        cache_dir=sketch_cache,
     shell:
         """
-mash sketch -p {threads} -k {params.kmer_length} -s {params.sketch_size} -o {output} {input} 2>{log}
+CHECKSUM=$(sha256sum {input} | cut -d ' ' -f 1)
+CACHED={params.cache_dir}/${{CHECKSUM:0:2}}/${{CHECKSUM}}_{wildcards.sample}.msh
+if [ -s "${{CACHED}}" ]
+then
+    echo "Using cached sketch ${{CACHED}}" > {log}
+    cp "${{CACHED}}" {output}
+else
+    mash sketch -k {params.kmer_length} -s {params.sketch_size} -o {output} {input} 2>{log}
+    mkdir -p $(dirname "${{CACHED}}")
+    cp {output} "${{CACHED}}.tmp.$$"
+    mv "${{CACHED}}.tmp.$$" "${{CACHED}}"
+fi
         """
 
 
-rule calculate_mash_distances:
+localrules:
+    list_sketches,
+
+
+rule list_sketches:
     input:
-        output_dir.joinpath("preclustering", "mash_sketches.msh"),
+        expand(
+            output_dir.joinpath("preclustering", "sketches", "{sample}.msh"),
+            sample=SKETCH_SAMPLES,
+        ),
     output:
-        output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        temp(output_dir.joinpath("preclustering", "sketches.txt")),
     message:
-        "Calculating distances for all sketches using mash."
-    container:
-        "docker://staphb/mash:2.3"
-    log:
-        log_dir.joinpath("calculate_mash_distances.log"),
-    conda:
-        "../../envs/mash.yaml"
-    threads: config["threads"]["mash"]
+        "Listing mash sketches to merge."
+    benchmark:
+        log_dir.joinpath("benchmark", "list_sketches.tsv"),
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["mem_gb"]["mash"],
-    params:
-        kmer_length=config["mash"]["kmer_length"],
-        sketch_size=config["mash"]["sketch_size"],
-    shell:
-        """
-mash dist -p {threads} {input} {input} > {output} 2>{log}
-        """
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
+    run:
+        with open(output[0], "w") as file:
+            file.writelines(f"{sketch}\n" for sketch in input)
 
 
-checkpoint preclustering:
+rule sketch_genomes:
     input:
-        output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        output_dir.joinpath("preclustering", "sketches.txt"),
     output:
-        yaml=output_dir.joinpath("preclustering", "clusters.yaml"),
-        plot_dir=directory(output_dir.joinpath("preclustering", "plots")),
-    container:
-        "docker://ghcr.io/boasvdp/network_analysis:0.1"
+        merged_sketches,
     message:
-        "Defining pre-clusters based on mash distances."
+        "Merging mash sketches."
+    container:
+        "docker://staphb/mash:2.3"
     log:
-        log_dir.joinpath("preclustering.log"),
+        log_dir.joinpath("sketch_genomes.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "sketch_genomes.tsv"),
     conda:
-        "../../envs/preclustering.yaml"
-    threads: config["threads"]["other"]
+        "../../envs/mash.yaml"
+    threads: RESOURCES.threads("mash")
     resources:
-        mem_gb=config["mem_gb"]["other"],
-    params:
-        mash_threshold=config["mash"]["threshold"],
-        script=srcdir("../../bin/preclustering.py"),
+        mem_gb=RESOURCES.mem_gb("mash"),
+        runtime=RESOURCES.runtime("mash"),
+    retries: RESOURCES.retries
     shell:
         """
-python {params.script} --input {input} --threshold {params.mash_threshold} \
-    --output {output.yaml} --plot-output {output.plot_dir} 2>&1>{log}
+if [ ! -s {input} ]
+then
+    echo "No new samples to sketch" > {log}
+    touch {output}
+else
+    mash paste -l {output} {input} 2>{log}
+fi
         """
+
+
+if config["precluster_state"] == "None":
+
+    rule calculate_mash_distances:
+        input:
+            merged_sketches,
+        output:
+            output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        message:
+            "Calculating distances for all sketches using mash."
+        container:
+            "docker://staphb/mash:2.3"
+        log:
+            log_dir.joinpath("calculate_mash_distances.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "calculate_mash_distances.tsv"),
+        conda:
+            "../../envs/mash.yaml"
+        threads: RESOURCES.threads("mash")
+        resources:
+            mem_gb=RESOURCES.mem_gb("mash"),
+            runtime=RESOURCES.runtime("mash"),
+        retries: RESOURCES.retries
+        params:
+            kmer_length=config["mash"]["kmer_length"],
+            sketch_size=config["mash"]["sketch_size"],
+        shell:
+            """
+    mash dist -p {threads} {input} {input} > {output} 2>{log}
+            """
+
+    checkpoint preclustering:
+        input:
+            output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        output:
+            yaml=output_dir.joinpath("preclustering", "clusters.yaml"),
+            plot_dir=directory(output_dir.joinpath("preclustering", "plots")),
+        container:
+            "docker://ghcr.io/boasvdp/network_analysis:0.1"
+        message:
+            "Defining pre-clusters based on mash distances."
+        log:
+            log_dir.joinpath("preclustering.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "preclustering.tsv"),
+        conda:
+            "../../envs/preclustering.yaml"
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            mash_threshold=config["mash"]["threshold"],
+            script=srcdir("../../bin/preclustering.py"),
+            manifest=run_manifest,
+        shell:
+            """
+    python {params.script} --input {input} --threshold {params.mash_threshold} \
+        --output {output.yaml} --plot-output {output.plot_dir} \
+        --manifest {params.manifest} 2>&1>{log}
+            """
+
+else:
+
+    rule calculate_mash_distances:
+        input:
+            merged_sketches,
+        output:
+            output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        message:
+            "Calculating distances of new sketches using mash."
+        container:
+            "docker://staphb/mash:2.3"
+        log:
+            log_dir.joinpath("calculate_mash_distances.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "calculate_mash_distances.tsv"),
+        conda:
+            "../../envs/mash.yaml"
+        threads: RESOURCES.threads("mash")
+        resources:
+            mem_gb=RESOURCES.mem_gb("mash"),
+            runtime=RESOURCES.runtime("mash"),
+        retries: RESOURCES.retries
+        params:
+            known_sketches=precluster_state_sketches if KNOWN_SAMPLES else "None",
+        shell:
+            """
+    touch {output}
+    if [ -s {input} ]
+    then
+        mash dist -p {threads} {input} {input} >> {output} 2>{log}
+        if [ -s {params.known_sketches} ]
+        then
+            mash dist -p {threads} {params.known_sketches} {input} >> {output} 2>>{log}
+        fi
+    fi
+            """
+
+    checkpoint preclustering:
+        input:
+            output_dir.joinpath("preclustering", "mash_distances.tsv"),
+        output:
+            yaml=output_dir.joinpath("preclustering", "clusters.yaml"),
+            plot_dir=directory(output_dir.joinpath("preclustering", "plots")),
+            state=output_dir.joinpath("preclustering", "precluster_state.yaml"),
+        container:
+            "docker://ghcr.io/boasvdp/network_analysis:0.1"
+        message:
+            "Updating pre-clusters with the mash distances of new samples."
+        log:
+            log_dir.joinpath("preclustering.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "preclustering.tsv"),
+        conda:
+            "../../envs/preclustering.yaml"
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            mash_threshold=config["mash"]["threshold"],
+            script=srcdir("../../bin/preclustering.py"),
+            state=precluster_state_yaml,
+            kmer_length=config["mash"]["kmer_length"],
+            sketch_size=config["mash"]["sketch_size"],
+            sample_sheet=sample_sheet,
+            manifest=run_manifest,
+        shell:
+            """
+    python {params.script} --input {input} --threshold {params.mash_threshold} \
+        --output {output.yaml} --plot-output {output.plot_dir} \
+        --state-input {params.state} --state-output {output.state} \
+        --kmer-length {params.kmer_length} --sketch-size {params.sketch_size} \
+        --sample-sheet {params.sample_sheet} --manifest {params.manifest} 2>&1>{log}
+            """
+
+    localrules:
+        prepare_precluster_state,
+
+    rule prepare_precluster_state:
+        input:
+            state=output_dir.joinpath("preclustering", "precluster_state.yaml"),
+            sketches=expand(
+                output_dir.joinpath("preclustering", "sketches", "{sample}.msh"),
+                sample=SKETCH_SAMPLES,
+            ),
+        output:
+            temp(output_dir.joinpath("preclustering", "new_precluster_state.txt")),
+        message:
+            "Collecting the sketches of the samples of this run for the preclustering state."
+        benchmark:
+            log_dir.joinpath("benchmark", "prepare_precluster_state.tsv"),
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        run:
+            new_state = prepare_state(
+                precluster_state_dir,
+                precluster_state_current,
+                input.state,
+                dict(zip(SKETCH_SAMPLES, input.sketches)),
+                list(SAMPLES),
+            )
+            with open(output[0], "w") as file:
+                file.write(f"{new_state}\n")
+
+    rule update_precluster_state:
+        input:
+            output_dir.joinpath("preclustering", "new_precluster_state.txt"),
+        output:
+            output_dir.joinpath("preclustering", "precluster_state_updated.txt"),
+        message:
+            "Storing the sketches and pre-clusters of this run as the preclustering state."
+        container:
+            "docker://staphb/mash:2.3"
+        log:
+            log_dir.joinpath("update_precluster_state.log"),
+        benchmark:
+            log_dir.joinpath("benchmark", "update_precluster_state.tsv"),
+        conda:
+            "../../envs/mash.yaml"
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            state_dir=precluster_state_dir,
+        shell:
+            """
+    NEW_STATE=$(cat {input})
+    if [ -s $NEW_STATE/sketch_list.txt ]
+    then
+        mash paste -l $NEW_STATE/mash_sketches.msh $NEW_STATE/sketch_list.txt 2>{log}
+    fi
+    # Replacing the link is atomic
+    PREVIOUS=$(readlink {params.state_dir}/current || true)
+    ln -s $(basename $NEW_STATE) $NEW_STATE.link
+    mv -T $NEW_STATE.link {params.state_dir}/current
+    if [ -n "$PREVIOUS" ]
+    then
+        rm -rf {params.state_dir}/$PREVIOUS
+    fi
+    echo "Preclustering state updated in $NEW_STATE" > {output}
+            """
@@ -0,0 +1,57 @@
+from snakemake.logging import logger
+
+
+localrules:
+    profile_patterns,
+    profile_report,
+
+
+rule profile_patterns:
+    output:
+        log_dir.joinpath("benchmark", "patterns.json"),
+    message:
+        "Listing the benchmark files of the rules."
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    run:
+        patterns = {
+            rule_.name: str(rule_.benchmark)
+            for rule_ in workflow.rules
+            if rule_.benchmark is not None
+        }
+        with open(output[0], "w") as file:
+            json.dump(patterns, file, indent=2)
+
+
+rule profile_report:
+    input:
+        patterns=log_dir.joinpath("benchmark", "patterns.json"),
+        results=get_output_per_cluster,
+    output:
+        directory(output_dir.joinpath("profile")),
+    message:
+        "Making the performance report of the run."
+    log:
+        log_dir.joinpath("profile_report.log"),
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    params:
+        # Changes every run, so the report is made again for every run
+        run_start=RUN_START,
+        clusters_file=RESOURCES.clusters_file,
+        # Inputs and outputs of the jobs (as printed by Snakemake)
+        run_log=logger.get_logfile(),
+    shell:
+        """
+python bin/profile_report.py \
+    --patterns {input.patterns} \
+    --log {params.run_log} \
+    --run-start {params.run_start} \
+    --clustering-file {params.clusters_file} \
+    --output-dir {output_dir} \
+    --output {output} &> {log}
+        """
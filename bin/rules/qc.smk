@@ -1,10 +1,7 @@
-def return_filter_status_per_cluster(cluster):
-    with open(checkpoints.preclustering.get(**cluster).output[0]) as file:
-        SAMPLE_CLUSTERS = yaml.safe_load(file)
-    SELECTED_SAMPLES = []
-    for sample, sample_cluster in SAMPLE_CLUSTERS.items():
-        if str(sample_cluster) == str(cluster):
-            SELECTED_SAMPLES.append(sample)
+def return_filter_status_per_cluster(wildcards):
+    SELECTED_SAMPLES = CLUSTER_INDEX.samples(
+        checkpoints.preclustering.get(**wildcards).output[0], wildcards.cluster
+    )
     return expand(
         output_dir.joinpath(
             "qc",
@@ -17,169 +14,23 @@ def return_filter_status_per_cluster(cluster):
     )
 
 
-def return_multiqc_per_cluster(cluster):
-    with open(checkpoints.preclustering.get(**cluster).output[0]) as file:
-        SAMPLE_CLUSTERS = yaml.safe_load(file)
-    SELECTED_SAMPLES = []
-    for sample, sample_cluster in SAMPLE_CLUSTERS.items():
-        if str(sample_cluster) == str(cluster):
-            SELECTED_SAMPLES.append(sample)
-    return (
-        expand(
-            output_dir.joinpath(
-                "qc", "cluster_{cluster}", "insertsize", "{sample}_metrics.txt"
-            ),
-            sample=SELECTED_SAMPLES,
-            allow_missing=True,
-        )
-        + expand(
-            output_dir.joinpath(
-                "qc",
-                "cluster_{cluster}",
-                "CollectAlignmentSummaryMetrics",
-                "{sample}.txt",
-            ),
-            sample=SELECTED_SAMPLES,
-            allow_missing=True,
-        )
-        + expand(
-            output_dir.joinpath(
-                "qc", "cluster_{cluster}", "CollectWgsMetrics", "{sample}.txt"
-            ),
-            sample=SELECTED_SAMPLES,
-            allow_missing=True,
-        )
-        + expand(
-            output_dir.joinpath(
-                "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}.txt"
-            ),
-            sample=SELECTED_SAMPLES,
-            allow_missing=True,
-        )
+def return_multiqc_per_cluster(wildcards):
+    SELECTED_SAMPLES = CLUSTER_INDEX.samples(
+        checkpoints.preclustering.get(**wildcards).output[0], wildcards.cluster
     )
-
-
-rule picard_CollectInsertSizeMetrics:
-    input:
-        bam=output_dir.joinpath(
-            "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}.bam"
-        ),
-    output:
-        txt=output_dir.joinpath(
-            "qc", "cluster_{cluster}", "insertsize", "{sample}_metrics.txt"
-        ),
-        pdf=output_dir.joinpath(
-            "qc", "cluster_{cluster}", "insertsize", "{sample}_report.pdf"
-        ),
-    message:
-        "Calculating insert size for {wildcards.sample}"
-    conda:
-        "../../envs/gatk_picard.yaml"
-    container:
-        "docker://broadinstitute/picard:2.27.5"
-    log:
-        log_dir.joinpath("get_insert_size", "cluster_{cluster}", "{sample}.log"),
-    params:
-        use_singularity=config["use_singularity"],
-    threads: config["threads"]["picard"]
-    resources:
-        mem_gb=config["mem_gb"]["picard"],
-    shell:
-        """
-if [ {params.use_singularity} == True ]
-then
-    EXEC=\"java -jar /usr/picard/picard.jar\"
-else
-    EXEC=picard
-fi
-
-$EXEC CollectInsertSizeMetrics \
--I {input.bam} \
--O {output.txt} \
--H {output.pdf} \
---VALIDATION_STRINGENCY LENIENT 2>&1>{log}
-        """
-
-
-rule picard_CollectAlignmentSummaryMetrics:
-    input:
-        bam=output_dir.joinpath(
-            "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}.bam"
-        ),
-        ref=output_dir.joinpath("ref_genomes_used/cluster_{cluster}/ref_genome.fasta"),
-    output:
-        txt=output_dir.joinpath(
-            "qc",
-            "cluster_{cluster}",
-            "CollectAlignmentSummaryMetrics",
-            "{sample}.txt",
-        ),
-    conda:
-        "../../envs/gatk_picard.yaml"
-    container:
-        "docker://broadinstitute/picard:2.27.5"
-    log:
-        log_dir.joinpath(
-            "CollectAlignmentSummaryMetrics", "cluster_{cluster}", "{sample}.log"
-        ),
-    params:
-        use_singularity=config["use_singularity"],
-    threads: config["threads"]["picard"]
-    resources:
-        mem_gb=config["mem_gb"]["picard"],
-    shell:
-        """
-if [ {params.use_singularity} == True ]
-then
-    EXEC=\"java -jar /usr/picard/picard.jar\"
-else
-    EXEC=picard
-fi
-
-$EXEC CollectAlignmentSummaryMetrics \
--I {input.bam} \
--R {input.ref} \
--O {output} \
---VALIDATION_STRINGENCY LENIENT 2>&1>{log}
-        """
-
-
-rule picard_CollectWgsMetrics:
-    input:
-        bam=output_dir.joinpath(
-            "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}.bam"
+    return expand(
+        output_dir.joinpath(
+            "qc", "cluster_{cluster}", "samtools_stats", "{sample}.txt"
         ),
-        ref=output_dir.joinpath("ref_genomes_used/cluster_{cluster}/ref_genome.fasta"),
-    output:
-        txt=output_dir.joinpath(
-            "qc", "cluster_{cluster}", "CollectWgsMetrics", "{sample}.txt"
+        sample=SELECTED_SAMPLES,
+        allow_missing=True,
+    ) + expand(
+        output_dir.joinpath(
+            "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}.txt"
         ),
-    conda:
-        "../../envs/gatk_picard.yaml"
-    container:
-        "docker://broadinstitute/picard:2.27.5"
-    log:
-        log_dir.joinpath("CollectWgsMetrics", "cluster_{cluster}", "{sample}.log"),
-    params:
-        use_singularity=config["use_singularity"],
-    threads: config["threads"]["picard"]
-    resources:
-        mem_gb=config["mem_gb"]["picard"],
-    shell:
-        """
-if [ {params.use_singularity} == True ]
-then
-    EXEC=\"java -jar /usr/picard/picard.jar\"
-else
-    EXEC=picard
-fi
-
-$EXEC CollectWgsMetrics \
--I {input.bam} \
--R {input.ref} \
--O {output} \
---VALIDATION_STRINGENCY LENIENT 2>&1>{log}
-        """
+        sample=SELECTED_SAMPLES,
+        allow_missing=True,
+    )
 
 
 rule multiqc:
@@ -196,13 +47,18 @@ rule multiqc:
         "../../envs/multiqc.yaml"
     container:
         "docker://quay.io/biocontainers/multiqc:1.19--pyhdfd78af_0"
-    threads: config["threads"]["multiqc"]
+    threads: RESOURCES.threads("multiqc")
     resources:
-        mem_gb=config["mem_gb"]["multiqc"],
+        mem_gb=RESOURCES.mem_gb("multiqc"),
+        runtime=RESOURCES.runtime("multiqc"),
+    retries: RESOURCES.retries
     params:
         config_file="config/multiqc_config.yaml",
     log:
         log_dir.joinpath("multiqc", "cluster_{cluster}", "multiqc.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "multiqc", "cluster_{cluster}.tsv"),
+    group: CLUSTER_POST_GROUP
     shell:
         """
 DIRNAME=$(dirname {output})
@@ -0,0 +1,63 @@
+# Compares the clusters with those of the manifest of the previous run: new,
+# changed or unchanged, with the digest of the samples of every cluster
+checkpoint plan_clusters:
+    input:
+        lambda wildcards: checkpoints.preclustering.get().output[0],
+    output:
+        cluster_plan,
+    message:
+        "Comparing the clusters with those of the previous run."
+    log:
+        log_dir.joinpath("plan_clusters.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "plan_clusters.tsv"),
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
+    params:
+        manifest=run_manifest,
+        sample_sheet=sample_sheet,
+    shell:
+        """
+python bin/run_manifest.py plan --clustering-file {input} \
+    --sample-sheet {params.sample_sheet} --manifest {params.manifest} \
+    --output {output} &> {log}
+        """
+
+
+def get_cluster_references(wildcards):
+    CLUSTERS = CLUSTER_INDEX.clusters(checkpoints.preclustering.get().output[0])
+    return expand(
+        output_dir.joinpath("ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"),
+        cluster=CLUSTERS,
+    )
+
+
+# The manifest is only written once all results of the run exist, so a failed
+# run is compared again with the last complete one
+rule update_run_manifest:
+    input:
+        clustering=lambda wildcards: checkpoints.preclustering.get().output[0],
+        plan=cluster_plan,
+        references=get_cluster_references,
+        results=get_results_per_cluster,
+    output:
+        run_manifest,
+    message:
+        "Writing the manifest of the clusters of this run."
+    log:
+        log_dir.joinpath("update_run_manifest.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "update_run_manifest.tsv"),
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
+    shell:
+        """
+python bin/run_manifest.py update --clustering-file {input.clustering} \
+    --plan {input.plan} --output-dir {output_dir} --output {output} &> {log}
+        """
@@ -1,13 +1,37 @@
-import yaml
+def get_all_mapped(wildcards):
+    SAMPLE_CLUSTERS = CLUSTER_INDEX.sample_clusters(
+        checkpoints.preclustering.get().output[0]
+    )
+    return [
+        output_dir.joinpath(
+            "snp_analysis", f"cluster_{sample_cluster}", sample, f"{sample}.txt"
+        )
+        for sample, sample_cluster in SAMPLE_CLUSTERS.items()
+    ]
+
+
+def get_reads_for_mapping(wildcards):
+    if config["max_coverage"] == "None":
+        return {
+            "r1": SAMPLES[wildcards.sample]["R1"],
+            "r2": SAMPLES[wildcards.sample]["R2"],
+        }
+    return {
+        "r1": subsampled_reads_dir.joinpath(
+            f"cluster_{wildcards.cluster}",
+            f"{wildcards.sample}_R1.fastq.gz",
+        ),
+        "r2": subsampled_reads_dir.joinpath(
+            f"cluster_{wildcards.cluster}",
+            f"{wildcards.sample}_R2.fastq.gz",
+        ),
+    }
 
 
-def get_mapped_per_cluster(cluster):
-    with open(checkpoints.preclustering.get(**cluster).output[0]) as file:
-        SAMPLE_CLUSTERS = yaml.safe_load(file)
-    SELECTED_SAMPLES = []
-    for sample, sample_cluster in SAMPLE_CLUSTERS.items():
-        if str(sample_cluster) == str(cluster):
-            SELECTED_SAMPLES.append(sample)
+def get_mapped_per_cluster(wildcards):
+    SELECTED_SAMPLES = CLUSTER_INDEX.samples(
+        checkpoints.preclustering.get(**wildcards).output[0], wildcards.cluster
+    )
     return expand(
         output_dir.joinpath("snp_analysis", "cluster_{cluster}", "{sample}"),
         sample=SELECTED_SAMPLES,
@@ -15,35 +39,228 @@ def get_mapped_per_cluster(cluster):
     )
 
 
+def get_mapping_cache_key(wildcards):
+    if config["mapping_cache"] == "None":
+        return {}
+    return {
+        "cache_key": output_dir.joinpath(
+            "snp_analysis",
+            "cache_keys",
+            f"cluster_{wildcards.cluster}",
+            f"{wildcards.sample}.txt",
+        )
+    }
+
+
+# Settings of snippy and of the mapping steps copied from it (see the
+# snp_analysis rule). With the subsampling they are part of the key of the
+# mapping cache.
+SNIPPY_SETTINGS = {
+    "mincov": 10,
+    "minfrac": 0.9,
+    "minqual": 100,
+    "mapqual": 60,
+    "basequal": 13,
+    "maxsoft": "x",
+    "report": config["snippy"]["report"],
+    "samclip_maxsoft": 10,
+    "snippy_version": "4.6.0",
+}
+SUBSAMPLE_SEED = 1
+# With grouped jobs the BAM stays in the scratch directory of the node (its
+# QC runs in the same job)
+MAPPING_OUTPUTS = [".vcf", ".filt.vcf", ".aligned.fa", ".txt"]
+if not config["group_jobs"]:
+    MAPPING_OUTPUTS = [".bam"] + MAPPING_OUTPUTS
+# With grouped jobs and a scratch directory the subsampled reads are written
+# there (under the path of the output directory, so runs do not collide).
+# subsample_reads and snp_analysis run in the same job on the node, which
+# removes the reads once they are mapped.
+subsampled_reads_dir = output_dir.joinpath("subsampled_reads")
+if config["group_jobs"] and config["scratch_dir"] != "None":
+    subsampled_reads_dir = Path(config["scratch_dir"]).joinpath(
+        *output_dir.resolve().parts[1:], "subsampled_reads"
+    )
+
+
 rule make_fasta_ref:
     input:
         output_dir.joinpath("ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"),
     output:
-        output_dir.joinpath("ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"),
+        fasta=output_dir.joinpath(
+            "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+        ),
+        index=multiext(
+            str(
+                output_dir.joinpath(
+                    "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+                )
+            ),
+            ".fai",
+            ".amb",
+            ".ann",
+            ".bwt",
+            ".pac",
+            ".sa",
+        ),
+        dict=output_dir.joinpath(
+            "ref_genomes_used", "cluster_{cluster}", "ref_genome.dict"
+        ),
     message:
-        "Converting reference genome to fasta format."
+        "Converting reference genome to fasta format and indexing it."
     log:
         log_dir.joinpath("make_fasta_ref", "cluster_{cluster}.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "make_fasta_ref", "cluster_{cluster}.tsv"),
+    group: CLUSTER_PREP_GROUP
     container:
         "docker://staphb/snippy:4.6.0-SC2"
     conda:
         "../../envs/snippy.yaml"
-    threads: config["threads"]["other"]
+    threads: RESOURCES.threads("other")
     resources:
-        mem_gb=config["mem_gb"]["other"],
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
     shell:
         """
-any2fasta {input} > {output} 2>{log}
+any2fasta {input} > {output.fasta} 2>{log}
+samtools faidx {output.fasta} 2>>{log}
+samtools dict {output.fasta} -o {output.dict} 2>>{log}
+bwa index {output.fasta} 2>>{log}
         """
 
 
-rule snp_analysis:
+if config["mapping_cache"] != "None":
+
+    rule mapping_cache_key:
+        input:
+            r1=lambda wildcards: SAMPLES[wildcards.sample]["R1"],
+            r2=lambda wildcards: SAMPLES[wildcards.sample]["R2"],
+            ref=output_dir.joinpath(
+                "ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"
+            ),
+        output:
+            temp(
+                output_dir.joinpath(
+                    "snp_analysis", "cache_keys", "cluster_{cluster}", "{sample}.txt"
+                )
+            ),
+        message:
+            "Computing the mapping cache key of sample {wildcards.sample}."
+        log:
+            log_dir.joinpath(
+                "snp_analysis", "cluster_{cluster}", "cache_key_{sample}.log"
+            ),
+        benchmark:
+            log_dir.joinpath(
+                "benchmark", "mapping_cache_key", "cluster_{cluster}", "{sample}.tsv"
+            ),
+        group: SAMPLE_GROUP
+        threads: RESOURCES.threads("other")
+        resources:
+            mem_gb=RESOURCES.mem_gb("other"),
+            runtime=RESOURCES.runtime("other"),
+        retries: RESOURCES.retries
+        params:
+            sample="{sample}",
+            max_coverage=config["max_coverage"],
+            seed=SUBSAMPLE_SEED,
+            settings=" ".join(f"{key}={value}" for key, value in SNIPPY_SETTINGS.items()),
+            # Grouped jobs do not keep the BAM
+            group_jobs=config["group_jobs"],
+        shell:
+            """
+    # Results are cached by the content of the original reads and the
+    # reference, the subsampling, the snippy settings and whether the BAM is
+    # kept, so the cache is checked before the reads are subsampled
+    (sha256sum {input.r1} {input.r2} {input.ref} | cut -d ' ' -f 1
+        echo "{params.sample} {params.max_coverage} {params.seed} {params.settings} {params.group_jobs}") \
+        | sha256sum | cut -d ' ' -f 1 > {output} 2> {log}
+            """
+
+
+rule subsample_reads:
     input:
+        unpack(get_mapping_cache_key),
         r1=lambda wildcards: SAMPLES[wildcards.sample]["R1"],
         r2=lambda wildcards: SAMPLES[wildcards.sample]["R2"],
+        ref=output_dir.joinpath(
+            "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+        ),
+    output:
+        r1=temp(
+            subsampled_reads_dir.joinpath("cluster_{cluster}", "{sample}_R1.fastq.gz")
+        ),
+        r2=temp(
+            subsampled_reads_dir.joinpath("cluster_{cluster}", "{sample}_R2.fastq.gz")
+        ),
+    message:
+        "Subsampling reads of sample {wildcards.sample} to a maximum coverage."
+    log:
+        log_dir.joinpath(
+            "snp_analysis", "cluster_{cluster}", "subsample_{sample}.log"
+        ),
+    benchmark:
+        log_dir.joinpath(
+            "benchmark", "subsample_reads", "cluster_{cluster}", "{sample}.tsv"
+        ),
+    group: SAMPLE_GROUP
+    threads: RESOURCES.threads("subsample")
+    resources:
+        mem_gb=RESOURCES.mem_gb("subsample"),
+        runtime=RESOURCES.runtime("subsample"),
+    retries: RESOURCES.retries
+    params:
+        max_coverage=config["max_coverage"],
+        seed=SUBSAMPLE_SEED,
+        cache_dir=config["mapping_cache"],
+        cache_key=lambda wildcards, input: input.get("cache_key", "None"),
+    shell:
+        """
+# The reads of samples with results in the mapping cache are not needed
+CACHE_KEY=""
+if [ "{params.cache_key}" != "None" ]
+then
+    CACHE_KEY=$(cat {params.cache_key})
+fi
+if [ -n "$CACHE_KEY" ] && [ -f "{params.cache_dir}/$CACHE_KEY/complete" ]
+then
+    echo "Results of {wildcards.sample} found in {params.cache_dir}/$CACHE_KEY, not subsampling" > {log}
+    touch "{params.cache_dir}/$CACHE_KEY/last_used"
+    touch {output.r1} {output.r2}
+else
+    python bin/subsample_reads.py --r1 {input.r1} --r2 {input.r2} \
+        --reference {input.ref} --max-coverage {params.max_coverage} \
+        --out-r1 {output.r1} --out-r2 {output.r2} \
+        --seed {params.seed} --threads {threads} &> {log}
+fi
+        """
+
+
+rule snp_analysis:
+    input:
+        unpack(get_reads_for_mapping),
+        unpack(get_mapping_cache_key),
         ref=output_dir.joinpath(
             "ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"
         ),
+        ref_fasta=output_dir.joinpath(
+            "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+        ),
+        ref_index=multiext(
+            str(
+                output_dir.joinpath(
+                    "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
+                )
+            ),
+            ".fai",
+            ".amb",
+            ".ann",
+            ".bwt",
+            ".pac",
+            ".sa",
+        ),
     output:
         multiext(
             str(
@@ -51,45 +268,137 @@ rule snp_analysis:
                     "snp_analysis", "cluster_{cluster}", "{sample}", "{sample}"
                 )
             ),
-            ".bam",
-            ".vcf",
-            ".filt.vcf",
-            ".aligned.fa",
-            ".txt",
+            *MAPPING_OUTPUTS,
         ),
         res=directory(
             output_dir.joinpath("snp_analysis", "cluster_{cluster}", "{sample}")
         ),
+        stats=output_dir.joinpath(
+            "qc", "cluster_{cluster}", "samtools_stats", "{sample}.txt"
+        ),
     message:
-        "Running snippy on sample {wildcards.sample}."
+        "Running snippy and BAM QC on sample {wildcards.sample}."
     log:
         log_dir.joinpath("snp_analysis", "cluster_{cluster}", "snippy_{sample}.log"),
+    benchmark:
+        log_dir.joinpath(
+            "benchmark", "snp_analysis", "cluster_{cluster}", "{sample}.tsv"
+        ),
+    group: SAMPLE_GROUP
     container:
         "docker://staphb/snippy:4.6.0-SC2"
     conda:
         "../../envs/snippy.yaml"
-    threads: config["threads"]["snippy"]
+    threads: RESOURCES.threads("snippy")
     resources:
-        mem_gb=config["mem_gb"]["snippy"],
+        mem_gb=RESOURCES.mem_gb("snippy"),
+        runtime=RESOURCES.runtime("snippy"),
+    retries: RESOURCES.retries
     params:
-        mincov=10,
-        minfrac=0.9,
-        minqual=100,
-        mapqual=60,
-        basequal=13,
-        maxsoft="x",
+        **SNIPPY_SETTINGS,
         sample="{sample}",
-        report=config["snippy"]["report"],
+        cache_dir=config["mapping_cache"],
+        cache_key=lambda wildcards, input: input.get("cache_key", "None"),
+        scratch_dir=config["scratch_dir"],
+        group_jobs=config["group_jobs"],
     shell:
         """
+# Unchanged samples are not mapped again (see mapping_cache_key)
+CACHE_KEY=""
+if [ "{params.cache_key}" != "None" ]
+then
+    CACHE_KEY=$(cat {params.cache_key})
+    if [ -f "{params.cache_dir}/$CACHE_KEY/complete" ]
+    then
+        echo "Restoring results from {params.cache_dir}/$CACHE_KEY" > {log}
+        mkdir -p {output.res} $(dirname {output.stats})
+        cp -r "{params.cache_dir}/$CACHE_KEY/{params.sample}/." {output.res}/
+        cp "{params.cache_dir}/$CACHE_KEY/samtools_stats.txt" {output.stats}
+        touch "{params.cache_dir}/$CACHE_KEY/last_used"
+        exit 0
+    fi
+    if [ ! -s {input.r1} ]
+    then
+        echo "The results of {params.sample} were removed from {params.cache_dir} after the reads were skipped, run the pipeline again" | tee -a {log} >&2
+        exit 1
+    fi
+fi
+
+# The mapping steps below are copied from snippy 4.6.0 (bwa mem -Y -M,
+# samclip with its default --maxsoft 10, fixmate, sort and markdup -r -s),
+# but run against the index shared by the cluster. snippy is pinned to that
+# version in the container and envs/snippy.yaml; when it is upgraded, these
+# steps and SNIPPY_SETTINGS have to be compared with its mapping.
+SNIPPY_VERSION=$(snippy --version 2>&1 | cut -d ' ' -f 2)
+if [ "$SNIPPY_VERSION" != "{params.snippy_version}" ]
+then
+    echo "The mapping steps are those of snippy {params.snippy_version}, found snippy $SNIPPY_VERSION" | tee -a {log} >&2
+    exit 1
+fi
+
+# Temporary files go to the scratch directory of the node if given
+if [ "{params.scratch_dir}" != "None" ]
+then
+    mkdir -p {params.scratch_dir}
+    TMP_DIR=$(mktemp -d -p {params.scratch_dir})
+else
+    TMP_DIR=$(mktemp -d)
+fi
+trap "rm -rf $TMP_DIR" EXIT
+
+bwa mem -Y -M -t {threads} \
+    -R '@RG\\tID:{params.sample}\\tSM:{params.sample}' \
+    {input.ref_fasta} {input.r1} {input.r2} 2>{log} \
+    | samclip --max {params.samclip_maxsoft} --ref {input.ref_fasta}.fai 2>>{log} \
+    | samtools sort -n -l 0 -T $TMP_DIR/sort_n --threads {threads} 2>>{log} \
+    | samtools fixmate -m --threads {threads} - - 2>>{log} \
+    | samtools sort -l 0 -T $TMP_DIR/sort --threads {threads} 2>>{log} \
+    | samtools markdup -T $TMP_DIR/markdup --threads {threads} -r -s - $TMP_DIR/mapped.bam 2>>{log}
+
+# QC of the BAM (insert sizes, alignment and coverage) in one pass
+mkdir -p $(dirname {output.stats})
+samtools stats -@ {threads} -r {input.ref_fasta} $TMP_DIR/mapped.bam > {output.stats} 2>>{log}
+
+# With grouped jobs snippy also works in the temporary directory and only
+# its results (not the BAM, its copy of the reference and intermediate
+# files) are copied to the output directory
+SNIPPY_DIR={output.res}
+if [ "{params.group_jobs}" = "True" ]
+then
+    SNIPPY_DIR=$TMP_DIR/snippy
+fi
 snippy --cpus {threads} \
-    --outdir {output.res} \
+    --outdir $SNIPPY_DIR \
     --ref {input.ref} \
-    --R1 {input.r1} \
-    --R2 {input.r2} \
+    --bam $TMP_DIR/mapped.bam \
     {params.report} \
     --prefix {params.sample} \
-    --force 2>&1>{log}
+    --force 2>&1>>{log}
+if [ "$SNIPPY_DIR" != "{output.res}" ]
+then
+    mkdir -p {output.res}
+    for EXT in vcf filt.vcf aligned.fa txt tab csv html log
+    do
+        if [ -e $SNIPPY_DIR/{params.sample}.$EXT ]
+        then
+            cp -L $SNIPPY_DIR/{params.sample}.$EXT {output.res}/
+        fi
+    done
+# Make sure the BAM does not point to the temporary mapping
+elif [ -L {output.res}/{params.sample}.bam ]
+then
+    cp --remove-destination $(readlink -f {output.res}/{params.sample}.bam) {output.res}/{params.sample}.bam
+fi
+
+if [ -n "$CACHE_KEY" ]
+then
+    mkdir -p {params.cache_dir}
+    CACHE_TMP=$(mktemp -d {params.cache_dir}/.tmp_XXXXXX)
+    cp -r {output.res} $CACHE_TMP/{params.sample}
+    cp {output.stats} $CACHE_TMP/samtools_stats.txt
+    touch $CACHE_TMP/complete $CACHE_TMP/last_used
+    mv -T $CACHE_TMP {params.cache_dir}/$CACHE_KEY || rm -rf $CACHE_TMP
+fi
         """
 
 
@@ -99,7 +408,7 @@ if config["mask"] == "None":
         input:
             samples=get_mapped_per_cluster,
             ref=output_dir.joinpath(
-                "ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"
+                "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
             ),
         output:
             res=directory(
@@ -117,17 +426,18 @@ if config["mask"] == "None":
             cluster="{cluster}",
         log:
             log_dir.joinpath("snp_analysis", "snippy_core", "cluster_{cluster}.log"),
-        conda:
-            "../../envs/snippy.yaml"
-        container:
-            "docker://staphb/snippy:4.6.0-SC2"
-        threads: config["threads"]["snippy"]
+        benchmark:
+            log_dir.joinpath("benchmark", "snp_core", "cluster_{cluster}.tsv"),
+        group: CLUSTER_CORE_GROUP
+        threads: RESOURCES.threads("snp_core")
         resources:
-            mem_gb=config["mem_gb"]["snippy"],
+            mem_gb=RESOURCES.mem_gb("snp_core"),
+            runtime=RESOURCES.runtime("snp_core"),
+        retries: RESOURCES.retries
         shell:
             """
-    mkdir -p {output.res}
-    snippy-core --ref {input.ref} --prefix {output.res}/cluster_{params.cluster} {input.samples} 2>&1> {log}
+    python bin/snp_core.py --ref {input.ref} --threads {threads} \
+        --prefix {output.res}/cluster_{params.cluster} {input.samples} &> {log}
             """
 
 else:
@@ -136,7 +446,7 @@ else:
         input:
             samples=get_mapped_per_cluster,
             ref=output_dir.joinpath(
-                "ref_genomes_used", "cluster_{cluster}", "ref_genome.seq"
+                "ref_genomes_used", "cluster_{cluster}", "ref_genome.fasta"
             ),
             mask=config["mask"],
         output:
@@ -155,15 +465,42 @@ else:
             cluster="{cluster}",
         log:
             log_dir.joinpath("snp_analysis", "snippy_core", "cluster_{cluster}.log"),
-        conda:
-            "../../envs/snippy.yaml"
-        container:
-            "docker://staphb/snippy:4.6.0-SC2"
-        threads: config["threads"]["snippy"]
+        benchmark:
+            log_dir.joinpath("benchmark", "snp_core_masked", "cluster_{cluster}.tsv"),
+        group: CLUSTER_CORE_GROUP
+        threads: RESOURCES.threads("snp_core")
         resources:
-            mem_gb=config["mem_gb"]["snippy"],
+            mem_gb=RESOURCES.mem_gb("snp_core"),
+            runtime=RESOURCES.runtime("snp_core"),
+        retries: RESOURCES.retries
         shell:
             """
-    mkdir -p {output.res}
-    snippy-core --ref {input.ref} --mask {input.mask} --prefix {output.res}/cluster_{params.cluster} {input.samples} 2>&1> {log}
+    python bin/snp_core.py --ref {input.ref} --mask {input.mask} --threads {threads} \
+        --prefix {output.res}/cluster_{params.cluster} {input.samples} &> {log}
             """
+
+
+rule evict_mapping_cache:
+    input:
+        get_all_mapped,
+    output:
+        output_dir.joinpath("snp_analysis", "mapping_cache_evicted.txt"),
+    message:
+        "Removing least recently used results from the mapping cache."
+    log:
+        log_dir.joinpath("snp_analysis", "evict_mapping_cache.log"),
+    benchmark:
+        log_dir.joinpath("benchmark", "evict_mapping_cache.tsv"),
+    threads: RESOURCES.threads("other")
+    resources:
+        mem_gb=RESOURCES.mem_gb("other"),
+        runtime=RESOURCES.runtime("other"),
+    retries: RESOURCES.retries
+    params:
+        cache_dir=config["mapping_cache"],
+        max_size_gb=config["mapping_cache_size"],
+    shell:
+        """
+python bin/reference_store.py --root {params.cache_dir} --max-size-gb {params.max_size_gb} > {log} 2>&1
+touch {output}
+        """
@@ -0,0 +1,263 @@
+import argparse
+import hashlib
+import os
+import pathlib
+
+import yaml
+
+# The C implementation of the yaml loader is much faster on large files
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def read_yaml(path: pathlib.Path) -> dict:
+    """Contents of a yaml file, or an empty dict if there is none"""
+    if path is None or not pathlib.Path(path).exists():
+        return {}
+    with open(path) as file:
+        return yaml.load(file, Loader=YAML_LOADER) or {}
+
+
+def write_yaml(content: dict, path: pathlib.Path) -> None:
+    with open(path, "w") as file:
+        yaml.dump(content, file, default_flow_style=False, sort_keys=False)
+
+
+def file_checksum(path: pathlib.Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024**2), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def stable_cluster_ids(clusters: dict, manifest: dict) -> dict:
+    """
+    Renames the clusters (sample: cluster) after those of the manifest of a
+    previous run. Pairs of a new and a previous cluster are matched by the
+    number of samples they share, largest first, so a cluster that grew
+    keeps its number, two merged clusters keep that of the one they share
+    most samples with and the largest part of a split cluster keeps it.
+    Unmatched clusters get numbers that were never used before, in their
+    current order. Without a manifest the clusters are returned unchanged.
+    """
+    previous = manifest.get("clusters", {})
+    if len(previous) == 0:
+        return clusters
+    previous_cluster = {
+        sample: int(cluster)
+        for cluster, info in previous.items()
+        for sample in info["samples"]
+    }
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(cluster, []).append(sample)
+    shared = {}
+    for cluster, samples in members.items():
+        for sample in samples:
+            if sample in previous_cluster:
+                key = (cluster, previous_cluster[sample])
+                shared[key] = shared.get(key, 0) + 1
+    order = {cluster: i for i, cluster in enumerate(members)}
+    pairs = sorted(shared, key=lambda pair: (-shared[pair], order[pair[0]], pair[1]))
+    new_ids, used = {}, set()
+    for cluster, previous_id in pairs:
+        if cluster not in new_ids and previous_id not in used:
+            new_ids[cluster] = previous_id
+            used.add(previous_id)
+    next_id = max(
+        [int(manifest.get("next_cluster", 1))] + [int(c) + 1 for c in previous]
+    )
+    for cluster in members:
+        if cluster not in new_ids:
+            new_ids[cluster] = next_id
+            next_id += 1
+    return {sample: new_ids[cluster] for sample, cluster in clusters.items()}
+
+
+def sample_checksums(assemblies: dict, manifest: dict) -> dict:
+    """
+    Checksum of the assembly of every sample. Checksums of the manifest of a
+    previous run are reused for files with the same path, size and
+    modification time.
+    """
+    known = manifest.get("samples", {})
+    checksums = {}
+    for sample, assembly in assemblies.items():
+        stat = os.stat(assembly)
+        entry = {
+            "assembly": str(assembly),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        cached = known.get(sample, {})
+        if all(cached.get(key) == value for key, value in entry.items()):
+            entry["sha256"] = cached["sha256"]
+        else:
+            entry["sha256"] = file_checksum(assembly)
+        checksums[sample] = entry
+    return checksums
+
+
+def members_digest(samples: list, checksums: dict) -> str:
+    """Checksum of the names and assembly checksums of the samples of a cluster"""
+    sha256 = hashlib.sha256()
+    for sample in sorted(samples):
+        sha256.update(f"{sample}\t{checksums[sample]['sha256']}\n".encode())
+    return sha256.hexdigest()
+
+
+def plan_clusters(clusters: dict, assemblies: dict, manifest: dict) -> dict:
+    """
+    Compares the clusters of this run with those of the manifest of a
+    previous run. A cluster is new, changed (samples added, removed or with
+    a different assembly) or unchanged; the results of unchanged clusters
+    are kept. The digest of the members is used by the pipeline to choose
+    a reference again only for new and changed clusters.
+    """
+    checksums = sample_checksums(
+        {sample: assemblies[sample] for sample in clusters}, manifest
+    )
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(int(cluster), []).append(sample)
+    previous = {
+        int(cluster): info for cluster, info in manifest.get("clusters", {}).items()
+    }
+    plan = {}
+    for cluster, samples in sorted(members.items()):
+        digest = members_digest(samples, checksums)
+        entry = {"status": "new", "samples": len(samples), "digest": digest}
+        if cluster in previous:
+            old = previous[cluster]
+            old_samples = set(old["samples"])
+            entry["status"] = "unchanged" if old["digest"] == digest else "changed"
+            entry["added"] = len(set(samples) - old_samples)
+            entry["removed"] = len(old_samples - set(samples))
+            entry["previous_reference"] = old.get("reference", {}).get("sha256")
+        plan[cluster] = entry
+    next_cluster = max(
+        [int(manifest.get("next_cluster", 1))] + [cluster + 1 for cluster in members]
+    )
+    return {
+        "clusters": plan,
+        "removed_clusters": sorted(set(previous) - set(members)),
+        "next_cluster": next_cluster,
+        "samples": checksums,
+    }
+
+
+def reference_info(reference: pathlib.Path) -> dict:
+    with open(reference) as file:
+        header = file.readline().strip().lstrip(">")
+    return {"sha256": file_checksum(reference), "header": header}
+
+
+def update_manifest(plan: dict, clusters: dict, output_dir: pathlib.Path) -> dict:
+    """
+    Manifest of this run: per cluster the checksums of its samples, the
+    digest of its members and its reference genome.
+    """
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(int(cluster), []).append(sample)
+    checksums = plan["samples"]
+    manifest_clusters = {}
+    for cluster, samples in sorted(members.items()):
+        reference = reference_info(
+            output_dir.joinpath(
+                "ref_genomes_used", f"cluster_{cluster}", "ref_genome.seq"
+            )
+        )
+        cluster_plan = plan["clusters"][cluster]
+        previous_reference = cluster_plan.get("previous_reference")
+        manifest_clusters[cluster] = {
+            "status": cluster_plan["status"],
+            "reference_changed": previous_reference is not None
+            and previous_reference != reference["sha256"],
+            "digest": cluster_plan["digest"],
+            "reference": reference,
+            "samples": {
+                sample: checksums[sample]["sha256"] for sample in sorted(samples)
+            },
+        }
+    return {
+        "next_cluster": plan["next_cluster"],
+        "clusters": manifest_clusters,
+        "removed_clusters": plan["removed_clusters"],
+        "samples": checksums,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the clusters of a run with the manifest of a previous run and write the manifest of this run."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in ["plan", "update"]:
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument(
+            "-cf",
+            "--clustering-file",
+            help="Clusters of the samples (clusters.yaml).",
+            metavar="FILE",
+            type=pathlib.Path,
+            required=True,
+        )
+        subparser.add_argument(
+            "-o",
+            "--output",
+            help="Output yaml.",
+            metavar="FILE",
+            type=pathlib.Path,
+            required=True,
+        )
+    subparsers.choices["plan"].add_argument(
+        "-s",
+        "--sample-sheet",
+        help="Sample sheet of the run, with the assembly of every sample.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    subparsers.choices["plan"].add_argument(
+        "-m",
+        "--manifest",
+        help="Manifest of a previous run, if any.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    subparsers.choices["update"].add_argument(
+        "-p",
+        "--plan",
+        help="Plan of this run.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    subparsers.choices["update"].add_argument(
+        "-d",
+        "--output-dir",
+        help="Output directory of the pipeline, with the reference genomes used.",
+        metavar="DIR",
+        type=pathlib.Path,
+        required=True,
+    )
+    args = parser.parse_args()
+    clusters = read_yaml(args.clustering_file)
+    if args.command == "plan":
+        sample_sheet = read_yaml(args.sample_sheet)
+        assemblies = {sample: sample_sheet[sample]["assembly"] for sample in clusters}
+        plan = plan_clusters(clusters, assemblies, read_yaml(args.manifest))
+        for cluster, entry in plan["clusters"].items():
+            print(f"Cluster {cluster}: {entry['status']} ({entry['samples']} samples)")
+        write_yaml(plan, args.output)
+    else:
+        write_yaml(
+            update_manifest(read_yaml(args.plan), clusters, args.output_dir),
+            args.output,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import pathlib
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from preclustering import read_mash_chunks
+
+
+def read_clusters(clusters_file: pathlib.Path) -> dict:
+    with open(clusters_file) as file:
+        return yaml.safe_load(file) or {}
+
+
+def read_cluster_distances(
+    filepath: pathlib.Path, clusters: dict, n_representatives: int, chunksize: int
+) -> dict:
+    """
+    Reads the mash dist output in chunks and returns, for every cluster with
+    more than n_representatives samples, its samples and their distance
+    matrix. Pairs that are not in the mash output (e.g. two samples of a
+    previous run in incremental preclustering) are NaN.
+    """
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(cluster, []).append(sample)
+    members = {
+        cluster: samples
+        for cluster, samples in members.items()
+        if len(samples) > n_representatives
+    }
+    position = pd.Series(
+        {sample: i for samples in members.values() for i, sample in enumerate(samples)},
+        dtype=np.int64,
+    )
+    sample_clusters = pd.Series(clusters)[position.index]
+    matrices = {}
+    for cluster, samples in members.items():
+        matrices[cluster] = np.full((len(samples), len(samples)), np.nan, np.float32)
+        np.fill_diagonal(matrices[cluster], 0)
+    if len(members) == 0:
+        return {}
+    for query, ref, dist in read_mash_chunks(filepath, chunksize):
+        keep = (query.isin(position.index) & ref.isin(position.index)).values
+        query, ref = query[keep].values, ref[keep].values
+        pairs = pd.DataFrame(
+            {
+                "cluster": sample_clusters[query].values,
+                "ref_cluster": sample_clusters[ref].values,
+                "query": position[query].values,
+                "ref": position[ref].values,
+                "dist": dist[keep],
+            }
+        )
+        pairs = pairs[pairs["cluster"] == pairs["ref_cluster"]]
+        for cluster, cluster_pairs in pairs.groupby("cluster"):
+            dm = matrices[cluster]
+            dm[cluster_pairs["query"].values, cluster_pairs["ref"].values] = (
+                cluster_pairs["dist"].values
+            )
+            dm[cluster_pairs["ref"].values, cluster_pairs["query"].values] = (
+                cluster_pairs["dist"].values
+            )
+    return {cluster: (members[cluster], matrices[cluster]) for cluster in members}
+
+
+def select_representatives(samples: list, dm: np.ndarray, n: int) -> list:
+    """
+    Picks the medoid (smallest mean distance to the other samples) and then,
+    one by one, the sample farthest from the samples already picked. Pairs
+    without a distance are ignored. Stops early if all samples are identical
+    to a picked one.
+    """
+    if len(samples) <= n:
+        return list(samples)
+    known = ~np.isnan(dm)
+    counts = known.sum(axis=1) - 1
+    sums = np.where(known, dm, 0).sum(axis=1)
+    mean_distance = np.where(counts > 0, sums / np.maximum(counts, 1), np.inf)
+    selected = [int(mean_distance.argmin())]
+    min_distance = np.nan_to_num(dm[selected[0]], nan=0.0)
+    while len(selected) < n:
+        candidate = int(min_distance.argmax())
+        if min_distance[candidate] <= 0:
+            break
+        selected.append(candidate)
+        min_distance = np.fmin(min_distance, dm[candidate])
+    return [samples[i] for i in selected]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Select per cluster the samples for which a reference genome is searched."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="Mash dist output used for the preclustering.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-cf",
+        "--clustering-file",
+        help="Clusters of the samples (clusters.yaml).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output yaml with the selected samples and their cluster.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-n",
+        "--representatives",
+        help="Maximum number of samples selected per cluster.",
+        metavar="INT",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        help="Number of mash dist lines to read at once.",
+        metavar="INT",
+        type=int,
+        default=1_000_000,
+    )
+    args = parser.parse_args()
+    clusters = read_clusters(args.clustering_file)
+    distances = read_cluster_distances(
+        args.input, clusters, args.representatives, args.chunk_size
+    )
+    representatives = {}
+    for sample, cluster in clusters.items():
+        if cluster not in distances:
+            representatives[sample] = cluster
+    for cluster, (samples, dm) in distances.items():
+        selected = select_representatives(samples, dm, args.representatives)
+        print(
+            f"Cluster {cluster}: {len(selected)} of {len(samples)} samples selected"
+            f" ({', '.join(selected)})"
+        )
+        for sample in selected:
+            representatives[sample] = cluster
+    with open(args.output, "w") as file:
+        yaml.dump(representatives, file, default_flow_style=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+import argparse
+import mmap
+import multiprocessing
+import os
+import pathlib
+
+import numpy as np
+
+from analyse_core_alignment import BLOCK_BYTES, REFERENCE_NAME
+from packed_alignment import (
+    LINE_WIDTH,
+    FastaLayout,
+    PackedAlignmentWriter,
+    encode_window,
+    wrap,
+)
+from snp_dists import SequenceLayout, index_fasta, is_nucleotide
+
+# Characters of the aligned.fa of snippy counted in the .txt (as snippy-core),
+# besides the bases
+UNALIGNED, HET, MASKED, LOWCOV = (ord(char) for char in "-nXN")
+TXT_COLUMNS = ["ID", "LENGTH", "ALIGNED", "UNALIGNED", "VARIANT", "HET", "MASKED"]
+TXT_COLUMNS.append("LOWCOV")
+
+# State shared with the worker processes
+_worker = {}
+
+
+def find_aligned_fasta(snippy_dir: pathlib.Path) -> pathlib.Path:
+    """snippy names its outputs after --prefix (the sample) or snps by default"""
+    for prefix in [snippy_dir.name, "snps"]:
+        aligned = snippy_dir.joinpath(f"{prefix}.aligned.fa")
+        if aligned.exists():
+            return aligned
+    raise FileNotFoundError(f"Could not find the aligned.fa of snippy in {snippy_dir}")
+
+
+def count_variants(snippy_dir: pathlib.Path) -> int:
+    for prefix in [snippy_dir.name, "snps"]:
+        vcf = snippy_dir.joinpath(f"{prefix}.vcf")
+        if vcf.exists():
+            with open(vcf) as file:
+                return sum(1 for line in file if not line.startswith("#"))
+    return 0
+
+
+def read_reference(reference: pathlib.Path) -> tuple[list, np.ndarray]:
+    """Returns the name and length of every contig and the concatenated sequence"""
+    contigs = []
+    seqs = []
+    with open(reference) as file:
+        for line in file:
+            if line.startswith(">"):
+                contigs.append([line[1:].split()[0], 0])
+                seqs.append([])
+            elif len(contigs) > 0:
+                seqs[-1].append(line.strip().upper())
+                contigs[-1][1] += len(seqs[-1][-1])
+    seq = "".join("".join(contig_seq) for contig_seq in seqs)
+    return contigs, np.frombuffer(seq.encode(), dtype=np.uint8)
+
+
+def read_mask(mask: pathlib.Path, contigs: list) -> np.ndarray:
+    """Boolean mask of the concatenated reference from a BED file"""
+    starts = dict(
+        zip(
+            [name for name, _ in contigs],
+            np.cumsum([0] + [length for _, length in contigs[:-1]]).tolist(),
+        )
+    )
+    lengths = dict(contigs)
+    masked = np.zeros(sum(lengths.values()), dtype=bool)
+    with open(mask) as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 3 or fields[0] not in starts:
+                continue
+            start = max(0, int(fields[1]))
+            end = min(int(fields[2]), lengths[fields[0]])
+            masked[starts[fields[0]] + start : starts[fields[0]] + end] = True
+    return masked
+
+
+def index_sample(aligned_fasta: pathlib.Path, contigs: list) -> list:
+    """
+    Layout of every contig in the aligned.fa of a sample. The contigs are in
+    the order of the reference, which is checked by their lengths.
+    """
+    with open(aligned_fasta, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as alignment:
+        records = index_fasta(alignment)
+        layouts = [SequenceLayout(alignment, start, end) for _, start, end in records]
+    if [layout.length for layout in layouts] != [length for _, length in contigs]:
+        raise ValueError(
+            f"The contigs in {aligned_fasta} do not match those of the reference"
+        )
+    return layouts
+
+
+def _init_worker(
+    aligned_fastas: list,
+    layouts: list,
+    contig_starts: np.ndarray,
+    reference: np.ndarray,
+    masked: np.ndarray,
+    output: pathlib.Path,
+    fasta_layout: FastaLayout,
+) -> None:
+    # Files are opened per window, as clusters can have more samples than
+    # the number of files a process may keep open. A fasta alignment is
+    # written by the workers, a packed one (no fasta_layout) by the parent
+    _worker["aligned_fastas"] = aligned_fastas
+    _worker["layouts"] = layouts
+    _worker["contig_starts"] = contig_starts
+    _worker["reference"] = reference
+    _worker["masked"] = masked
+    _worker["output"] = None if fasta_layout is None else os.open(output, os.O_WRONLY)
+    _worker["fasta_layout"] = fasta_layout
+
+
+def _read_window(sample: int, first: int, last: int) -> np.ndarray:
+    """Columns first to last (exclusive) of the concatenated contigs of a sample"""
+    contig_starts = _worker["contig_starts"]
+    parts = []
+    contig = np.searchsorted(contig_starts, first, side="right") - 1
+    fd = os.open(_worker["aligned_fastas"][sample], os.O_RDONLY)
+    try:
+        while first < last:
+            layout = _worker["layouts"][sample][contig]
+            start = first - contig_starts[contig]
+            end = min(last - contig_starts[contig], layout.length)
+            offset = layout.offset(start)
+            count = layout.offset(end - 1) + 1 - offset
+            seq = np.frombuffer(os.pread(fd, count, offset), dtype=np.uint8)
+            seq = seq[(seq != ord("\n")) & (seq != ord("\r"))]
+            if len(seq) != end - start:
+                raise ValueError(
+                    "Sequences in aligned.fa are not wrapped at a fixed width"
+                )
+            parts.append(seq)
+            first += end - start
+            contig += 1
+    finally:
+        os.close(fd)
+    return np.concatenate(parts)
+
+
+def _build_window(window: tuple) -> tuple[np.ndarray, np.ndarray, np.ndarray, bytes]:
+    """
+    Writes a window of columns of the full alignment (or compresses it, if it
+    is packed) and returns the counts per sequence (for the .txt), the
+    positions and alleles of the core SNPs in the window and the compressed
+    window.
+    """
+    first, last = window
+    n_samples = len(_worker["layouts"])
+    block = np.empty((n_samples + 1, last - first), dtype=np.uint8)
+    block[0] = _worker["reference"][first:last]
+    for sample in range(n_samples):
+        block[sample + 1] = _read_window(sample, first, last)
+    # As snippy-core, the reference is masked too
+    block[:, _worker["masked"][first:last]] = MASKED
+
+    fasta_layout = _worker["fasta_layout"]
+    packed = None
+    if fasta_layout is None:
+        packed = encode_window(block)
+    else:
+        is_end = last == fasta_layout.length
+        for row, start in zip(block, fasta_layout.starts):
+            offset = start + first + first // LINE_WIDTH
+            os.pwrite(_worker["output"], wrap(row, is_end), offset)
+
+    nucleotides = is_nucleotide(block)
+    counts = np.stack(
+        [
+            nucleotides.sum(axis=1),
+            (block == UNALIGNED).sum(axis=1),
+            (block == HET).sum(axis=1),
+            (block == MASKED).sum(axis=1),
+            (block == LOWCOV).sum(axis=1),
+        ],
+        axis=1,
+    )
+    core = np.flatnonzero(nucleotides.all(axis=0) & (block != block[0]).any(axis=0))
+    return counts, core + first, block[:, core], packed
+
+
+def make_windows(length: int, n_sequences: int, threads: int) -> list:
+    """
+    Windows of columns that start at a line start of the output, small
+    enough to keep BLOCK_BYTES in memory and to split the work in several
+    windows per thread.
+    """
+    window_size = min(max(1, BLOCK_BYTES // n_sequences), -(-length // (threads * 4)))
+    window_size = max(LINE_WIDTH, window_size // LINE_WIDTH * LINE_WIDTH)
+    return [
+        (first, min(first + window_size, length))
+        for first in range(0, length, window_size)
+    ]
+
+
+def build_windows(windows: list, threads: int, initargs: tuple):
+    """
+    Yields the results of _build_window() in the order of the windows, so
+    they can be written to a packed alignment as they come in.
+    """
+    if threads == 1:
+        _init_worker(*initargs)
+        yield from map(_build_window, windows)
+    else:
+        with multiprocessing.Pool(
+            threads, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            yield from pool.imap(_build_window, windows)
+
+
+def site_names(positions: np.ndarray, contigs: list) -> tuple[list, np.ndarray]:
+    """Contig and position (1-based) on the contig of positions in the alignment"""
+    ends = np.cumsum([length for _, length in contigs])
+    contig_idx = np.searchsorted(ends, positions, side="right")
+    starts = ends - np.array([length for _, length in contigs])
+    return [contigs[i][0] for i in contig_idx], positions - starts[contig_idx] + 1
+
+
+def write_fasta(names: list, seqs: np.ndarray, output: pathlib.Path) -> None:
+    with open(output, "wb") as file:
+        for name, seq in zip(names, seqs):
+            file.write(f">{name}\n".encode())
+            file.write(wrap(seq, True) if len(seq) > 0 else b"\n")
+
+
+def write_tab(
+    names: list, chroms: list, positions: np.ndarray, alleles: np.ndarray, output
+) -> None:
+    with open(output, "w") as file:
+        file.write("\t".join(["CHR", "POS", "REF"] + names[1:]) + "\n")
+        for k, (chrom, pos) in enumerate(zip(chroms, positions.tolist())):
+            file.write(
+                f"{chrom}\t{pos}\t" + "\t".join(alleles[:, k].tobytes().decode()) + "\n"
+            )
+
+
+def write_vcf(
+    names: list,
+    contigs: list,
+    chroms: list,
+    positions: np.ndarray,
+    alleles: np.ndarray,
+    output: pathlib.Path,
+) -> None:
+    with open(output, "w") as file:
+        file.write("##fileformat=VCFv4.2\n##source=snp_core.py\n")
+        for name, length in contigs:
+            file.write(f"##contig=<ID={name},length={length}>\n")
+        file.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        header = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"]
+        file.write("\t".join(header + ["FORMAT"] + names[1:]) + "\n")
+        for k, (chrom, pos) in enumerate(zip(chroms, positions.tolist())):
+            column = alleles[:, k].tobytes().decode()
+            alts = []
+            for allele in column[1:]:
+                if allele != column[0] and allele not in alts:
+                    alts.append(allele)
+            genotypes = [str(([column[0]] + alts).index(allele)) for allele in column]
+            fields = [chrom, str(pos), ".", column[0], ",".join(alts), ".", "PASS"]
+            file.write("\t".join(fields + [".", "GT"] + genotypes[1:]) + "\n")
+
+
+def write_txt(names: list, counts: np.ndarray, variants: list, length: int, output):
+    """Same columns as the .txt of snippy-core (parsed by MultiQC)"""
+    with open(output, "w") as file:
+        file.write("\t".join(TXT_COLUMNS) + "\n")
+        for name, row, n_variants in zip(names, counts.tolist(), variants):
+            aligned, unaligned, het, masked, lowcov = row
+            values = [length, aligned, unaligned, n_variants, het, masked, lowcov]
+            file.write("\t".join([name] + list(map(str, values))) + "\n")
+
+
+def build_core(
+    snippy_dirs: list,
+    reference: pathlib.Path,
+    prefix: str,
+    mask: pathlib.Path = None,
+    threads: int = 1,
+    packed: bool = True,
+) -> None:
+    snippy_dirs = [pathlib.Path(snippy_dir) for snippy_dir in snippy_dirs]
+    names = [REFERENCE_NAME] + [snippy_dir.name for snippy_dir in snippy_dirs]
+    contigs, ref_seq = read_reference(reference)
+    contig_starts = np.cumsum([0] + [length for _, length in contigs])
+    masked = np.zeros(len(ref_seq), dtype=bool)
+    if mask is not None:
+        masked = read_mask(mask, contigs)
+    aligned_fastas = [find_aligned_fasta(snippy_dir) for snippy_dir in snippy_dirs]
+    layouts = [index_sample(aligned, contigs) for aligned in aligned_fastas]
+
+    windows = make_windows(len(ref_seq), len(names), threads)
+    writer, fasta_layout = None, None
+    if packed:
+        full_aln = pathlib.Path(f"{prefix}.full.paln")
+        full_aln.parent.mkdir(parents=True, exist_ok=True)
+        window = windows[0][1] - windows[0][0] if len(windows) > 0 else LINE_WIDTH
+        writer = PackedAlignmentWriter(full_aln, names, len(ref_seq), window)
+    else:
+        full_aln = pathlib.Path(f"{prefix}.full.aln")
+        full_aln.parent.mkdir(parents=True, exist_ok=True)
+        fasta_layout = FastaLayout(names, len(ref_seq))
+        fd = os.open(full_aln, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, fasta_layout.size)
+            fasta_layout.write_headers(fd, names)
+        finally:
+            os.close(fd)
+
+    initargs = (
+        aligned_fastas,
+        layouts,
+        contig_starts,
+        ref_seq,
+        masked,
+        full_aln,
+        fasta_layout,
+    )
+    counts, positions, alleles = [], [], []
+    for result in build_windows(windows, threads, initargs):
+        counts.append(result[0])
+        positions.append(result[1])
+        alleles.append(result[2])
+        if writer is not None:
+            writer.add_window(result[3])
+    if writer is not None:
+        writer.close()
+    counts = sum(counts)
+    positions = np.concatenate(positions)
+    alleles = np.hstack(alleles)
+    print(f"Found {len(positions)} core SNPs in {len(snippy_dirs)} samples")
+
+    chroms, contig_positions = site_names(positions, contigs)
+    variants = [0] + [count_variants(snippy_dir) for snippy_dir in snippy_dirs]
+    write_fasta(names, alleles, pathlib.Path(f"{prefix}.aln"))
+    write_tab(names, chroms, contig_positions, alleles, f"{prefix}.tab")
+    write_vcf(names, contigs, chroms, contig_positions, alleles, f"{prefix}.vcf")
+    write_txt(names, counts, variants, len(ref_seq), f"{prefix}.txt")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make the core genome alignment of snippy results (as snippy-core)."
+    )
+    parser.add_argument(
+        "snippy_dirs",
+        help="Output directories of snippy, named after the samples.",
+        metavar="DIR",
+        type=pathlib.Path,
+        nargs="+",
+    )
+    parser.add_argument(
+        "-r",
+        "--ref",
+        help="Reference genome (fasta) used by snippy.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        help="Prefix of the output files (.full.paln, .aln, .tab, .vcf and .txt).",
+        metavar="PREFIX",
+        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--mask",
+        help="BED file with the regions to mask (X) in the reference and the samples.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes building windows of the alignment.",
+        metavar="INT",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--fasta",
+        help="Write the full alignment as fasta (.full.aln) instead of packed (.full.paln).",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    build_core(
+        args.snippy_dirs,
+        args.ref,
+        args.prefix,
+        args.mask,
+        args.threads,
+        packed=not args.fasta,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import mmap
+import multiprocessing
+import pathlib
+
+import numpy as np
+
+# Same header as snp-dists, which made snp_matrix.csv before
+SNP_DISTS_HEADER = "snp-dists 0.8.2"
+NUCLEOTIDES = b"ACGT"
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+# Bit planes shared with the worker processes
+_planes = None
+
+
+def index_fasta(alignment: mmap.mmap) -> list:
+    """Returns the name and the (start, end) offsets of every sequence"""
+    records = []
+    start = alignment.find(b">")
+    while start != -1:
+        header_end = alignment.find(b"\n", start)
+        next_start = alignment.find(b"\n>", header_end)
+        end = len(alignment) if next_start == -1 else next_start
+        name = alignment[start + 1 : header_end].split()[0].decode()
+        records.append((name, header_end + 1, end))
+        start = -1 if next_start == -1 else next_start + 1
+    return records
+
+
+class SequenceLayout:
+    """
+    Byte layout of a sequence in a fasta file with lines of a fixed width,
+    used to read any range of columns without reading the whole sequence.
+    """
+
+    def __init__(self, alignment: mmap.mmap, start: int, end: int) -> None:
+        line_end = alignment.find(b"\n", start, end)
+        if line_end == -1:
+            line_end = end
+        self.start = start
+        self.newline = 2 if alignment[line_end - 1 : line_end] == b"\r" else 1
+        self.width = max(1, line_end - start - (self.newline - 1))
+        while end > start and alignment[end - 1 : end] in (b"\n", b"\r"):
+            end -= 1
+        full_lines, rest = divmod(end - start, self.width + self.newline)
+        self.length = full_lines * self.width + rest
+
+    def offset(self, column: int) -> int:
+        line, position = divmod(column, self.width)
+        return self.start + line * (self.width + self.newline) + position
+
+
+def read_columns(
+    alignment: mmap.mmap,
+    layout: SequenceLayout,
+    first: int,
+    last: int,
+    upper: bool = True,
+) -> np.ndarray:
+    """
+    Returns the characters of columns first to last (exclusive), in upper case
+    unless upper is False.
+    """
+    start = layout.offset(first)
+    count = layout.offset(last - 1) + 1 - start
+    seq = np.frombuffer(alignment, dtype=np.uint8, count=count, offset=start)
+    seq = seq[(seq != ord("\n")) & (seq != ord("\r"))]
+    if len(seq) != last - first:
+        raise ValueError("Sequences in the alignment are not wrapped at a fixed width")
+    if not upper:
+        return seq
+    return np.where((seq >= ord("a")) & (seq <= ord("z")), seq - 32, seq)
+
+
+def read_sequence(alignment: mmap.mmap, start: int, end: int) -> np.ndarray:
+    seq = np.frombuffer(alignment, dtype=np.uint8, count=end - start, offset=start)
+    seq = seq[(seq != ord("\n")) & (seq != ord("\r"))]
+    # Upper case, like snp-dists does by default
+    return np.where((seq >= ord("a")) & (seq <= ord("z")), seq - 32, seq)
+
+
+def is_nucleotide(seq: np.ndarray) -> np.ndarray:
+    """Whether the characters are A, C, G or T (faster than np.isin)"""
+    nucleotides = seq == NUCLEOTIDES[0]
+    for nucleotide in NUCLEOTIDES[1:]:
+        nucleotides |= seq == nucleotide
+    return nucleotides
+
+
+def nucleotide_codes(seq: np.ndarray) -> np.ndarray:
+    """Bit 0-3 for A, C, G, T and 0 for any other character (gap, N, ...)"""
+    # Bits 1 and 2 of the ASCII codes of A, C, T and G are 0, 1, 2 and 3,
+    # which become 0, 1, 3 and 2 by XOR-ing the higher bit into the lower one
+    bits = (seq >> 1) & 3
+    bits ^= bits >> 1
+    codes = np.left_shift(1, bits, dtype=np.uint8)
+    codes *= is_nucleotide(seq)
+    return codes
+
+
+def find_variable_columns(alignment: mmap.mmap, records: list) -> np.ndarray:
+    seen = None
+    for _, start, end in records:
+        codes = nucleotide_codes(read_sequence(alignment, start, end))
+        if seen is None:
+            seen = codes
+        elif codes.shape != seen.shape:
+            raise ValueError("Sequences in the alignment do not have the same length")
+        else:
+            seen |= codes
+    return np.flatnonzero(POPCOUNT[seen] > 1)
+
+
+def make_bit_planes(
+    alignment: mmap.mmap, records: list, variable_columns: np.ndarray
+) -> np.ndarray:
+    """
+    Packs the variable columns of every sequence in bit planes with shape
+    (5, n_sequences, n_bytes): one plane per nucleotide (A, C, G, T) plus a
+    mask of the positions with a nucleotide (i.e. not missing data).
+    """
+    n_bytes = (len(variable_columns) + 7) // 8
+    planes = np.zeros((5, len(records), n_bytes), dtype=np.uint8)
+    for i, (_, start, end) in enumerate(records):
+        codes = nucleotide_codes(read_sequence(alignment, start, end))[variable_columns]
+        planes[:, i] = pack_bit_planes(codes[np.newaxis, :])[:, 0]
+    return planes
+
+
+def pack_bit_planes(codes: np.ndarray) -> np.ndarray:
+    """Same as make_bit_planes() for a (n_sequences, n_columns) matrix of codes"""
+    planes = [np.packbits(codes & (1 << bit) > 0, axis=1) for bit in range(4)]
+    planes.append(np.packbits(codes > 0, axis=1))
+    return np.stack(planes)
+
+
+def _init_worker(planes: np.ndarray) -> None:
+    global _planes
+    _planes = planes
+
+
+def _distance_rows(rows: range) -> np.ndarray:
+    planes = _planes
+    dm = np.zeros((len(rows), planes.shape[1]), dtype=np.int64)
+    for k, i in enumerate(rows):
+        # A position differs if both sequences have a nucleotide there and
+        # any of the A, C or G planes differs (then T differs as well)
+        different = (planes[0] ^ planes[0, i]) | (planes[1] ^ planes[1, i])
+        different |= planes[2] ^ planes[2, i]
+        different &= planes[4] & planes[4, i]
+        dm[k] = POPCOUNT[different].sum(axis=1)
+    return dm
+
+
+def snp_distances(planes: np.ndarray, threads: int = 1) -> np.ndarray:
+    n = planes.shape[1]
+    chunk_size = max(1, -(-n // (threads * 4)))
+    chunks = [range(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+    if threads == 1:
+        _init_worker(planes)
+        return np.vstack([_distance_rows(chunk) for chunk in chunks])
+    with multiprocessing.Pool(
+        threads, initializer=_init_worker, initargs=(planes,)
+    ) as pool:
+        return np.vstack(pool.map(_distance_rows, chunks))
+
+
+def get_snp_matrix(alignment_file: pathlib.Path, threads: int = 1) -> tuple:
+    """Returns the sequence names and their pairwise SNP distances"""
+    with open(alignment_file, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as alignment:
+        records = index_fasta(alignment)
+        variable_columns = find_variable_columns(alignment, records)
+        print(
+            f"Found {len(variable_columns)} variable positions in {len(records)} sequences"
+        )
+        planes = make_bit_planes(alignment, records, variable_columns)
+    names = [name for name, _, _ in records]
+    return names, snp_distances(planes, threads)
+
+
+def write_csv(names: list, dm: np.ndarray, output_file: pathlib.Path) -> None:
+    with open(output_file, "w") as file:
+        file.write(",".join([SNP_DISTS_HEADER] + names) + "\n")
+        for name, row in zip(names, dm):
+            file.write(name + "," + ",".join(map(str, row.tolist())) + "\n")
+
+
+def write_npy(names: list, dm: np.ndarray, output_file: pathlib.Path) -> None:
+    """Writes the matrix as .npy with the names in a .labels.txt file next to it"""
+    output_file = pathlib.Path(output_file)
+    np.save(output_file, dm.astype(np.uint32))
+    with open(output_file.with_suffix(".labels.txt"), "w") as file:
+        file.writelines(f"{name}\n" for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pairwise SNP distances of an alignment (same output as snp-dists -c)"
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        help="Alignment (fasta), e.g. the .full.aln of snippy-core.",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file (csv extension).",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-b",
+        "--binary-output",
+        help="Optional output file (npy extension) to also store the matrix in binary format.",
+        metavar="FILE",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes used to compute the distances.",
+        metavar="INT",
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args()
+    names, dm = get_snp_matrix(args.input, args.threads)
+    write_csv(names, dm, args.output)
+    if args.binary_output is not None:
+        write_npy(names, dm, args.binary_output)
+
+
+if __name__ == "__main__":
+    main()
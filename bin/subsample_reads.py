@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import gzip
+import io
+import itertools
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+
+
+@contextlib.contextmanager
+def open_fastq(path: pathlib.Path, mode: str = "r", threads: int = 1):
+    """
+    Opens a (gzipped) fastq file as a text stream. Compressed files are
+    handled by pigz when it is available so that (de)compression runs in
+    parallel to the parsing.
+    """
+    path = pathlib.Path(path)
+    if path.suffix != ".gz":
+        with open(path, mode) as file:
+            yield file
+    elif shutil.which("pigz") is None:
+        # mtime=0 keeps the output identical between runs
+        with gzip.GzipFile(path, mode + "b", compresslevel=6, mtime=0) as file:
+            with io.TextIOWrapper(file) as stream:
+                yield stream
+    elif mode == "r":
+        process = subprocess.Popen(
+            ["pigz", "-dc", "-p", str(threads), str(path)], stdout=subprocess.PIPE
+        )
+        stream = io.TextIOWrapper(process.stdout)
+        try:
+            yield stream
+        finally:
+            stream.close()
+            returncode = process.wait()
+        # A truncated or corrupt file ends the stream early, which would
+        # otherwise look like a shorter file
+        if returncode != 0:
+            raise RuntimeError(f"pigz failed to read {path}")
+    else:
+        with open(path, "wb") as output_file:
+            process = subprocess.Popen(
+                ["pigz", "-c", "-n", "-6", "-p", str(threads)],
+                stdin=subprocess.PIPE,
+                stdout=output_file,
+            )
+        stream = io.TextIOWrapper(process.stdin)
+        try:
+            yield stream
+        finally:
+            stream.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"pigz failed to write {path}")
+
+
+def read_records(fastq):
+    while True:
+        record = [fastq.readline() for _ in range(4)]
+        if not record[0]:
+            return
+        yield record
+
+
+def get_genome_size(reference: pathlib.Path) -> int:
+    genome_size = 0
+    with open(reference) as file:
+        for line in file:
+            if not line.startswith(">"):
+                genome_size += len(line.strip())
+    return genome_size
+
+
+def count_bases(fastq_file: pathlib.Path, threads: int = 1) -> int:
+    bases = 0
+    with open_fastq(fastq_file, threads=threads) as fastq:
+        for record in read_records(fastq):
+            bases += len(record[1].rstrip("\n"))
+    return bases
+
+
+def subsample_pairs(
+    r1: pathlib.Path,
+    r2: pathlib.Path,
+    out_r1: pathlib.Path,
+    out_r2: pathlib.Path,
+    fraction: float,
+    seed: int = 1,
+    threads: int = 1,
+) -> int:
+    """
+    Keeps every read pair with probability fraction. The random generator is
+    seeded so the same input always gives the same output. Returns the number
+    of pairs kept. Raises a ValueError if the files have a different number
+    of reads, as the pairs would then be mixed up.
+    """
+    rng = random.Random(seed)
+    kept = 0
+    with open_fastq(r1, threads=threads) as fastq_1, open_fastq(
+        r2, threads=threads
+    ) as fastq_2, open_fastq(out_r1, "w", threads) as out_1, open_fastq(
+        out_r2, "w", threads
+    ) as out_2:
+        for record_1, record_2 in itertools.zip_longest(
+            read_records(fastq_1), read_records(fastq_2)
+        ):
+            if record_1 is None or record_2 is None:
+                raise ValueError(f"{r1} and {r2} have a different number of reads")
+            if rng.random() < fraction:
+                out_1.writelines(record_1)
+                out_2.writelines(record_2)
+                kept += 1
+    return kept
+
+
+def link_reads(reads: pathlib.Path, output: pathlib.Path) -> None:
+    if output.exists() or output.is_symlink():
+        output.unlink()
+    os.symlink(pathlib.Path(reads).resolve(), output)
+
+
+def subsample_reads(
+    r1: pathlib.Path,
+    r2: pathlib.Path,
+    reference: pathlib.Path,
+    max_coverage: int,
+    out_r1: pathlib.Path,
+    out_r2: pathlib.Path,
+    seed: int = 1,
+    threads: int = 1,
+) -> None:
+    """
+    Subsamples the read pairs to max_coverage of the reference genome. Reads
+    that are below it are linked instead of copied.
+    """
+    out_r1 = pathlib.Path(out_r1)
+    out_r2 = pathlib.Path(out_r2)
+    genome_size = get_genome_size(reference)
+    total_bases = count_bases(r1, threads) + count_bases(r2, threads)
+    coverage = total_bases / genome_size
+    print(f"Estimated coverage is {coverage:.1f}x (genome size: {genome_size} bp)")
+    out_r1.parent.mkdir(parents=True, exist_ok=True)
+    out_r2.parent.mkdir(parents=True, exist_ok=True)
+    if coverage <= max_coverage:
+        print("Coverage is below the maximum, reads are used as they are")
+        link_reads(r1, out_r1)
+        link_reads(r2, out_r2)
+        return
+    fraction = max_coverage / coverage
+    kept = subsample_pairs(
+        r1,
+        r2,
+        out_r1,
+        out_r2,
+        fraction,
+        seed=seed,
+        threads=threads,
+    )
+    print(f"Kept {kept} read pairs ({fraction:.3f} of the reads)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Subsample paired reads to a maximum coverage of the reference genome."
+    )
+    parser.add_argument("-1", "--r1", metavar="FILE", type=pathlib.Path, required=True)
+    parser.add_argument("-2", "--r2", metavar="FILE", type=pathlib.Path, required=True)
+    parser.add_argument(
+        "-r",
+        "--reference",
+        metavar="FILE",
+        type=pathlib.Path,
+        required=True,
+        help="Reference genome (fasta) used to estimate the genome size.",
+    )
+    parser.add_argument(
+        "-c",
+        "--max-coverage",
+        metavar="INT",
+        type=int,
+        required=True,
+        help="Maximum coverage (depth) to keep.",
+    )
+    parser.add_argument(
+        "-o1", "--out-r1", metavar="FILE", type=pathlib.Path, required=True
+    )
+    parser.add_argument(
+        "-o2", "--out-r2", metavar="FILE", type=pathlib.Path, required=True
+    )
+    parser.add_argument("-s", "--seed", metavar="INT", type=int, default=1)
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=1)
+    args = parser.parse_args()
+
+    subsample_reads(
+        args.r1,
+        args.r2,
+        args.reference,
+        args.max_coverage,
+        args.out_r1,
+        args.out_r2,
+        seed=args.seed,
+        threads=args.threads,
+    )
+
+
+if __name__ == "__main__":
+    main()
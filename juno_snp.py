@@ -113,6 +113,24 @@ class JunoSnp(Pipeline):
             default=400,
             help="Sliding window - the lower the more accurate but also slower. Passed to referenceseeker",
         )
+        self.add_argument(
+            "--reference-search",
+            type=str,
+            metavar="MODE",
+            default="all",
+            choices=["all", "representatives"],
+            help="Samples on which referenceseeker is run to choose the reference of every cluster."
+            " 'all' runs it on every sample. 'representatives' only on the medoid of the cluster and"
+            " the samples most distant from it (by mash distance). Default is all",
+        )
+        self.add_argument(
+            "--representatives",
+            type=int,
+            metavar="INT",
+            default=3,
+            help="Maximum number of samples per cluster on which referenceseeker is run in"
+            " 'representatives' reference search mode. Default is 3",
+        )
         self.add_argument(
             "-kl",
             "--kmer-length",
@@ -147,11 +165,145 @@ class JunoSnp(Pipeline):
             choices=["upgma", "nj"],
             help="Algorithm to use for making the tree. It can be 'upgma' or 'nj' (neighbor-joining). Default is upgma",
         )
+        self.add_argument(
+            "--ml-tree-mode",
+            type=str,
+            metavar="MODE",
+            default="full",
+            choices=["full", "incremental", "refresh"],
+            help="Mode to make the ML tree. 'full' runs ModelFinder and the tree search from scratch."
+            " 'incremental' reuses the model and tree of a previous run with the same reference"
+            " (new samples are grafted in the tree) and stores them for later runs. ModelFinder is"
+            " run again (on the grafted tree) when more than 20%% of the samples are new."
+            " 'refresh' runs ModelFinder and the tree search from scratch and stores the model and"
+            " tree for later incremental runs. Default is full",
+        )
+        self.add_argument(
+            "--ml-tree-cache",
+            type=Path,
+            metavar="DIR",
+            default=None,
+            help="Directory where the models and trees are stored in incremental and refresh ML tree mode."
+            " If none is given, ml_tree_cache inside the database directory is used.",
+        )
         self.add_argument(
             "--snippy-report",
             action="store_true",
             help="If set, the pipeline will run Snippy with --report option. This requires quite some extra time and storage, especially if there a lot of variants",
         )
+        self.add_argument(
+            "--precluster-state",
+            type=Path,
+            metavar="DIR",
+            default=None,
+            help="Directory with a persistent preclustering state (mash sketches and pre-clusters)."
+            " If given, only samples that are not yet in the state are sketched and compared, and the"
+            " state is updated at the end of the run. Not used if a custom reference is supplied.",
+        )
+        self.add_argument(
+            "--sketch-cache",
+            type=Path,
+            metavar="DIR",
+            default=None,
+            help="Directory where mash sketches are cached per assembly, so unchanged assemblies are not"
+            " sketched again in later runs. If none is given, the sketches are cached in the output directory.",
+        )
+        self.add_argument(
+            "--reference-store-size",
+            type=float,
+            metavar="FLOAT",
+            default=20,
+            help="Maximum size (in GB) of the store of downloaded reference genomes inside the database"
+            " directory. The least recently used genomes are removed when it is exceeded.",
+        )
+        self.add_argument(
+            "--max-coverage",
+            type=int,
+            metavar="INT",
+            default=None,
+            help="If given, the reads of samples with a higher coverage of the reference genome are subsampled"
+            " (seeded, read pairs are kept together) to this coverage before mapping.",
+        )
+        self.add_argument(
+            "--mapping-cache",
+            type=Path,
+            metavar="DIR",
+            default=None,
+            help="Directory where the results of snippy are cached per sample. Samples with the same reads,"
+            " reference genome and snippy parameters as in a previous run are then not mapped again.",
+        )
+        self.add_argument(
+            "--mapping-cache-size",
+            type=float,
+            metavar="FLOAT",
+            default=200,
+            help="Maximum size (in GB) of the mapping cache. The least recently used results are removed when it is exceeded.",
+        )
+        self.add_argument(
+            "--resource-model",
+            type=str,
+            metavar="MODE",
+            default="fixed",
+            choices=["fixed", "model"],
+            help="How the threads, memory and runtime of the jobs are set. 'fixed' uses the values per tool"
+            " of pipeline_parameters.yaml. 'model' predicts them from the size of the inputs, the length of"
+            " the reference and the number of samples in the cluster. Default is fixed",
+        )
+        self.add_argument(
+            "--resource-model-file",
+            type=Path,
+            metavar="FILE",
+            default=Path(__file__).parent.joinpath("config", "resource_model.yaml"),
+            help="Coefficients of the resource model. Default is config/resource_model.yaml",
+        )
+        self.add_argument(
+            "--retries",
+            type=int,
+            metavar="INT",
+            default=None,
+            help="Number of times a failed job is retried. Default is 2 with --resource-model model"
+            " (so jobs that ran out of memory get more) and 0 otherwise",
+        )
+        self.add_argument(
+            "--retry-memory-factor",
+            type=float,
+            metavar="FLOAT",
+            default=1.5,
+            help="Factor by which the memory (and runtime) of a job is multiplied on every retry,"
+            " so jobs that ran out of memory get more. Default is 1.5",
+        )
+        self.add_argument(
+            "--profile-run",
+            action="store_true",
+            help="If set, the wall time, CPU time, peak memory and I/O of every job are collected into a"
+            " performance report (critical path, slowest rules, per cluster and per sample) in the"
+            " profile folder of the output directory.",
+        )
+        self.add_argument(
+            "--group-jobs",
+            action="store_true",
+            help="If set, the subsampling, mapping and BAM QC of every sample are submitted to the cluster as one"
+            " job that works in a scratch directory on the node and only copies the results (not the BAM) to the"
+            " output directory, the core alignment and its analysis are one job per cluster, and the small steps"
+            " per cluster (indexing the reference, tree, MultiQC) are submitted in batches of --group-batch-size"
+            " clusters. Has no effect when running locally.",
+        )
+        self.add_argument(
+            "--group-batch-size",
+            type=int,
+            metavar="INT",
+            default=5,
+            help="Number of clusters of which the small steps are submitted as one job with --group-jobs."
+            " The threads and memory of the steps in a batch add up. Default is 5",
+        )
+        self.add_argument(
+            "--scratch-dir",
+            type=Path,
+            metavar="DIR",
+            default=None,
+            help="Directory on the nodes (e.g. a node-local scratch disk) for the temporary files of the"
+            " mapping and, with --group-jobs, the subsampled reads. If none is given, the temporary directory of the node ($TMPDIR) is used.",
+        )
         self.add_argument(
             "--mask",
             type=Path,
@@ -163,15 +315,35 @@ class JunoSnp(Pipeline):
 
         self.reference: Path = args.reference
         self.mask: Path = args.mask
+        self.precluster_state: Path = args.precluster_state
+        self.sketch_cache: Path = args.sketch_cache
+        self.reference_store_size: float = args.reference_store_size
+        self.max_coverage: int = args.max_coverage
+        self.mapping_cache: Path = args.mapping_cache
+        self.mapping_cache_size: float = args.mapping_cache_size
         self.db_dir: Path = args.db_dir
         self.ani: float = args.ani
         self.conserved_dna: float = args.conserved_dna
         self.sliding_window: int = args.sliding_window
+        self.reference_search: str = args.reference_search
+        self.representatives: int = args.representatives
         self.kmer_length: int = args.kmer_length
         self.sketch_size: int = args.sketch_size
         self.mash_threshold: float = args.mash_threshold
         self.tree_algorithm: str = args.tree_algorithm
+        self.ml_tree_mode: str = args.ml_tree_mode
+        self.ml_tree_cache: Path = args.ml_tree_cache
         self.snippy_report: bool = args.snippy_report
+        self.resource_model: str = args.resource_model
+        self.resource_model_file: Path = args.resource_model_file
+        self.retries: int = args.retries
+        if self.retries is None:
+            self.retries = 2 if self.resource_model == "model" else 0
+        self.retry_memory_factor: float = args.retry_memory_factor
+        self.profile_run: bool = args.profile_run
+        self.group_jobs: bool = args.group_jobs
+        self.group_batch_size: int = args.group_batch_size
+        self.scratch_dir: Path = args.scratch_dir
         self.dryrun: bool = args.dryrun
 
         return args
@@ -181,17 +353,54 @@ class JunoSnp(Pipeline):
         # Don't use mask file if user has not provided a custom ref
         if self.reference is None:
             self.mask = None
+        # The preclustering state is only used when clustering is needed
+        if self.reference is not None:
+            self.precluster_state = None
+        if self.ml_tree_cache is None:
+            self.ml_tree_cache = self.db_dir.joinpath("ml_tree_cache")
+        if self.sketch_cache is None:
+            self.sketch_cache = self.output_dir.joinpath(
+                "preclustering", "sketch_cache"
+            )
 
         if self.snakemake_args["use_singularity"]:
             paths_to_bind = [self.snakemake_args["singularity_args"]]
             paths_to_bind.append(f"--bind {self.db_dir}:{self.db_dir}")
             if self.mask != None:
                 paths_to_bind.append(f"--bind {self.mask}:{self.mask}")
+            if self.precluster_state != None:
+                self.precluster_state.mkdir(parents=True, exist_ok=True)
+                paths_to_bind.append(
+                    f"--bind {self.precluster_state}:{self.precluster_state}"
+                )
+            if self.mapping_cache != None:
+                self.mapping_cache.mkdir(parents=True, exist_ok=True)
+                paths_to_bind.append(
+                    f"--bind {self.mapping_cache}:{self.mapping_cache}"
+                )
+            self.sketch_cache.mkdir(parents=True, exist_ok=True)
+            paths_to_bind.append(f"--bind {self.sketch_cache}:{self.sketch_cache}")
+            if self.ml_tree_mode in ["incremental", "refresh"]:
+                self.ml_tree_cache.mkdir(parents=True, exist_ok=True)
+                paths_to_bind.append(
+                    f"--bind {self.ml_tree_cache}:{self.ml_tree_cache}"
+                )
+            # Only exists on the nodes, so it is not made here
+            if self.scratch_dir != None:
+                paths_to_bind.append(f"--bind {self.scratch_dir}:{self.scratch_dir}")
 
             self.snakemake_args["singularity_args"] = " ".join(
                 paths_to_bind
             )  # paths that singularity should be able to read from can be bound by adding to the above list
 
+        # Snakemake merges this many connected components (clusters) of the
+        # groups of small steps into one cluster job
+        if self.group_jobs:
+            self.snakemake_args["group_components"] = {
+                "cluster_prep": self.group_batch_size,
+                "cluster_post": self.group_batch_size,
+            }
+
         with open(
             Path(__file__).parent.joinpath("config/pipeline_parameters.yaml")
         ) as f:
@@ -210,6 +419,10 @@ class JunoSnp(Pipeline):
             "db_dir": str(self.db_dir),
             "reference": str(self.reference),
             "mask": str(self.mask),
+            "precluster_state": str(self.precluster_state),
+            "max_coverage": str(self.max_coverage),
+            "mapping_cache": str(self.mapping_cache),
+            "mapping_cache_size": self.mapping_cache_size,
             "use_singularity": str(self.snakemake_args["use_singularity"]),
             "dryrun": self.dryrun,
             "referenceseeker": {
@@ -217,14 +430,31 @@ class JunoSnp(Pipeline):
                 "ani_threshold": self.ani,
                 "conserved_dna_threshold": self.conserved_dna,
                 "sliding_window": self.sliding_window,
+                "search": self.reference_search,
+                "representatives": self.representatives,
             },
             "mash": {
                 "kmer_length": self.kmer_length,
                 "sketch_size": self.sketch_size,
                 "threshold": self.mash_threshold,
+                "sketch_cache": str(self.sketch_cache),
+            },
+            "reference_store": {
+                "dir": str(self.db_dir.joinpath("reference_genomes")),
+                "max_size_gb": self.reference_store_size,
             },
             "tree": {"algorithm": self.tree_algorithm},
+            "ml_tree": {"mode": self.ml_tree_mode, "cache": str(self.ml_tree_cache)},
             "snippy": {"report": snippy_report_cmd},
+            "resource_model": {
+                "mode": self.resource_model,
+                "file": str(self.resource_model_file),
+                "retries": self.retries,
+                "retry_factor": self.retry_memory_factor,
+            },
+            "profile_run": self.profile_run,
+            "group_jobs": self.group_jobs,
+            "scratch_dir": str(self.scratch_dir),
         }
 
 
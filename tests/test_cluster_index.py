@@ -0,0 +1,48 @@
+import os
+
+import yaml
+
+from cluster_index import ClusterIndex
+
+
+def write_clusters(path, clusters, mtime_ns=None):
+    path.write_text(yaml.dump(clusters))
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_clusters_file_is_parsed_once(tmp_path):
+    clusters_file = tmp_path.joinpath("clusters.yaml")
+    write_clusters(clusters_file, {"a": 1, "b": 1, "c": 2})
+    index = ClusterIndex()
+    assert index.clusters(clusters_file) == ["1", "2"]
+    samples = index.samples(clusters_file, 1)
+    assert samples == ["a", "b"]
+    assert index.samples(clusters_file, "1") is samples
+    assert index.samples(clusters_file, 3) == []
+
+
+def test_rewritten_clusters_file_is_read_again(tmp_path):
+    clusters_file = tmp_path.joinpath("clusters.yaml")
+    write_clusters(clusters_file, {"a": 1, "b": 1, "c": 2}, mtime_ns=10**18)
+    index = ClusterIndex()
+    assert index.sample_clusters(clusters_file) == {"a": 1, "b": 1, "c": 2}
+
+    # Newer file of the same size
+    write_clusters(clusters_file, {"a": 1, "b": 2, "c": 2}, mtime_ns=2 * 10**18)
+    assert index.samples(clusters_file, 2) == ["b", "c"]
+
+    # Same modification time (e.g. a file system with coarse timestamps), but
+    # another size
+    write_clusters(clusters_file, {"a": 1, "b": 2, "c": 2, "d": 3}, mtime_ns=2 * 10**18)
+    assert index.clusters(clusters_file) == ["1", "2", "3"]
+    assert index.samples(clusters_file, 3) == ["d"]
+
+
+def test_rewritten_plan_is_read_again(tmp_path):
+    plan_file = tmp_path.joinpath("cluster_plan.yaml")
+    write_clusters(plan_file, {"clusters": {1: {"status": "new"}}}, mtime_ns=10**18)
+    index = ClusterIndex()
+    assert index.plan(plan_file, "1") == {"status": "new"}
+    write_clusters(plan_file, {"clusters": {1: {"status": "changed"}}}, mtime_ns=10**18)
+    assert index.plan(plan_file, 1) == {"status": "changed"}
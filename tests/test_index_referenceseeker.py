@@ -0,0 +1,47 @@
+import pandas as pd
+
+from index_referenceseeker import parse_referenceseeker_res, read_index, write_index
+
+HEADER = "#ID\tMash Distance\tANI\tCon. DNA\tTaxonomy ID\tAssembly Status\tOrganism\n"
+HITS = {
+    "sample_2": [
+        ("GCF_000001.1", 0.01, 99.1, 95.0),
+        ("GCF_000002.1", 0.02, 98.2, 90.5),
+    ],
+    "sample_1": [("GCF_000003.1", 0.005, 99.5, 97.25)],
+    "sample_3": [],
+    "sample_10": [("GCF_000001.1", 0.03, 97.0, 88.0)],
+}
+
+
+def write_referenceseeker_results(tmp_path):
+    files = []
+    for sample, hits in HITS.items():
+        path = tmp_path.joinpath(f"referenceseeker_{sample}.tab")
+        with open(path, "w") as file:
+            file.write(HEADER)
+            for accession, distance, ani, con_dna in hits:
+                file.write(
+                    f"{accession}\t{distance}\t{ani}\t{con_dna}\t1\tcomplete\tE. coli\n"
+                )
+        files.append(path)
+    return files
+
+
+def test_index_has_the_rows_of_the_requested_samples(tmp_path):
+    files = write_referenceseeker_results(tmp_path)
+    index = tmp_path.joinpath("referenceseeker_index")
+    write_index(*parse_referenceseeker_res(files), index)
+
+    for sample in HITS:
+        rows, samples = read_index(index, [sample])
+        assert samples == list(HITS)
+        parsed, _ = parse_referenceseeker_res(
+            [tmp_path.joinpath(f"referenceseeker_{sample}.tab")]
+        )
+        pd.testing.assert_frame_equal(rows, parsed, check_dtype=False)
+
+    rows, _ = read_index(index, ["sample_10", "sample_1", "unknown"])
+    assert rows["Sample"].tolist() == ["sample_1", "sample_10"]
+    rows, _ = read_index(index)
+    assert len(rows) == 4
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import make_tree
+from make_tree import neighbour_joining
+
+
+def unpruned_joins(names, dm):
+    """
+    Neighbour joining computing the whole Q matrix at every step, with the
+    rows in the same order as ActiveMatrix (the join in row i, the last row
+    moved to row j) so ties are broken the same way: the first minimum.
+    Returns per join the leaves of both sides with their branch length.
+    """
+    dm = np.array(dm, dtype=np.float64)
+    clades = [frozenset([name]) for name in names]
+    joins = []
+    while len(clades) > 2:
+        n = len(clades)
+        sums = dm.sum(axis=1)
+        q = (n - 2) * dm - sums[:, np.newaxis] - sums
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(q.argmin(), q.shape)
+        length_i = dm[i, j] / 2 + (sums[i] - sums[j]) / (2 * (n - 2))
+        joins.append({clades[i]: length_i, clades[j]: dm[i, j] - length_i})
+        distances = (dm[i] + dm[j] - dm[i, j]) / 2
+        distances[[i, j]] = 0
+        dm[i], dm[:, i] = distances, distances
+        clades[i] = clades[i] | clades[j]
+        dm[j], dm[:, j] = dm[n - 1], dm[:, n - 1]
+        dm[j, j] = 0
+        clades[j] = clades[n - 1]
+        dm = dm[: n - 1, : n - 1]
+        clades.pop()
+    return joins
+
+
+def pruned_joins(monkeypatch, names, dm):
+    """Joins made by neighbour_joining, in the format of unpruned_joins"""
+    joins = []
+    add_node = make_tree.Tree.add_node
+
+    def leaves(tree, node):
+        if not tree.children[node]:
+            return frozenset([tree.names[node]])
+        return frozenset().union(
+            *(leaves(tree, child) for child, _ in tree.children[node])
+        )
+
+    def recording_add_node(tree, children):
+        joins.append({leaves(tree, child): length for child, length in children})
+        return add_node(tree, children)
+
+    monkeypatch.setattr(make_tree.Tree, "add_node", recording_add_node)
+    neighbour_joining(names, dm)
+    # The last two nodes are joined without a new node
+    return joins[: len(names) - 2]
+
+
+def random_matrix(n_samples, n_features, max_value, seed):
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, max_value + 1, size=(n_samples, n_features))
+    dm = np.abs(points[:, None, :] - points[None, :, :]).sum(axis=2)
+    return [f"sample_{i}" for i in range(n_samples)], dm.astype(float)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize(
+    "n_samples, n_features, max_value",
+    [
+        (30, 20, 50),
+        # Few distinct distances: many ties in Q, and identical samples
+        (30, 3, 1),
+        (25, 1, 2),
+    ],
+)
+def test_pruned_search_makes_the_same_joins(
+    monkeypatch, seed, n_samples, n_features, max_value
+):
+    names, dm = random_matrix(n_samples, n_features, max_value, seed)
+    expected = unpruned_joins(names, dm)
+    joins = pruned_joins(monkeypatch, names, dm)
+    assert [set(join) for join in joins] == [set(join) for join in expected]
+    for join, expected_join in zip(joins, expected):
+        assert join == pytest.approx(expected_join)
@@ -0,0 +1,92 @@
+import pandas as pd
+from Bio import Phylo
+
+from ml_tree_cache import find_cached_tree, prepare, read_model, store
+
+TREE = "((Reference:0.1,(s1:0.1,s2:0.1):0.1):0.1,(s3:0.1,(s4:0.1,s5:0.1):0.1):0.1);\n"
+IQTREE_REPORT = """\
+IQ-TREE 2.2.2.6 built May 27 2023
+
+Best-fit model according to BIC: GTR+F+ASC+G4
+
+List of models sorted by BIC scores:
+"""
+# Position of every taxon on a line, SNP distance = difference in position
+POSITIONS = {
+    "Reference": 0,
+    "s1": 1,
+    "s2": 2,
+    "s3": 10,
+    "s4": 11,
+    "s5": 12,
+    "s6": 13,
+    "s7": 20,
+    "s8": 21,
+}
+# Taxa of TREE
+STORED_TAXA = ["Reference", "s1", "s2", "s3", "s4", "s5"]
+
+
+def write_alignment(path, taxa):
+    path.write_text("".join(f">{taxon}\nACGT\n" for taxon in taxa))
+
+
+def write_snp_matrix(path, taxa):
+    pd.DataFrame(
+        [[abs(POSITIONS[t_1] - POSITIONS[t_2]) for t_2 in taxa] for t_1 in taxa],
+        index=taxa,
+        columns=taxa,
+    ).to_csv(path)
+
+
+def store_run(tmp_path, cache, reference):
+    run_dir = tmp_path.joinpath("run")
+    run_dir.mkdir(exist_ok=True)
+    alignment = run_dir.joinpath("cluster_1.aln")
+    write_alignment(alignment, STORED_TAXA)
+    run_dir.joinpath("cluster_1.treefile").write_text(TREE)
+    run_dir.joinpath("cluster_1.iqtree").write_text(IQTREE_REPORT)
+    store(cache, reference, alignment, str(run_dir.joinpath("cluster_1")))
+
+
+def prepare_run(tmp_path, cache, reference, taxa, name):
+    alignment = tmp_path.joinpath(f"{name}.aln")
+    write_alignment(alignment, taxa)
+    snp_matrix = tmp_path.joinpath(f"{name}.csv")
+    write_snp_matrix(snp_matrix, taxa)
+    output_dir = tmp_path.joinpath(name)
+    prepare(cache, reference, alignment, snp_matrix, output_dir)
+    return output_dir
+
+
+def test_new_taxa_are_grafted_in_the_cached_tree(tmp_path):
+    cache = tmp_path.joinpath("cache")
+    reference = tmp_path.joinpath("ref_genome.fasta")
+    reference.write_text(">contig_1\nACGT\n")
+    store_run(tmp_path, cache, reference)
+    entry = next(next(cache.iterdir()).iterdir())
+    assert read_model(tmp_path.joinpath("run", "cluster_1.iqtree")) == "GTR+F+ASC+G4"
+    assert find_cached_tree(entry.parent, ["s1", "s2"]) is None
+    assert find_cached_tree(entry.parent, ["s1", "s2", "s3"]) == entry
+
+    # s5 left and s6 is new: it is placed next to s4, its closest taxon
+    taxa = ["Reference", "s1", "s2", "s3", "s4", "s6"]
+    start = prepare_run(tmp_path, cache, reference, taxa, "start")
+    tree = Phylo.read(start.joinpath("start_tree.nwk"), "newick")
+    assert sorted(leaf.name for leaf in tree.get_terminals()) == sorted(taxa)
+    s4, s6 = tree.find_any(name="s4"), tree.find_any(name="s6")
+    assert tree.get_path(s4)[:-1] == tree.get_path(s6)[:-1]
+    assert start.joinpath("model.txt").read_text().strip() == "GTR+F+ASC+G4"
+
+
+def test_model_is_selected_again_for_many_new_taxa(tmp_path):
+    cache = tmp_path.joinpath("cache")
+    reference = tmp_path.joinpath("ref_genome.fasta")
+    reference.write_text(">contig_1\nACGT\n")
+    store_run(tmp_path, cache, reference)
+    # 3 of 9 taxa are new
+    taxa = list(POSITIONS)
+    start = prepare_run(tmp_path, cache, reference, taxa, "start")
+    tree = Phylo.read(start.joinpath("start_tree.nwk"), "newick")
+    assert sorted(leaf.name for leaf in tree.get_terminals()) == sorted(taxa)
+    assert not start.joinpath("model.txt").exists()
@@ -0,0 +1,60 @@
+import itertools
+
+import numpy as np
+import pytest
+from Bio import Phylo
+
+from make_tree import neighbour_joining, upgma
+from newick2dm import newick2dm
+
+
+def phylo_distances(newick_file):
+    tree = Phylo.read(newick_file, "newick")
+    terminals = tree.get_terminals()
+    dm = np.zeros((len(terminals), len(terminals)))
+    for (i, a), (j, b) in itertools.combinations(enumerate(terminals), 2):
+        dm[i, j] = dm[j, i] = tree.distance(a, b)
+    return [terminal.name for terminal in terminals], dm
+
+
+def random_snp_matrix(n_samples, seed):
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 50, size=(n_samples, 20))
+    dm = np.abs(points[:, None, :] - points[None, :, :]).sum(axis=2)
+    return [f"sample_{i}" for i in range(n_samples)], dm.astype(float)
+
+
+@pytest.mark.parametrize("make_tree", [upgma, neighbour_joining])
+@pytest.mark.parametrize("seed", range(5))
+def test_same_distances_as_phylo(tmp_path, make_tree, seed):
+    newick_file = tmp_path.joinpath("tree.nwk")
+    newick_file.write_text(make_tree(*random_snp_matrix(12, seed)) + "\n")
+    names, dm = newick2dm(newick_file)
+    expected_names, expected_dm = phylo_distances(newick_file)
+    assert names == expected_names
+    np.testing.assert_allclose(dm, expected_dm)
+
+
+def test_deep_tree_without_some_branch_lengths(tmp_path):
+    # Caterpillar tree deeper than the recursion limit, with missing lengths:
+    # sample_i hangs from node i (sample_0 and sample_1 both from node 1)
+    # and node i from node i + 1 at distance 0.5
+    n_samples = 1500
+    lengths = np.array([1] + [0 if i % 7 == 0 else i % 5 for i in range(1, n_samples)])
+    newick = "sample_0:1"
+    for i in range(1, n_samples):
+        length = "" if i % 7 == 0 else f":{i % 5}"
+        newick = f"({newick},sample_{i}{length}):0.5"
+    newick_file = tmp_path.joinpath("tree.nwk")
+    newick_file.write_text(newick + ";\n")
+    names, dm = newick2dm(newick_file)
+    order = [int(name.split("_")[1]) for name in names]
+    assert sorted(order) == list(range(n_samples))
+    nodes = np.maximum(order, 1)
+    expected = (
+        lengths[order][:, None]
+        + lengths[order][None, :]
+        + 0.5 * np.abs(nodes[:, None] - nodes[None, :])
+    )
+    np.fill_diagonal(expected, 0)
+    np.testing.assert_allclose(dm, expected)
@@ -0,0 +1,203 @@
+import os
+import random
+import shutil
+
+import numpy as np
+
+import precluster_state
+import preclustering
+
+THRESHOLD = 0.01
+KMER_LENGTH = 21
+SKETCH_SIZE = 1000
+
+
+def write_distances(path, queries, refs, positions):
+    """Mash dist output of samples on a line (distance = difference in position)"""
+    with open(path, "a") as file:
+        for query in queries:
+            for ref in refs:
+                dist = abs(positions[query] - positions[ref])
+                file.write(f"{ref}.fasta\t{query}.fasta\t{dist}\t0\t1000/1000\n")
+
+
+def partition(clusters):
+    members = {}
+    for sample, cluster in clusters.items():
+        members.setdefault(cluster, set()).add(sample)
+    return sorted(sorted(samples) for samples in members.values())
+
+
+def full_run(samples, positions, tmp_path):
+    distances = tmp_path.joinpath("full.tsv")
+    write_distances(distances, samples, samples, positions)
+    union_find = preclustering.stream_mash_clusters(str(distances), THRESHOLD)
+    return preclustering.define_clusters(union_find, set(samples))
+
+
+def test_chain_is_split_without_its_middle_sample(tmp_path):
+    positions = {"a": 0.0, "b": 0.008, "c": 0.016}
+    state = tmp_path.joinpath("state.yaml")
+    distances = tmp_path.joinpath("run_1.tsv")
+    write_distances(distances, list(positions), list(positions), positions)
+    union_find = preclustering.stream_mash_clusters(str(distances), THRESHOLD)
+    preclustering.write_state(union_find, state, KMER_LENGTH, SKETCH_SIZE)
+
+    samples = {"a", "c"}
+    union_find = preclustering.load_state(state, samples)
+    assert len(union_find.index) == 0
+    distances = tmp_path.joinpath("run_2.tsv")
+    write_distances(distances, ["a", "c"], ["a", "b", "c"], positions)
+    union_find = preclustering.stream_mash_clusters(
+        str(distances), THRESHOLD, union_find=union_find, samples=samples
+    )
+    clusters = preclustering.define_clusters(union_find, samples)
+    assert clusters["a"] != clusters["c"]
+
+
+def test_incremental_run_matches_full_run(tmp_path):
+    for seed in range(20):
+        rng = random.Random(seed)
+        positions = {f"s{i}": rng.uniform(0, 0.2) for i in range(60)}
+        run_1 = rng.sample(list(positions), 30)
+        state = tmp_path.joinpath(f"state_{seed}.yaml")
+        distances = tmp_path.joinpath(f"run_1_{seed}.tsv")
+        write_distances(distances, run_1, run_1, positions)
+        union_find = preclustering.stream_mash_clusters(str(distances), THRESHOLD)
+        preclustering.write_state(union_find, state, KMER_LENGTH, SKETCH_SIZE)
+
+        # Samples are removed and added; as the pipeline does, the new samples
+        # and the other members of pre-clusters that lost samples are compared
+        # with each other and with all stored sketches
+        removed = set(rng.sample(run_1, 5))
+        added = rng.sample([s for s in positions if s not in run_1], 10)
+        run_2 = [sample for sample in run_1 if sample not in removed] + added
+        known = precluster_state.read_state(state, KMER_LENGTH, SKETCH_SIZE)
+        compared = precluster_state.samples_to_sketch(run_2, known)
+        distances = tmp_path.joinpath(f"run_2_{seed}.tsv")
+        write_distances(distances, compared, compared, positions)
+        write_distances(distances, compared, run_1, positions)
+
+        samples = set(run_2)
+        union_find = preclustering.load_state(state, samples)
+        union_find = preclustering.stream_mash_clusters(
+            str(distances), THRESHOLD, union_find=union_find, samples=samples
+        )
+        incremental = preclustering.define_clusters(union_find, samples)
+        full_dir = tmp_path.joinpath(f"full_{seed}")
+        full_dir.mkdir()
+        assert partition(incremental) == partition(full_run(run_2, positions, full_dir))
+
+
+def incremental_run(state_dir, samples, components, kmer_length=KMER_LENGTH):
+    """
+    The state handling of an incremental run: the samples to sketch are
+    sketched (a file with the sample name), a new state is prepared with the
+    pre-clusters (components) and made current as update_precluster_state
+    does (removing the previous state). Returns the samples that were sketched.
+    """
+    current = state_dir.joinpath("current").resolve()
+    known = precluster_state.known_samples(current, kmer_length, SKETCH_SIZE)
+    sketched = precluster_state.samples_to_sketch(samples, known)
+    run_dir = state_dir.parent.joinpath(f"run_{len(os.listdir(state_dir.parent))}")
+    run_dir.mkdir()
+    new_sketches = {}
+    for sample in sketched:
+        new_sketches[sample] = run_dir.joinpath(f"{sample}.msh")
+        new_sketches[sample].write_text(sample)
+    state_file = run_dir.joinpath("precluster_state.yaml")
+    precluster_state.save_state(
+        {sample: components[sample] for sample in samples},
+        state_file,
+        kmer_length,
+        SKETCH_SIZE,
+    )
+    new_state = precluster_state.prepare_state(
+        state_dir, current, state_file, new_sketches, samples
+    )
+    new_state.with_suffix(".link").symlink_to(new_state.name)
+    os.replace(new_state.with_suffix(".link"), state_dir.joinpath("current"))
+    if current.name != "current":
+        shutil.rmtree(current)
+    return sketched
+
+
+def test_state_holds_every_sample_of_the_run_once(tmp_path):
+    state_dir = tmp_path.joinpath("state")
+    components = {"a": 0, "b": 0, "c": 1, "d": 2, "e": 3}
+    assert incremental_run(state_dir, ["a", "b", "c"], components) == ["a", "b", "c"]
+    assert incremental_run(state_dir, ["a", "b", "c", "d"], components) == ["d"]
+    # b left, so a (same pre-cluster) is sketched and compared again
+    assert incremental_run(state_dir, ["a", "c", "d", "e"], components) == ["a", "e"]
+
+    current = state_dir.joinpath("current")
+    sketched = current.joinpath("sketched_samples.txt").read_text().split()
+    assert sketched == ["a", "c", "d", "e"]
+    assert sorted(os.listdir(current.joinpath("sketches"))) == [
+        "a.msh",
+        "c.msh",
+        "d.msh",
+        "e.msh",
+    ]
+    sketch_list = current.joinpath("sketch_list.txt").read_text().split()
+    assert [open(sketch).read() for sketch in sketch_list] == sketched
+    # Only the current state is kept
+    assert sorted(os.listdir(state_dir)) == ["current", current.resolve().name]
+
+
+def test_state_of_other_sketch_settings_is_not_used(tmp_path):
+    state_dir = tmp_path.joinpath("state")
+    components = {"a": 0, "b": 1}
+    incremental_run(state_dir, ["a", "b"], components)
+    assert incremental_run(state_dir, ["a", "b"], components, kmer_length=17) == [
+        "a",
+        "b",
+    ]
+    assert (
+        len(
+            preclustering.load_state(
+                state_dir.joinpath("current", "precluster_state.yaml"),
+                {"a", "b"},
+                KMER_LENGTH,
+                SKETCH_SIZE,
+            ).index
+        )
+        == 0
+    )
+
+
+def test_plot_data_is_collected_while_clustering(tmp_path, monkeypatch):
+    monkeypatch.setattr(preclustering, "MAX_HEATMAP_SIZE", 12)
+    rng = random.Random(1)
+    positions = {f"s{i}": rng.uniform(0, 0.1) for i in range(20)}
+    samples = list(positions)
+    distances = tmp_path.joinpath("distances.tsv")
+    write_distances(distances, samples, samples, positions)
+    plot_data = preclustering.PlotData()
+    # Small chunks, so components merge after their links were collected
+    union_find = preclustering.stream_mash_clusters(
+        str(distances), THRESHOLD, chunksize=7, plot_data=plot_data
+    )
+    clusters = preclustering.define_clusters(union_find)
+    heatmap, heatmap_clusters, cluster_links = plot_data.for_clusters(
+        union_find, clusters
+    )
+
+    shown = sorted(list(union_find.index)[:12], key=clusters.get)
+    assert heatmap_clusters == [clusters[sample] for sample in shown]
+    shown_positions = np.array([positions[sample] for sample in shown])
+    expected = np.abs(shown_positions[:, None] - shown_positions[None, :])
+    # Distances of samples to themselves are not drawn
+    np.fill_diagonal(expected, np.nan)
+    np.testing.assert_allclose(heatmap, expected, rtol=1e-6)
+
+    expected_links = {}
+    for sample_1 in samples:
+        for sample_2 in samples:
+            pair = tuple(sorted((clusters[sample_1], clusters[sample_2])))
+            if pair[0] != pair[1]:
+                dist = abs(positions[sample_1] - positions[sample_2])
+                expected_links[pair] = min(dist, expected_links.get(pair, 1))
+    assert cluster_links.to_dict().keys() == expected_links.keys()
+    for pair, dist in expected_links.items():
+        assert abs(cluster_links[pair] - dist) < 1e-12
@@ -0,0 +1,80 @@
+import json
+import os
+
+from profile_report import profile_report
+
+# Jobs as Snakemake prints them in the log of a run
+RUN_LOG = """\
+[Sun Oct 18 11:14:45 2026]
+rule map:
+    input: {output_dir}/reads/s1.fq
+    output: {output_dir}/map/cluster_1/s1.bam
+    jobid: 2
+    benchmark: {output_dir}/log/benchmark/map/cluster_1/s1.tsv
+    reason: Missing output files: {output_dir}/map/cluster_1/s1.bam
+    wildcards: cluster=1, sample=s1
+    resources: tmpdir=/tmp
+
+[Sun Oct 18 11:14:46 2026]
+Finished job 2.
+1 of 3 steps (33%) done
+
+[Sun Oct 18 11:14:46 2026]
+rule core:
+    input: {output_dir}/map/cluster_1/s1.bam
+    output: {output_dir}/core/cluster_1.aln
+    jobid: 1
+    benchmark: {output_dir}/log/benchmark/core/cluster_1.tsv
+    wildcards: cluster=1
+    threads: 4
+"""
+BENCHMARK = (
+    "s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\tcpu_time\n"
+)
+
+
+def write_benchmark(path, seconds, mtime):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        BENCHMARK + f"{seconds}\t0:00:01\t100\t0\t0\t0\t1\t2\t50\t{seconds}\n"
+    )
+    os.utime(path, (mtime, mtime))
+
+
+def test_report_from_benchmarks_and_run_log(tmp_path):
+    output_dir = tmp_path.joinpath("out")
+    benchmark_dir = output_dir.joinpath("log", "benchmark")
+    patterns = {
+        "map": str(benchmark_dir.joinpath("map", "cluster_{cluster}", "{sample}.tsv")),
+        "core": str(benchmark_dir.joinpath("core", "cluster_{cluster}.tsv")),
+    }
+    patterns_file = tmp_path.joinpath("patterns.json")
+    patterns_file.write_text(json.dumps(patterns))
+    run_log = tmp_path.joinpath("run.log")
+    run_log.write_text(RUN_LOG.format(output_dir=output_dir))
+    output_dir.joinpath("reads").mkdir(parents=True)
+    output_dir.joinpath("reads", "s1.fq").write_text("@r\nACGT\n+\nIIII\n")
+    write_benchmark(benchmark_dir.joinpath("map", "cluster_1", "s1.tsv"), 10, 1010)
+    write_benchmark(benchmark_dir.joinpath("core", "cluster_1.tsv"), 5, 1020)
+    # Left by an earlier run
+    write_benchmark(benchmark_dir.joinpath("map", "cluster_1", "s2.tsv"), 10, 10)
+
+    report_dir = tmp_path.joinpath("profile")
+    profile_report(
+        patterns_file,
+        run_log,
+        1000,
+        tmp_path.joinpath("clusters.yaml"),
+        output_dir,
+        report_dir,
+    )
+    with open(report_dir.joinpath("report.json")) as file:
+        report = json.load(file)
+    assert report["summary"]["jobs"] == 2
+    assert report["summary"]["wall_time_s"] == 20
+    path = report["critical_path"]
+    assert [job["rule"] for job in path] == ["map", "core"]
+    assert [job["sample"] for job in path] == ["s1", None]
+    assert [job["cluster"] for job in path] == ["1", "1"]
+    assert path[0]["input_gb"] == 15 / 1e9
+    assert path[1]["wait"] == 5
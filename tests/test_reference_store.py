@@ -0,0 +1,65 @@
+import os
+
+from reference_store import ReferenceStore, evict_lru
+
+
+def fetch(accession_nr, output_dir):
+    ref_genome = output_dir.joinpath("ref_genome.seq")
+    ref_genome.write_text(f">{accession_nr}\n" + "ACGT" * 256 + "\n")
+    return ref_genome
+
+
+def test_reference_is_copied_across_file_systems(tmp_path, monkeypatch):
+    def cross_device_link(source, destination):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", cross_device_link)
+    store = ReferenceStore(tmp_path.joinpath("store"), fetch, max_size_gb=0)
+    ref_genome = store.get("GCF_1", tmp_path.joinpath("out", "ref_genome.seq"))
+    assert not ref_genome.is_symlink()
+    assert ref_genome.read_text().startswith(">GCF_1")
+    # The copy does not depend on the store
+    store.get("GCF_2", tmp_path.joinpath("out_2", "ref_genome.seq"))
+    assert not store.entry("GCF_1").exists()
+    assert ref_genome.read_text().startswith(">GCF_1")
+
+
+def test_linked_entries_are_not_evicted(tmp_path):
+    store = ReferenceStore(tmp_path.joinpath("store"), fetch, max_size_gb=0)
+    used = store.get("GCF_1", tmp_path.joinpath("cluster_1", "ref_genome.seq"))
+    unused = store.get("GCF_2", tmp_path.joinpath("cluster_2", "ref_genome.seq"))
+    os.remove(unused)
+    store.get("GCF_3", tmp_path.joinpath("cluster_3", "ref_genome.seq"))
+    assert store.entry("GCF_1").exists()
+    assert not store.entry("GCF_2").exists()
+    assert used.read_text().startswith(">GCF_1")
+
+
+def test_evict_least_recently_used(tmp_path):
+    for i, name in enumerate(["old", "new"]):
+        entry = tmp_path.joinpath(name)
+        entry.mkdir()
+        entry.joinpath("data").write_bytes(b"x" * 1000)
+        entry.joinpath("last_used").touch()
+        os.utime(entry.joinpath("last_used"), (i, i))
+    evict_lru(tmp_path, 1500)
+    assert not tmp_path.joinpath("old").exists()
+    assert tmp_path.joinpath("new").exists()
+
+
+def test_linked_entries_count_toward_the_size(tmp_path, capsys):
+    for i, name in enumerate(["linked", "unlinked"]):
+        entry = tmp_path.joinpath("store", name)
+        entry.mkdir(parents=True)
+        entry.joinpath("data").write_bytes(b"x" * 1000)
+        entry.joinpath("last_used").touch()
+        os.utime(entry.joinpath("last_used"), (i, i))
+    os.link(tmp_path.joinpath("store", "linked", "data"), tmp_path.joinpath("output"))
+    evict_lru(tmp_path.joinpath("store"), 1500)
+    assert tmp_path.joinpath("store", "linked").exists()
+    assert not tmp_path.joinpath("store", "unlinked").exists()
+    assert "linked from elsewhere" not in capsys.readouterr().out
+
+    evict_lru(tmp_path.joinpath("store"), 500)
+    assert tmp_path.joinpath("store", "linked").exists()
+    assert "1000 bytes are still linked from elsewhere" in capsys.readouterr().out
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from snakemake.io import Wildcards
+
+from cluster_index import ClusterIndex
+from resource_model import ResourceModel, fit
+
+CONFIG = {
+    "threads": {"snippy": 4, "other": 1},
+    "mem_gb": {"snippy": 6, "other": 2},
+}
+
+
+def resource_model(tmp_path, mode, model=None):
+    model_file = tmp_path.joinpath("resource_model.yaml")
+    model_file.write_text(yaml.dump(model or {}))
+    clusters_file = tmp_path.joinpath("clusters.yaml")
+    clusters_file.write_text(yaml.dump({"a": 1, "b": 1, "c": 1, "d": 1, "e": 2}))
+    reference_dir = tmp_path.joinpath("out", "ref_genomes_used", "cluster_1")
+    reference_dir.mkdir(parents=True)
+    reference_dir.joinpath("ref_genome.fasta.fai").write_text(
+        "contig_1\t1500000\t10\t60\t61\ncontig_2\t500000\t20\t60\t61\n"
+    )
+    settings = {
+        "mode": mode,
+        "retries": 2,
+        "file": str(model_file),
+        "retry_factor": 1.5,
+    }
+    return ResourceModel(
+        {**CONFIG, "resource_model": settings},
+        ClusterIndex(),
+        clusters_file,
+        tmp_path.joinpath("out"),
+    )
+
+
+def test_fixed_mode_uses_the_values_per_tool(tmp_path):
+    resources = resource_model(tmp_path, "fixed")
+    wildcards = Wildcards(fromdict={"cluster": "1"})
+    assert resources.threads("snippy")(wildcards, [], "snp_analysis") == 4
+    assert resources.mem_gb("snippy")(wildcards, [], 1, "snp_analysis") == 6
+    assert resources.runtime("snippy")(wildcards, [], 1, "snp_analysis") is None
+    assert resources.retries == 2
+
+
+def test_memory_grows_with_every_attempt(tmp_path):
+    resources = resource_model(tmp_path, "fixed")
+    get_mem_gb = resources.mem_gb("snippy")
+    wildcards = Wildcards()
+    assert [
+        get_mem_gb(wildcards, [], attempt, "snp_analysis") for attempt in [1, 2, 3]
+    ] == [6, 9, 14]
+
+
+def test_model_mode_predicts_from_the_cluster(tmp_path):
+    model = {
+        "rules": {
+            "snp_core": {
+                "threads": {"intercept": 1, "n_samples": 0.5},
+                "mem_gb": {"intercept": 1, "ref_mb": 1, "n_samples": 0.5, "max": 4},
+                "runtime": {"intercept": 5, "input_gb": 1000},
+            }
+        }
+    }
+    resources = resource_model(tmp_path, "model", model)
+    input_file = tmp_path.joinpath("core.aln")
+    input_file.write_bytes(b"A" * 1000)
+    wildcards = Wildcards(fromdict={"cluster": "1"})
+    # 4 samples and a reference of 2 Mb
+    assert resources.threads("other")(wildcards, [input_file], "snp_core") == 3
+    # The prediction (5) is clipped to its maximum, the retries still get more
+    get_mem_gb = resources.mem_gb("other")
+    assert [
+        get_mem_gb(wildcards, [], attempt, "snp_core") for attempt in [1, 2, 3]
+    ] == [4, 6, 9]
+    get_runtime = resources.runtime("other")
+    # 5 + 1000 * 1e-6 GB minutes
+    assert get_runtime(wildcards, [input_file], 1, "snp_core") == 6
+    assert get_runtime(wildcards, [input_file], 2, "snp_core") == 8
+    # Rules that are not in the model keep the values per tool
+    assert resources.mem_gb("snippy")(wildcards, [], 2, "snp_analysis") == 9
+    assert resources.runtime("snippy")(wildcards, [], 1, "snp_analysis") is None
+
+
+def test_fit_recovers_the_coefficients(tmp_path):
+    rng = np.random.default_rng(1)
+    n_jobs = 50
+    jobs = pd.DataFrame(
+        {
+            "rule": "snp_analysis",
+            "input_gb": rng.uniform(0.1, 5, n_jobs),
+            "ref_mb": rng.uniform(1, 10, n_jobs),
+            "n_samples": 1,
+        }
+    )
+    mem_gb = 2 + 3 * jobs["input_gb"] + 0.5 * jobs["ref_mb"]
+    runtime = 10 + 4 * jobs["input_gb"] - 0.2 * jobs["ref_mb"]
+    jobs["max_rss"] = mem_gb * 1024
+    jobs["s"] = runtime * 60
+    # Too few jobs to fit
+    jobs = pd.concat([jobs, jobs.head(3).assign(rule="snp_core")], ignore_index=True)
+    observations = tmp_path.joinpath("jobs.tsv")
+    jobs.to_csv(observations, sep="\t", index=False)
+    model_file = tmp_path.joinpath("resource_model.yaml")
+    model_file.write_text(
+        yaml.dump(
+            {
+                "rules": {
+                    "snp_analysis": {
+                        "threads": {"intercept": 4},
+                        "mem_gb": {"intercept": 1, "min": 4, "max": 64},
+                    },
+                    "snp_core": {"mem_gb": {"intercept": 1}},
+                }
+            }
+        )
+    )
+    output = tmp_path.joinpath("fitted.yaml")
+    fit([observations], model_file, output)
+    with open(output) as file:
+        rules = yaml.safe_load(file)["rules"]
+
+    fitted = rules["snp_analysis"]
+    assert fitted["threads"] == {"intercept": 4}
+    # The memory is exactly linear: no margin is added. The limits are kept
+    # and n_samples, which does not vary, is left out
+    assert fitted["mem_gb"] == pytest.approx(
+        {"intercept": 2, "input_gb": 3, "ref_mb": 0.5, "min": 4, "max": 64}
+    )
+    # The negative coefficient of the reference is dropped and the runtime
+    # refitted on the input size, with a margin over most jobs
+    assert set(fitted["runtime"]) == {"intercept", "input_gb"}
+    assert fitted["runtime"]["input_gb"] == pytest.approx(4, abs=0.2)
+    predicted = fitted["runtime"]["intercept"] + 4 * jobs["input_gb"].head(n_jobs)
+    assert (predicted >= runtime - 0.2).mean() >= 0.9
+    assert rules["snp_core"] == {"mem_gb": {"intercept": 1}}
@@ -0,0 +1,109 @@
+from run_manifest import plan_clusters, stable_cluster_ids, update_manifest
+
+# Manifest of a previous run: cluster 3 was removed in an earlier run, so
+# the next new cluster is 4 and 3 is never used again
+MANIFEST = {
+    "next_cluster": 4,
+    "clusters": {
+        1: {"samples": {"a": "", "b": "", "c": ""}},
+        2: {"samples": {"d": "", "e": ""}},
+    },
+}
+
+
+def test_clusters_without_manifest_are_unchanged():
+    clusters = {"a": 1, "b": 1, "c": 2}
+    assert stable_cluster_ids(clusters, {}) == clusters
+
+
+def test_grown_cluster_keeps_its_number():
+    clusters = {"d": 1, "e": 1, "x": 1, "a": 2, "b": 2, "c": 2}
+    assert stable_cluster_ids(clusters, MANIFEST) == {
+        "d": 2,
+        "e": 2,
+        "x": 2,
+        "a": 1,
+        "b": 1,
+        "c": 1,
+    }
+
+
+def test_merged_clusters_keep_the_number_of_the_largest_share():
+    clusters = {"d": 1, "e": 1, "a": 1, "b": 1, "c": 1}
+    assert set(stable_cluster_ids(clusters, MANIFEST).values()) == {1}
+
+
+def test_split_cluster_keeps_its_number_for_the_largest_part():
+    clusters = {"a": 1, "b": 1, "c": 2, "d": 3, "e": 3}
+    assert stable_cluster_ids(clusters, MANIFEST) == {
+        "a": 1,
+        "b": 1,
+        "c": 4,
+        "d": 2,
+        "e": 2,
+    }
+
+
+def test_new_clusters_get_numbers_never_used_before():
+    clusters = {"x": 1, "y": 1, "z": 2, "a": 3, "b": 3, "c": 3}
+    new_ids = stable_cluster_ids(clusters, MANIFEST)
+    # Cluster 2 left in this run and is not given to a new cluster either
+    assert new_ids == {"x": 4, "y": 4, "z": 5, "a": 1, "b": 1, "c": 1}
+
+
+def write_assemblies(directory, contents):
+    assemblies = {}
+    for sample, content in contents.items():
+        assemblies[sample] = directory.joinpath(f"{sample}.fasta")
+        assemblies[sample].write_text(f">{sample}\n{content}\n")
+    return assemblies
+
+
+def write_references(output_dir, clusters):
+    for cluster in set(clusters.values()):
+        reference = output_dir.joinpath(
+            "ref_genomes_used", f"cluster_{cluster}", "ref_genome.seq"
+        )
+        reference.parent.mkdir(parents=True, exist_ok=True)
+        reference.write_text(f">reference_{cluster}\nACGT\n")
+
+
+def test_plan_of_a_repeated_run(tmp_path):
+    assemblies = write_assemblies(
+        tmp_path, {"a": "ACGT", "b": "ACGA", "c": "TTTT", "d": "GGGG"}
+    )
+    clusters = {"a": 1, "b": 1, "c": 2, "d": 3}
+    first = plan_clusters(clusters, assemblies, {})
+    assert {entry["status"] for entry in first["clusters"].values()} == {"new"}
+    assert first["next_cluster"] == 4
+    write_references(tmp_path, clusters)
+    manifest = update_manifest(first, clusters, tmp_path)
+
+    # Sample e joins cluster 2, the assembly of d changed and cluster 1 is
+    # the same
+    assemblies.update(write_assemblies(tmp_path, {"d": "GGGC", "e": "TTTA"}))
+    clusters = stable_cluster_ids({"a": 1, "b": 1, "c": 2, "e": 2, "d": 3}, manifest)
+    second = plan_clusters(clusters, assemblies, manifest)
+    assert {
+        cluster: entry["status"] for cluster, entry in second["clusters"].items()
+    } == {
+        1: "unchanged",
+        2: "changed",
+        3: "changed",
+    }
+    assert second["clusters"][1]["digest"] == first["clusters"][1]["digest"]
+    assert second["clusters"][2]["added"] == 1
+    assert second["clusters"][2]["removed"] == 0
+    assert second["removed_clusters"] == []
+    assert second["next_cluster"] == 4
+
+    # Cluster 3 leaves: its number is not used for the new cluster of f
+    assemblies.update(write_assemblies(tmp_path, {"f": "CCCC"}))
+    write_references(tmp_path, clusters)
+    manifest = update_manifest(second, clusters, tmp_path)
+    clusters = stable_cluster_ids({"a": 1, "b": 1, "c": 2, "e": 2, "f": 3}, manifest)
+    assert clusters["f"] == 4
+    third = plan_clusters(clusters, assemblies, manifest)
+    assert third["clusters"][4]["status"] == "new"
+    assert third["removed_clusters"] == [3]
+    assert third["next_cluster"] == 5
@@ -0,0 +1,50 @@
+import numpy as np
+
+from select_representatives import read_cluster_distances, select_representatives
+
+# Cluster 1: samples on a line (distance = difference in position), cluster
+# 2 is too small to select from
+POSITIONS = {"a": 0.0, "b": 0.001, "c": 0.002, "d": 0.003, "e": 0.01}
+CLUSTERS = {"a": 1, "b": 1, "c": 1, "d": 1, "e": 1, "f": 2, "g": 2}
+
+
+def write_distances(path, missing=()):
+    with open(path, "w") as file:
+        for query in CLUSTERS:
+            for ref in CLUSTERS:
+                if {query, ref} in [set(pair) for pair in missing]:
+                    continue
+                dist = abs(POSITIONS.get(query, 0.5) - POSITIONS.get(ref, 0.5))
+                file.write(f"{ref}.fasta\t{query}.fasta\t{dist}\t0\t1000/1000\n")
+
+
+def test_medoid_and_then_farthest_samples_are_selected(tmp_path):
+    distances = tmp_path.joinpath("mash_distances.tsv")
+    write_distances(distances)
+    cluster_distances = read_cluster_distances(distances, CLUSTERS, 3, chunksize=4)
+    assert list(cluster_distances) == [1]
+    samples, dm = cluster_distances[1]
+    # c has the smallest mean distance, e is farthest from it and a is then
+    # farthest from both
+    assert select_representatives(samples, dm, 3) == ["c", "e", "a"]
+    assert select_representatives(samples, dm, 4) == ["c", "e", "a", "b"]
+    assert select_representatives(["f", "g"], np.zeros((2, 2)), 3) == ["f", "g"]
+
+
+def test_pairs_without_a_distance_are_missing(tmp_path):
+    distances = tmp_path.joinpath("mash_distances.tsv")
+    write_distances(distances, missing=[("a", "b"), ("c", "e")])
+    samples, dm = read_cluster_distances(distances, CLUSTERS, 3, chunksize=4)[1]
+    expected = np.abs(
+        np.subtract.outer(
+            [POSITIONS[sample] for sample in samples],
+            [POSITIONS[sample] for sample in samples],
+        )
+    )
+    for sample_1, sample_2 in [("a", "b"), ("c", "e")]:
+        i, j = samples.index(sample_1), samples.index(sample_2)
+        expected[i, j] = expected[j, i] = np.nan
+    np.testing.assert_allclose(dm, expected, rtol=1e-6)
+    assert dm.dtype == np.float32
+    # The medoid is chosen from the known distances
+    assert select_representatives(samples, dm, 1) == ["c"]
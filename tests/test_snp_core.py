@@ -0,0 +1,141 @@
+import shutil
+import subprocess
+
+import pytest
+
+from packed_alignment import unpack
+from snp_core import build_core
+
+# Small cluster in the layout of snippy 4.6.0 (snps.aligned.fa and snps.vcf
+# per sample) with a BED mask over the first two bases. The expected outputs
+# follow the rules of snippy-core 4.6.0: masked columns are X in every
+# sequence (the reference included) and core SNPs are the variable columns
+# where every sequence has a nucleotide. Where snippy-core is installed,
+# test_same_outputs_as_snippy_core compares with the tool itself.
+REFERENCE = {"contig_1": "ACGTACGT", "contig_2": "GGCC"}
+ALIGNED = {
+    "sample_1": {"contig_1": "ACGTTCGT", "contig_2": "GGCA"},
+    "sample_2": {"contig_1": "ACGAACG-", "contig_2": "GNCA"},
+    "sample_3": {"contig_1": "ACnTTCGT", "contig_2": "GGCC"},
+}
+VARIANTS = {
+    "sample_1": [("contig_1", 5), ("contig_2", 4)],
+    "sample_2": [("contig_1", 4), ("contig_1", 5), ("contig_2", 4)],
+    "sample_3": [("contig_1", 5)],
+}
+MASK = "contig_1\t0\t2\n"
+
+EXPECTED_FULL_ALN = {
+    "Reference": "XXGTACGTGGCC",
+    "sample_1": "XXGTTCGTGGCA",
+    "sample_2": "XXGAACG-GNCA",
+    "sample_3": "XXnTTCGTGGCC",
+}
+EXPECTED_ALN = {
+    "Reference": "TAC",
+    "sample_1": "TTA",
+    "sample_2": "AAA",
+    "sample_3": "TTC",
+}
+EXPECTED_TAB = [
+    ["CHR", "POS", "REF", "sample_1", "sample_2", "sample_3"],
+    ["contig_1", "4", "T", "T", "A", "T"],
+    ["contig_1", "5", "A", "T", "A", "T"],
+    ["contig_2", "4", "C", "A", "A", "C"],
+]
+EXPECTED_TXT = [
+    ["ID", "LENGTH", "ALIGNED", "UNALIGNED", "VARIANT", "HET", "MASKED", "LOWCOV"],
+    ["Reference", "12", "10", "0", "0", "0", "2", "0"],
+    ["sample_1", "12", "10", "0", "2", "0", "2", "0"],
+    ["sample_2", "12", "8", "1", "3", "0", "2", "1"],
+    ["sample_3", "12", "9", "0", "1", "1", "2", "0"],
+]
+
+
+def write_fasta(seqs, path):
+    path.write_text("".join(f">{name}\n{seq}\n" for name, seq in seqs.items()))
+
+
+def read_fasta(path):
+    seqs = {}
+    for line in path.read_text().splitlines():
+        if line.startswith(">"):
+            name = line[1:].split()[0]
+            seqs[name] = ""
+        else:
+            seqs[name] += line.strip()
+    return seqs
+
+
+def read_table(path):
+    return [line.split("\t") for line in path.read_text().splitlines()]
+
+
+@pytest.fixture
+def snippy_cluster(tmp_path):
+    reference = tmp_path.joinpath("ref_genome.fasta")
+    write_fasta(REFERENCE, reference)
+    mask = tmp_path.joinpath("mask.bed")
+    mask.write_text(MASK)
+    snippy_dirs = []
+    for sample, contigs in ALIGNED.items():
+        snippy_dir = tmp_path.joinpath("snippy", sample)
+        snippy_dir.mkdir(parents=True)
+        write_fasta(contigs, snippy_dir.joinpath("snps.aligned.fa"))
+        with open(snippy_dir.joinpath("snps.vcf"), "w") as file:
+            file.write("##fileformat=VCFv4.2\n")
+            file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for contig, pos in VARIANTS[sample]:
+                ref = REFERENCE[contig][pos - 1]
+                alt = contigs[contig][pos - 1]
+                file.write(f"{contig}\t{pos}\t.\t{ref}\t{alt}\t100\t.\t.\n")
+        snippy_dirs.append(snippy_dir)
+    return reference, mask, snippy_dirs
+
+
+def check_outputs(prefix):
+    assert read_fasta(prefix.with_name(prefix.name + ".aln")) == EXPECTED_ALN
+    assert read_table(prefix.with_name(prefix.name + ".tab")) == EXPECTED_TAB
+    assert read_table(prefix.with_name(prefix.name + ".txt")) == EXPECTED_TXT
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_outputs_of_snippy_core(snippy_cluster, tmp_path, threads):
+    reference, mask, snippy_dirs = snippy_cluster
+    prefix = tmp_path.joinpath("core", "cluster_1")
+    build_core(snippy_dirs, reference, str(prefix), mask, threads, packed=False)
+    assert read_fasta(tmp_path.joinpath("core", "cluster_1.full.aln")) == (
+        EXPECTED_FULL_ALN
+    )
+    check_outputs(prefix)
+
+
+def test_packed_alignment_is_the_full_alignment(snippy_cluster, tmp_path):
+    reference, mask, snippy_dirs = snippy_cluster
+    prefix = tmp_path.joinpath("core", "cluster_1")
+    build_core(snippy_dirs, reference, str(prefix), mask, packed=True)
+    full_aln = tmp_path.joinpath("unpacked.aln")
+    unpack(tmp_path.joinpath("core", "cluster_1.full.paln"), full_aln)
+    assert read_fasta(full_aln) == EXPECTED_FULL_ALN
+    check_outputs(prefix)
+
+
+@pytest.mark.skipif(shutil.which("snippy-core") is None, reason="needs snippy-core")
+def test_same_outputs_as_snippy_core(snippy_cluster, tmp_path):
+    reference, mask, snippy_dirs = snippy_cluster
+    subprocess.run(
+        ["snippy-core", "--ref", reference, "--mask", mask, "--prefix", "core"]
+        + snippy_dirs,
+        cwd=tmp_path,
+        check=True,
+    )
+    prefix = tmp_path.joinpath("snp_core")
+    build_core(snippy_dirs, reference, str(prefix), mask, packed=False)
+    for extension in [".full.aln", ".aln"]:
+        assert read_fasta(tmp_path.joinpath("snp_core" + extension)) == read_fasta(
+            tmp_path.joinpath("core" + extension)
+        )
+    for extension in [".tab", ".txt"]:
+        assert read_table(tmp_path.joinpath("snp_core" + extension)) == read_table(
+            tmp_path.joinpath("core" + extension)
+        )
@@ -0,0 +1,78 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from snp_dists import SNP_DISTS_HEADER, get_snp_matrix, write_csv
+
+CHARACTERS = list("ACGTacgtN-nX")
+
+
+def random_alignment(path, n_sequences, length, seed, width=60):
+    """Alignment with missing data and lower case bases, wrapped at width"""
+    rng = np.random.default_rng(seed)
+    seqs = {}
+    for i in range(n_sequences):
+        seq = rng.choice(list("ACGT"), size=length)
+        mutated = rng.random(length) < 0.3
+        seq[mutated] = rng.choice(CHARACTERS, size=int(mutated.sum()))
+        seqs[f"sample_{i}"] = "".join(seq)
+    with open(path, "w") as file:
+        for name, seq in seqs.items():
+            lines = [seq[k : k + width] for k in range(0, length, width)]
+            file.write(f">{name}\n" + "\n".join(lines) + "\n")
+    return seqs
+
+
+def naive_snp_dists(seqs):
+    """snp-dists: differences between positions where both have A, C, G or T"""
+    names = list(seqs)
+    dm = np.zeros((len(names), len(names)), dtype=int)
+    for i, a in enumerate(names):
+        for j, b in enumerate(names):
+            dm[i, j] = sum(
+                x != y and x in "ACGT" and y in "ACGT"
+                for x, y in zip(seqs[a].upper(), seqs[b].upper())
+            )
+    return names, dm
+
+
+def read_csv(path):
+    lines = path.read_text().splitlines()
+    header = lines[0].split(",")
+    rows = [line.split(",") for line in lines[1:]]
+    return header, [row[0] for row in rows], np.array([row[1:] for row in rows], int)
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_matrix_of_snp_dists(tmp_path, threads):
+    alignment = tmp_path.joinpath("core.full.aln")
+    seqs = random_alignment(alignment, 7, 1000, seed=threads)
+    names, dm = get_snp_matrix(alignment, threads)
+    expected_names, expected_dm = naive_snp_dists(seqs)
+    assert names == expected_names
+    np.testing.assert_array_equal(dm, expected_dm)
+
+
+def test_csv_of_snp_dists(tmp_path):
+    alignment = tmp_path.joinpath("core.full.aln")
+    seqs = random_alignment(alignment, 4, 200, seed=1)
+    names, dm = get_snp_matrix(alignment)
+    write_csv(names, dm, tmp_path.joinpath("snp_matrix.csv"))
+    header, row_names, matrix = read_csv(tmp_path.joinpath("snp_matrix.csv"))
+    assert header == [SNP_DISTS_HEADER] + list(seqs)
+    assert row_names == list(seqs)
+    np.testing.assert_array_equal(matrix, naive_snp_dists(seqs)[1])
+
+
+@pytest.mark.skipif(shutil.which("snp-dists") is None, reason="needs snp-dists")
+def test_same_csv_as_snp_dists(tmp_path):
+    alignment = tmp_path.joinpath("core.full.aln")
+    random_alignment(alignment, 6, 500, seed=2)
+    expected = subprocess.run(
+        ["snp-dists", "-c", alignment], check=True, capture_output=True, text=True
+    ).stdout
+    names, dm = get_snp_matrix(alignment)
+    write_csv(names, dm, tmp_path.joinpath("snp_matrix.csv"))
+    assert tmp_path.joinpath("snp_matrix.csv").read_text() == expected
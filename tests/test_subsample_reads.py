@@ -0,0 +1,87 @@
+import random
+import shutil
+
+import pytest
+
+from subsample_reads import open_fastq, subsample_pairs, subsample_reads
+
+GENOME_SIZE = 1000
+READ_LENGTH = 50
+
+
+def write_reads(path, n_reads, seed):
+    rng = random.Random(seed)
+    with open_fastq(path, "w") as fastq:
+        for i in range(n_reads):
+            seq = "".join(rng.choice("ACGT") for _ in range(READ_LENGTH))
+            fastq.write(f"@read_{i}\n{seq}\n+\n{'I' * READ_LENGTH}\n")
+
+
+@pytest.fixture
+def reference(tmp_path):
+    path = tmp_path.joinpath("ref_genome.fasta")
+    path.write_text(">contig_1\n" + "A" * GENOME_SIZE + "\n")
+    return path
+
+
+@pytest.fixture
+def reads(tmp_path):
+    # 2 x 1000 reads of 50 bases: a coverage of 100x
+    r1 = tmp_path.joinpath("sample_R1.fastq.gz")
+    r2 = tmp_path.joinpath("sample_R2.fastq.gz")
+    write_reads(r1, 1000, seed=1)
+    write_reads(r2, 1000, seed=2)
+    return r1, r2
+
+
+def count_reads(path):
+    with open_fastq(path) as fastq:
+        return sum(1 for _ in fastq) // 4
+
+
+def test_reads_below_the_maximum_are_linked(tmp_path, reference, reads):
+    out_r1 = tmp_path.joinpath("out", "R1.fastq.gz")
+    out_r2 = tmp_path.joinpath("out", "R2.fastq.gz")
+    subsample_reads(*reads, reference, 100, out_r1, out_r2)
+    assert out_r1.is_symlink() and out_r1.resolve() == reads[0].resolve()
+    assert out_r2.is_symlink() and out_r2.resolve() == reads[1].resolve()
+
+
+def test_subsampled_reads_are_reproducible(tmp_path, reference, reads):
+    outputs = []
+    for run in ["run_1", "run_2"]:
+        out_r1 = tmp_path.joinpath(run, "R1.fastq.gz")
+        out_r2 = tmp_path.joinpath(run, "R2.fastq.gz")
+        subsample_reads(*reads, reference, 20, out_r1, out_r2, seed=3)
+        assert not out_r1.is_symlink()
+        outputs.append((out_r1.read_bytes(), out_r2.read_bytes()))
+    assert outputs[0] == outputs[1]
+
+    # 20x of 100x: a fifth of the pairs, with the names of the pairs matching
+    n_reads = count_reads(out_r1)
+    assert n_reads == count_reads(out_r2)
+    assert 150 <= n_reads <= 250
+    with open_fastq(out_r1) as fastq_1, open_fastq(out_r2) as fastq_2:
+        assert fastq_1.readlines()[::4] == fastq_2.readlines()[::4]
+
+
+def test_reads_of_different_length_are_an_error(tmp_path, reads):
+    r2 = tmp_path.joinpath("short_R2.fastq.gz")
+    write_reads(r2, 999, seed=2)
+    with pytest.raises(ValueError):
+        subsample_pairs(
+            reads[0],
+            r2,
+            tmp_path.joinpath("R1.fastq.gz"),
+            tmp_path.joinpath("R2.fastq.gz"),
+            0.5,
+        )
+
+
+@pytest.mark.skipif(shutil.which("pigz") is None, reason="needs pigz")
+def test_truncated_reads_are_an_error(tmp_path, reads):
+    truncated = tmp_path.joinpath("truncated_R1.fastq.gz")
+    truncated.write_bytes(reads[0].read_bytes()[:-100])
+    with pytest.raises(RuntimeError):
+        with open_fastq(truncated) as fastq:
+            fastq.read()